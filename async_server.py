@@ -0,0 +1,128 @@
+"""
+asyncio front-end for the skill server, an alternative to server.py with the same
+endpoints (index, login, get_auth).
+A request in flight only holds a coroutine, not a server thread: coroutine voice
+handlers are awaited directly, and the regular synchronous handlers run in a
+bounded thread pool.
+"""
+import asyncio
+import json
+import signal
+import ssl
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from aiohttp import web
+
+import dialog
+import lib.twitter_utils as twitter_utils
+from lib.dialog_utils import Request, encode_response
+from lib.twitter_utils import authenticate_user_page, get_access_token
+from lib import log_utils
+from lib.log_utils import get_logger, fields
+from lib import metrics_utils
+
+from config.config import (SERVER_CONFIG, ALL_REQUESTS_VALID,
+                           LOG_LEVEL, LOG_SAMPLE_RATES, LOG_CATEGORY_LEVELS)
+
+if not ALL_REQUESTS_VALID:
+    # The certificate and signature checks are slow to import, only load them when used
+    from lib.validation_utils import valid_alexa_request
+
+# Threads for synchronous voice handlers and other blocking work
+EXECUTOR_THREADS = 32
+
+request_log = get_logger("request")
+auth_log = get_logger("auth")
+
+
+async def index(http_request):
+    raw_body = await http_request.read()
+    request = Request.from_body(raw_body) # The only JSON parse of this body
+    executor = http_request.app['executor']
+    if not ALL_REQUESTS_VALID:
+        loop = asyncio.get_running_loop()
+        # May download the certificate chain, and checks an RSA signature
+        is_valid_request = await loop.run_in_executor(
+            executor, lambda: valid_alexa_request(http_request.headers, raw_body, request=request))
+        if not is_valid_request:
+            return web.Response(body=encode_response(None), content_type='application/json')
+    request_log.info("New Request", extra=fields(body=request.request))
+    output_json = await dialog.route_intent_async(request, executor)
+    return web.Response(body=encode_response(output_json), content_type='application/json')
+
+
+async def metrics(http_request):
+    """ Handler, twitter and validation metrics in the Prometheus text format """
+    return web.Response(body=metrics_utils.render().encode('utf-8'),
+                        headers={"Content-Type" : metrics_utils.CONTENT_TYPE})
+
+
+async def login(http_request):
+    """ Create login screen for user login"""
+    kwargs = dict(http_request.query)
+    auth_log.info("Login", extra=fields(params=kwargs))
+    callback_url = str(http_request.url.origin()) + "/get_auth/"
+    loop = asyncio.get_running_loop()
+    page = await loop.run_in_executor(http_request.app['executor'],
+                                      lambda: authenticate_user_page(callback_url, metadata=kwargs))
+    return web.Response(text=page, content_type='text/html')
+
+
+async def get_auth(http_request):
+    """ Receive access token for user from twitter"""
+    oauth_token = http_request.query['oauth_token']
+    oauth_verifier = http_request.query['oauth_verifier']
+    loop = asyncio.get_running_loop()
+    url_fragments = await loop.run_in_executor(http_request.app['executor'],
+                                               get_access_token, oauth_token, oauth_verifier)
+    from config.config import BASE_REDIRECT_URL
+    redirect_url = BASE_REDIRECT_URL + "#" + url_fragments
+    raise web.HTTPSeeOther(redirect_url.strip())
+
+
+async def on_startup(app):
+    twitter_utils.async_session = aiohttp.ClientSession()
+    # kill -USR2 <pid> reloads voice_handlers.py and the intent schema
+    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR2, dialog.reload_on_signal)
+    asyncio.get_running_loop().run_in_executor(app['executor'], dialog.preload)
+
+
+async def on_cleanup(app):
+    await twitter_utils.async_session.close()
+    app['executor'].shutdown(wait=False)
+
+
+def create_app():
+    app = web.Application()
+    app['executor'] = ThreadPoolExecutor(max_workers=EXECUTOR_THREADS)
+    app.router.add_post('/', index)
+    app.router.add_get('/metrics', metrics)
+    for path in ('/login', '/login/'):
+        app.router.add_get(path, login)
+    for path in ('/get_auth', '/get_auth/'):
+        app.router.add_get(path, get_auth)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def ssl_context_from_config(server_config):
+    if not server_config.get("server.ssl_certificate"):
+        return None
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(server_config["server.ssl_certificate"],
+                            server_config["server.ssl_private_key"])
+    return context
+
+
+if __name__ == "__main__":
+    """
+    Load the server config and launch the asyncio server
+    """
+    print (json.dumps(SERVER_CONFIG, indent=4))
+    log_utils.configure(LOG_LEVEL, LOG_SAMPLE_RATES, LOG_CATEGORY_LEVELS)
+    web.run_app(create_app(),
+                host=SERVER_CONFIG.get("server.socket_host", "0.0.0.0"),
+                port=SERVER_CONFIG.get("server.socket_port", 443),
+                ssl_context=ssl_context_from_config(SERVER_CONFIG))
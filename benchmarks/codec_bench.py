@@ -0,0 +1,120 @@
+"""
+Size and speed of the cache state formats (lib/storage_utils.py FORMATS): the
+jsonpickle text LocalCache used to write, and the compact binary format of
+lib/codec_utils.py.
+
+Each user state is a logged in user with a home timeline in their queue, a
+tweet in focus and a pending action. The tweets carry the fields the twitter
+API returns, of which the binary format keeps only the ones the skill reads
+(Tweet.slim). Every format encodes the states both with full tweets and with
+slimmed ones, so that the saving of slimming the tweets and the saving of the
+format itself show separately. Reports bytes per user and the encode and decode
+time per user.
+
+Usage (from the repository root):
+$ python3 -m benchmarks.codec_bench --users 1000 --tweets 20
+"""
+from __future__ import print_function
+import argparse
+import time
+
+from lib import codec_utils
+from lib.dialog_utils import PendingAction
+from lib.storage_utils import FORMATS, StorageBackend
+from lib.twitter_utils import ReadableQueue, process_tweets
+from benchmarks.fake_twitter import fake_tweet
+
+
+def api_tweet(index):
+    """ fake_tweet with the rest of the fields of a tweet from the twitter API """
+    tweet = fake_tweet(index)
+    tweet.update({"id_str" : str(tweet["id"]),
+                  "created_at" : "Wed Oct 10 20:19:24 +0000 2018",
+                  "source" : "<a href=\"http://twitter.com\" rel=\"nofollow\">Twitter Web Client</a>",
+                  "truncated" : False,
+                  "in_reply_to_status_id" : None, "in_reply_to_status_id_str" : None,
+                  "in_reply_to_user_id" : None, "in_reply_to_user_id_str" : None,
+                  "geo" : None, "coordinates" : None, "place" : None, "contributors" : None,
+                  "is_quote_status" : False, "favorite_count" : index * 3,
+                  "possibly_sensitive" : False, "lang" : "en"})
+    tweet["entities"].update({"hashtags" : [{"text" : "fake", "indices" : [10, 15]}],
+                              "symbols" : [],
+                              "urls" : [{"url" : "http://t.co/x", "expanded_url" : "http://example.com/fake",
+                                         "display_url" : "example.com/fake", "indices" : [40, 53]}]})
+    for mention in tweet["entities"]["user_mentions"]:
+        mention.update({"id" : 2000 + index % 7, "id_str" : str(2000 + index % 7), "indices" : [0, 6]})
+    tweet["user"].update({"id" : 3000 + index, "id_str" : str(3000 + index),
+                          "location" : "Seattle, WA", "url" : None, "protected" : False,
+                          "followers_count" : 1000 + index, "friends_count" : 100, "listed_count" : 5,
+                          "created_at" : "Mon Nov 29 21:18:15 +0000 2010", "favourites_count" : 42,
+                          "utc_offset" : None, "time_zone" : None, "geo_enabled" : True,
+                          "verified" : False, "statuses_count" : 12345, "lang" : None,
+                          "profile_background_color" : "C0DEED",
+                          "profile_image_url" : "http://pbs.twimg.com/profile_images/1/fake_normal.jpg",
+                          "profile_image_url_https" : "https://pbs.twimg.com/profile_images/1/fake_normal.jpg",
+                          "profile_link_color" : "1DA1F2", "profile_text_color" : "333333",
+                          "default_profile" : True, "default_profile_image" : False,
+                          "following" : False, "follow_request_sent" : False, "notifications" : False})
+    return tweet
+
+
+def user_state(index, tweets):
+    queue = ReadableQueue(process_tweets([api_tweet(index * tweets + offset) for offset in range(tweets)]))
+    return {"access_token" : "bench-user-{}".format(index),
+            "access_secret" : "secret",
+            "twitter_user_id" : str(index),
+            "screen_name" : "benchuser{}".format(index),
+            "user_queue" : queue,
+            "focus_tweet" : queue.queue()[0],
+            "pending_action" : PendingAction.create("post_reply", {"message" : "@author0 hello",
+                                                                   "in_reply_to_status_id" : index}).to_dict()}
+
+
+def slimmed(state):
+    """ state with its tweets cut down to the fields the skill reads, as the binary format stores them """
+    return codec_utils.decode(codec_utils.encode(state))
+
+
+def bench(format, states):
+    backend = StorageBackend()
+    backend.format = format
+    start = time.perf_counter()
+    encoded = [backend.encode(state) for state in states]
+    encode_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for data in encoded:
+        backend.decode(data)
+    decode_seconds = time.perf_counter() - start
+    return {"bytes/user" : sum(len(data) for data in encoded) / len(states),
+            "encode us/user" : encode_seconds / len(states) * 1e6,
+            "decode us/user" : decode_seconds / len(states) * 1e6}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--tweets", type=int, default=20, help="tweets in each user's queue")
+    parser.add_argument("--formats", default=",".join(FORMATS))
+    args = parser.parse_args()
+
+    full_states = [user_state(index, args.tweets) for index in range(args.users)]
+    tweets = {"full" : full_states, "slimmed" : [slimmed(state) for state in full_states]}
+    columns = ("bytes/user", "encode us/user", "decode us/user")
+    print ("{:<12} {:<8} ".format("format", "tweets") + " ".join("{:>16}".format(column) for column in columns))
+    results = {}
+    for format in args.formats.split(","):
+        for kind, states in tweets.items():
+            result = results[format, kind] = bench(format, states)
+            print ("{:<12} {:<8} ".format(format, kind) +
+                   " ".join("{:>16.1f}".format(result[column]) for column in columns))
+    size = lambda format, kind: results[format, kind]["bytes/user"]
+    if ("jsonpickle", "full") in results:
+        print ("Slimming the tweets (jsonpickle): {:.0f} -> {:.0f} bytes/user".format(
+            size("jsonpickle", "full"), size("jsonpickle", "slimmed")))
+    if ("jsonpickle", "slimmed") in results and ("binary", "slimmed") in results:
+        print ("Binary format (slimmed tweets): {:.0f} -> {:.0f} bytes/user".format(
+            size("jsonpickle", "slimmed"), size("binary", "slimmed")))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Offline stand-in for Alexa's request signing:
+generates a local root -> intermediate -> echo-api.amazon.com certificate chain,
+serves it in place of S3 and signs request bodies with it.
+"""
+import base64
+import json
+import os
+import tempfile
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import requests
+
+from cryptography import x509
+from cryptography.x509.oid import NameOID, ExtendedKeyUsageOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, padding
+
+from lib.validation_utils import CertificateCache, ECHO_API_DOMAIN
+
+CERT_CHAIN_URL = "https://s3.amazonaws.com/echo.api/echo-api-cert.pem"
+
+
+def _name(common_name):
+    return x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+
+
+def _issue(subject, key, issuer, issuer_key, is_ca, dns_name=None, valid_days=30):
+    now = datetime.now(timezone.utc)
+    builder = (x509.CertificateBuilder()
+               .subject_name(subject)
+               .issuer_name(issuer)
+               .public_key(key.public_key())
+               .serial_number(x509.random_serial_number())
+               .not_valid_before(now - timedelta(days=1))
+               .not_valid_after(now + timedelta(days=valid_days))
+               .add_extension(x509.BasicConstraints(ca=is_ca, path_length=None), critical=True)
+               # The extensions a publicly trusted chain carries, which validation requires
+               .add_extension(x509.KeyUsage(digital_signature=not is_ca, key_cert_sign=is_ca, crl_sign=is_ca,
+                                            content_commitment=False, key_encipherment=not is_ca,
+                                            data_encipherment=False, key_agreement=False,
+                                            encipher_only=False, decipher_only=False), critical=True)
+               .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False)
+               .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(issuer_key.public_key()),
+                              critical=False))
+    if dns_name:
+        builder = builder.add_extension(x509.SubjectAlternativeName([x509.DNSName(dns_name)]),
+                                        critical=False)
+    if not is_ca:
+        builder = builder.add_extension(x509.ExtendedKeyUsage([ExtendedKeyUsageOID.SERVER_AUTH,
+                                                               ExtendedKeyUsageOID.CLIENT_AUTH]), critical=False)
+    return builder.sign(issuer_key, hashes.SHA256())
+
+
+class FakeAlexaSigner(object):
+    """
+    Owns a freshly generated certificate chain and the signing key of its leaf.
+    fetch() stands in for the S3 download and counts how often it is hit.
+    After serve_over_http() the chain is fetched from a local HTTP server instead
+    of memory, so that downloads cost a real round trip.
+    """
+    def __init__(self, domain=ECHO_API_DOMAIN, key_size=2048):
+        root_key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+        intermediate_key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+        self.signing_key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+
+        root = _issue(_name("Fake Alexa Root"), root_key, _name("Fake Alexa Root"), root_key, True)
+        intermediate = _issue(_name("Fake Alexa Intermediate"), intermediate_key,
+                              root.subject, root_key, True)
+        leaf = _issue(_name(domain), self.signing_key, intermediate.subject, intermediate_key,
+                      False, dns_name=domain)
+
+        to_pem = lambda cert: cert.public_bytes(serialization.Encoding.PEM)
+        self.chain_pem = to_pem(leaf) + to_pem(intermediate)
+        self.fetch_count = 0
+        self.http_server = None
+
+        fd, self.roots_file = tempfile.mkstemp(suffix=".pem")
+        with os.fdopen(fd, 'wb') as roots:
+            roots.write(to_pem(root))
+
+    def close(self):
+        if os.path.exists(self.roots_file):
+            os.remove(self.roots_file)
+        if self.http_server:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+            self.http_server = None
+
+    def serve_over_http(self):
+        chain_pem = self.chain_pem
+
+        class ChainHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-pem-file")
+                self.send_header("Content-Length", str(len(chain_pem)))
+                self.end_headers()
+                self.wfile.write(chain_pem)
+
+            def log_message(self, *args):
+                pass
+
+        class ThreadingServer(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.http_server = ThreadingServer(("127.0.0.1", 0), ChainHandler)
+        threading.Thread(target=self.http_server.serve_forever, daemon=True).start()
+
+    def fetch(self, cert_chain_url):
+        self.fetch_count += 1
+        if self.http_server:
+            host, port = self.http_server.server_address
+            return requests.get("http://{}:{}/echo.api/echo-api-cert.pem".format(host, port)).content
+        return self.chain_pem
+
+    def certificate_cache(self, **kwargs):
+        """ A CertificateCache that downloads from, and trusts, this signer """
+        return CertificateCache(fetch=self.fetch, trusted_roots_file=self.roots_file, **kwargs)
+
+    def sign(self, request_body):
+        signature = self.signing_key.sign(request_body, padding.PKCS1v15(), hashes.SHA1())
+        return base64.b64encode(signature).decode('ascii')
+
+    def headers(self, request_body, cert_chain_url=CERT_CHAIN_URL):
+        return {"Signaturecertchainurl": cert_chain_url,
+                "Signature": self.sign(request_body)}
+
+
+def make_request_body(intent_name="ListHomeTweets", slots=None, access_token="fake-token",
+                      request_type="IntentRequest", session_id=None):
+    """
+    Serialized request, as Alexa would POST it.
+    slots - slot name -> value, a value of None sends the slot without a value
+    """
+    timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    request = {
+        "version": "1.0",
+        "session": {
+            "new": False,
+            "sessionId": session_id or "amzn1.echo-api.session." + str(uuid.uuid4()),
+            "user": {"userId": "amzn1.account.FAKE", "accessToken": access_token}
+        },
+        "request": {
+            "type": request_type,
+            "requestId": "amzn1.echo-api.request." + str(uuid.uuid4()),
+            "timestamp": timestamp
+        }
+    }
+    if request_type == "IntentRequest":
+        request_slots = {}
+        for name, value in (slots or {}).items():
+            request_slots[name] = {"name": name}
+            if value is not None:
+                request_slots[name]["value"] = value
+        request["request"]["intent"] = {"name": intent_name, "slots": request_slots}
+    return json.dumps(request).encode('utf-8')
@@ -0,0 +1,142 @@
+"""
+Stand-in for the twitter API: a local HTTP server that answers every endpoint
+the skill calls with canned JSON, optionally after an artificial delay.
+Timelines page like twitter's: a request with max_id or since_id gets the
+tweets of a longer timeline in that range, newest first.
+Point the skill at it by setting twitter_utils.TWITTER_API_ROOT (in process)
+or the TWITTER_API_ROOT environment variable (for a separately started server).
+
+Usage, standalone (from the repository root):
+$ python3 -m benchmarks.fake_twitter --port 8099 --latency 0.05
+"""
+from __future__ import print_function
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+
+def fake_tweet(index):
+    screen_name = "user{}".format(index % 7)
+    # Newest first, as twitter lists tweets
+    return {"id" : 100000 - index,
+            "text" : "@{} this is fake tweet number {} http://t.co/x".format(screen_name, index),
+            "entities" : {"user_mentions" : [{"screen_name" : screen_name, "name" : "User {}".format(index % 7)}]},
+            "user" : {"screen_name" : "author{}".format(index),
+                      "name" : "Author {}".format(index),
+                      "description" : "A fake account"},
+            "retweeted" : index % 2 == 0,
+            "retweet_count" : index,
+            "favorited" : False,
+            "in_reply_to_screen_name" : None}
+
+
+TIMELINE_PATHS = ("/1.1/statuses/home_timeline.json", "/1.1/statuses/mentions_timeline.json",
+                  "/1.1/statuses/user_timeline.json", "/1.1/statuses/retweets_of_me.json",
+                  "/1.1/favorites/list.json", "/1.1/search/tweets.json")
+
+
+def timeline_page(path, query, timeline):
+    """ The page of timeline asked for with max_id, since_id and count """
+    max_id = int(query["max_id"][0]) if "max_id" in query else None
+    since_id = int(query["since_id"][0]) if "since_id" in query else None
+    count = int(query.get("count", [20])[0])
+    tweets = [tweet for tweet in timeline
+              if (max_id is None or tweet["id"] <= max_id) and (since_id is None or tweet["id"] > since_id)]
+    tweets = tweets[:count]
+    return {"statuses" : tweets} if path == "/1.1/search/tweets.json" else tweets
+
+
+def canned_responses(tweets_per_page=20):
+    tweets = [fake_tweet(index) for index in range(tweets_per_page)]
+    return {
+        "/1.1/statuses/home_timeline.json" : tweets,
+        "/1.1/statuses/mentions_timeline.json" : tweets,
+        "/1.1/statuses/user_timeline.json" : tweets,
+        "/1.1/statuses/retweets_of_me.json" : tweets,
+        "/1.1/favorites/list.json" : tweets,
+        "/1.1/search/tweets.json" : {"statuses" : tweets},
+        "/1.1/statuses/update.json" : {"id" : 1},
+        "/1.1/users/lookup.json" : [{"location" : "Seattle"}],
+        "/1.1/geo/search.json" : {"result" : {"places" : [{"centroid" : [-122.33, 47.61]}]}},
+        "/1.1/trends/closest.json" : [{"woeid" : 2490383, "name" : "Seattle"}],
+        "/1.1/trends/place.json" : [{"trends" : [{"name" : "#one"}, {"name" : "#two"}, {"name" : "#three"}]}],
+    }
+
+
+class FakeTwitter(object):
+    """
+    Threaded local HTTP server answering twitter API calls.
+    latency - seconds to wait before answering, to model a slow upstream
+    timeline_length - tweets in each timeline, paged through with max_id
+    """
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, tweets_per_page=20, timeline_length=100):
+        responses = {path : json.dumps(body).encode('utf-8')
+                     for path, body in canned_responses(tweets_per_page).items()}
+        timeline = [fake_tweet(index) for index in range(timeline_length)]
+        self.request_count = 0
+        fake = self
+
+        class TwitterHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately, which Nagle would hold up on a kept alive connection
+            disable_nagle_algorithm = True
+
+            def answer(self):
+                fake.request_count += 1
+                if latency:
+                    time.sleep(latency)
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if url.path in TIMELINE_PATHS and ("max_id" in query or "since_id" in query):
+                    body = json.dumps(timeline_page(url.path, query, timeline)).encode('utf-8')
+                else:
+                    body = responses.get(url.path)
+                self.send_response(200 if body is not None else 404)
+                body = body if body is not None else b'{"errors":[{"code":34}]}'
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = answer
+            do_POST = answer
+
+            def log_message(self, *args):
+                pass
+
+        class ThreadingServer(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.server = ThreadingServer((host, port), TwitterHandler)
+
+    @property
+    def api_root(self):
+        host, port = self.server.server_address
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in for the twitter API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+    fake = FakeTwitter(args.host, args.port, args.latency)
+    print ("Serving fake twitter API at", fake.api_root)
+    fake.server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""
+HTTP load generator and replay harness for SkillServer.index.
+
+Runs Alexa style sessions (launch, list home tweets then 'next', post a tweet
+then 'yes', ...) from many concurrent clients, and reports throughput, latency
+percentiles and error rates per intent. Useful for sizing server.thread_pool.
+
+Sessions are drawn from --mix, e.g. home=4,post=1 (see FLOWS for the flows).
+With --replay, request bodies recorded one JSON object per line are sent
+instead, with fresh requestIds and timestamps. Requests sharing a sessionId are
+replayed in their recorded order by one client.
+
+--in-process starts SkillServer in this process against a stubbed twitter API
+(benchmarks/fake_twitter.py) and seeds a cache of its own, in a temporary
+directory and without a journal, with --users fake users.
+Otherwise --url points at a running server, which needs ALL_REQUESTS_VALID and
+must already know the --tokens (start it with TWITTER_API_ROOT pointing at a
+fake_twitter instance to stub twitter there as well).
+
+Usage (from the repository root):
+$ python3 -m benchmarks.load_test --in-process --server-threads 10 --concurrency 50 --sessions 1000 --twitter-latency 0.05
+$ python3 -m benchmarks.load_test --url https://localhost/ --tokens TOKEN1,TOKEN2 --mix home=1
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import requests
+
+from benchmarks.fake_alexa import make_request_body
+from benchmarks.fake_twitter import FakeTwitter
+
+NON_INTENT_REQUESTS = ("LaunchRequest", "SessionEndedRequest")
+
+# Session flows: lists of (intent or request type, slots)
+FLOWS = {
+    "launch" : [("LaunchRequest", None)],
+    "home" : [("ListHomeTweets", None), ("NextIntent", None), ("NextIntent", None)],
+    "mentions" : [("FindLatestMentions", None), ("MoreInfo", {"Index" : "2", "Ordinal" : None})],
+    "search" : [("SearchTweets", {"Topic" : "python"}), ("NextIntent", None)],
+    "trends" : [("SearchTrends", {"Location" : "Seattle"})],
+    "post" : [("PostTweet", {"Tweet" : "hello from the load test"}), ("YesIntent", None)],
+    "reply" : [("ListHomeTweets", None),
+               ("ReplyIntent", {"Tweet" : "nice one", "Index" : "2", "Ordinal" : None}),
+               ("YesIntent", None)],
+    "help" : [("AMAZON.HelpIntent", None), ("SessionEndedRequest", None)],
+}
+
+DEFAULT_MIX = "launch=2,home=4,mentions=1,search=1,trends=1,post=1,reply=1"
+
+
+def parse_mix(mix):
+    """ 'home=4,post=1' -> [('home', 4), ('post', 1)] """
+    weights = []
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        if name.strip() not in FLOWS:
+            raise ValueError("Unknown flow {}, pick from {}".format(name, sorted(FLOWS)))
+        weights.append((name.strip(), float(weight or 1)))
+    return weights
+
+
+def flow_requests(flow, token):
+    """ (label, body) pairs for one session of a flow """
+    session_id = "amzn1.echo-api.session." + str(uuid.uuid4())
+    for name, slots in FLOWS[flow]:
+        if name in NON_INTENT_REQUESTS:
+            body = make_request_body(request_type=name, access_token=token, session_id=session_id)
+        else:
+            body = make_request_body(name, slots, access_token=token, session_id=session_id)
+        yield name, body
+
+
+def replay_requests(session_requests):
+    """ Recorded requests, with fresh ids and timestamps so validation doesn't reject them """
+    for request_json in session_requests:
+        request_json = json.loads(json.dumps(request_json))
+        inner = request_json.setdefault("request", {})
+        inner["requestId"] = "amzn1.echo-api.request." + str(uuid.uuid4())
+        inner["timestamp"] = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        label = (inner.get("intent") or {}).get("name") or inner.get("type", "unknown")
+        yield label, json.dumps(request_json).encode('utf-8')
+
+
+class Results(object):
+    """ Latencies and errors per label, recorded from many threads """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, label, latency, ok):
+        with self.lock:
+            self.latencies[label].append(latency)
+            if not ok:
+                self.errors[label] += 1
+
+    def report(self, elapsed):
+        def percentile(samples, pct):
+            ordered = sorted(samples)
+            return ordered[int(round(pct / 100.0 * (len(ordered) - 1)))] * 1000
+
+        total = sum(len(samples) for samples in self.latencies.values())
+        total_errors = sum(self.errors.values())
+        print ("{} requests in {:.1f}s: {:.1f} req/s, {:.2f}% errors".format(
+            total, elapsed, total / elapsed, 100.0 * total_errors / max(total, 1)))
+        print ("{:<22} {:>7} {:>7} {:>9} {:>9} {:>9}".format("request", "count", "err%", "p50 ms", "p90 ms", "p99 ms"))
+        rows = sorted(self.latencies.items()) + [("ALL", [l for s in self.latencies.values() for l in s])]
+        for label, samples in rows:
+            errors = total_errors if label == "ALL" else self.errors[label]
+            print ("{:<22} {:>7} {:>7.2f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+                label, len(samples), 100.0 * errors / len(samples),
+                percentile(samples, 50), percentile(samples, 90), percentile(samples, 99)))
+
+
+def start_in_process_server(port, server_threads, twitter_api_root, tokens):
+    """ Mount SkillServer on a local port, talking to the stubbed twitter API """
+    from lib import twitter_utils
+    from lib.storage_utils import make_backend
+
+    # The fake users must never reach the server's cache in tmp/, or its journal, which
+    # the next server start would replay. The server modules import local_cache by name,
+    # so it is replaced before they are imported
+    temp_dir = tempfile.mkdtemp(prefix="load_test")
+    backup = os.path.join(temp_dir, "twitter.cache")
+    twitter_utils.local_cache = twitter_utils.LocalCache(
+        backup, backend=make_backend(twitter_utils.CACHE_BACKEND, backup, twitter_utils.CACHE_FORMAT), journal=False)
+    import cherrypy
+    import server
+
+    twitter_utils.TWITTER_API_ROOT = twitter_api_root
+    for index, token in enumerate(tokens):
+        twitter_utils.local_cache.set_user_state(token, {"access_token" : token,
+                                                         "access_secret" : "secret",
+                                                         "twitter_user_id" : str(index),
+                                                         "screen_name" : "loaduser{}".format(index)})
+    cherrypy.config.update({"server.socket_host" : "127.0.0.1",
+                            "server.socket_port" : port,
+                            "server.thread_pool" : server_threads,
+                            "log.screen" : False,
+                            "checker.on" : False,
+                            "engine.autoreload.on" : False})
+    cherrypy.tree.mount(server.SkillServer(), "/")
+    cherrypy.engine.start()
+
+    def stop():
+        cherrypy.engine.exit()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return "http://127.0.0.1:{}/".format(port), stop
+
+
+def run_load(url, jobs, concurrency, verify_tls=True):
+    """ jobs - iterables of (label, body), each one run as a session, in order, on one client """
+    results = Results()
+    local = threading.local()
+
+    def run_session(job):
+        if not hasattr(local, "http"):
+            local.http = requests.Session()
+        for label, body in job:
+            start = time.perf_counter()
+            try:
+                response = local.http.post(url, data=body, timeout=60, verify=verify_tls,
+                                           headers={"Content-Type" : "application/json"})
+                ok = response.status_code == 200 and response.content.strip() not in (b"", b"null")
+            except requests.RequestException:
+                ok = False
+            results.record(label, time.perf_counter() - start, ok)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(run_session, jobs))
+    return results, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for SkillServer.index")
+    parser.add_argument("--url", help="running SkillServer to target")
+    parser.add_argument("--in-process", action="store_true", help="start SkillServer with a stubbed twitter API")
+    parser.add_argument("--port", type=int, default=8098, help="port for --in-process")
+    parser.add_argument("--server-threads", type=int, default=10, help="server.thread_pool for --in-process")
+    parser.add_argument("--twitter-latency", type=float, default=0.0, help="seconds the stubbed twitter API waits")
+    parser.add_argument("--concurrency", type=int, default=20, help="concurrent client sessions")
+    parser.add_argument("--sessions", type=int, default=500)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="flow=weight,... from: " + ",".join(sorted(FLOWS)))
+    parser.add_argument("--users", type=int, default=100, help="fake users seeded for --in-process")
+    parser.add_argument("--tokens", help="comma separated access tokens, instead of the seeded fake users")
+    parser.add_argument("--replay", help="file with one recorded request JSON per line")
+    parser.add_argument("--insecure", action="store_true", help="don't verify the server's TLS certificate")
+    args = parser.parse_args()
+
+    if args.replay:
+        with open(args.replay) as replay_file:
+            recorded = [json.loads(line) for line in replay_file if line.strip()]
+        sessions = defaultdict(list)
+        for request_json in recorded:
+            sessions[request_json.get("session", {}).get("sessionId")].append(request_json)
+        jobs = [replay_requests(session_requests) for session_requests in sessions.values()]
+        tokens = sorted({r.get("session", {}).get("user", {}).get("accessToken") for r in recorded} - {None})
+    else:
+        tokens = (args.tokens.split(",") if args.tokens
+                  else ["load-user-{}".format(index) for index in range(args.users)])
+        flows, weights = zip(*parse_mix(args.mix))
+        jobs = [flow_requests(flow, random.choice(tokens))
+                for flow in random.choices(flows, weights=weights, k=args.sessions)]
+
+    stop = lambda: None
+    fake_twitter = None
+    if args.in_process:
+        fake_twitter = FakeTwitter(latency=args.twitter_latency).start()
+        url, stop = start_in_process_server(args.port, args.server_threads, fake_twitter.api_root, tokens)
+    elif args.url:
+        url = args.url
+    else:
+        parser.error("pass --url or --in-process")
+
+    try:
+        results, elapsed = run_load(url, jobs, args.concurrency, verify_tls=not args.insecure)
+    finally:
+        stop()
+        if fake_twitter:
+            fake_twitter.stop()
+    results.report(elapsed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Micro-benchmark for lib.dialog_utils.Request: time and memory per request of the
+lazy __slots__ view, against the wrapper that walked the nested request dicts
+on every accessor call.
+
+Each request goes through the accessors a ReplyIntent turn uses (validation,
+routing, then a handler reading its slots a few times), built from a parsed
+body as in SkillServer.index.
+
+Usage (from the repository root):
+$ python3 -m benchmarks.request_bench --iterations 100000
+"""
+from __future__ import print_function
+import argparse
+import json
+import timeit
+import tracemalloc
+
+from lib.dialog_utils import Request
+from benchmarks.fake_alexa import make_request_body
+
+
+class ChainedRequest(object):
+    """ The request wrapper as it was: every accessor walks self.request """
+    def __init__(self, request_dict):
+        self.request = request_dict
+
+    def request_type(self):
+        return self.request["request"]["type"]
+
+    def request_id(self):
+        return self.request["request"]["requestId"]
+
+    def timestamp(self):
+        return self.request["request"]["timestamp"]
+
+    def intent_name(self):
+        if not "intent" in self.request["request"]:
+            return None
+        return self.request["request"]["intent"]["name"]
+
+    def access_token(self):
+        try:
+            return self.request['session']['user']['accessToken']
+        except:
+            return None
+
+    def get_slot_value(self, slot_name):
+        try:
+            return self.request["request"]["intent"]["slots"][slot_name]["value"]
+        except:
+            return None
+
+    def get_slot_names(self):
+        try:
+            return self.request['request']['intent']['slots'].keys()
+        except:
+            return []
+
+    def get_slot_map(self):
+        return {slot_name : self.get_slot_value(slot_name) for slot_name in self.get_slot_names()}
+
+
+def reply_turn(request):
+    """ The accessor calls of one ReplyIntent request, from validation to the handler """
+    request.request_id(), request.timestamp()
+    request.access_token(), request.request_type(), request.intent_name()
+    slots = request.get_slot_map()
+    request.get_slot_value("Tweet")
+    slots["Tweet"], slots["Ordinal"], slots["Index"]
+    request.get_slot_map()
+    for _ in range(4):
+        request.access_token()
+
+
+def peak_bytes_per_request(request_class, request_json, count=1000):
+    """ Peak memory allocated while wrapping and serving one request, the parsed body is not counted """
+    tracemalloc.start()
+    total = 0
+    for _ in range(count):
+        start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        reply_turn(request_class(request_json))
+        total += tracemalloc.get_traced_memory()[1] - start
+    tracemalloc.stop()
+    return total / float(count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--iterations", type=int, default=100000)
+    args = parser.parse_args()
+
+    body = make_request_body("ReplyIntent", {"Tweet" : "nice one", "Index" : "2", "Ordinal" : None},
+                             access_token="bench-user")
+    request_json = json.loads(body.decode("utf-8"))
+
+    print ("{:<16} {:>12} {:>20}".format("wrapper", "us/request", "peak bytes/request"))
+    for name, request_class in (("chained dicts", ChainedRequest), ("lazy __slots__", Request)):
+        seconds = min(timeit.repeat(lambda: reply_turn(request_class(request_json)),
+                                    number=args.iterations, repeat=3))
+        print ("{:<16} {:>12.2f} {:>20.0f}".format(name, seconds / args.iterations * 1e6,
+                                                   peak_bytes_per_request(request_class, request_json)))
+
+
+if __name__ == "__main__":
+    main()
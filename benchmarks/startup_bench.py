@@ -0,0 +1,129 @@
+"""
+Startup time of the skill server: how long a fresh process takes to import its
+modules, and then to do the work that is deferred until first use (config files,
+handler discovery and the twitter cache).
+
+Every run starts a fresh interpreter with -X importtime. Import time is reported
+per top level package (the time spent in its own modules), and initialization
+time per step. --users backs the twitter cache with a temporary directory of that
+many fake users, each with a timeline in their queue, to show how startup grows
+with the number of users.
+
+Usage (from the repository root):
+$ python3 -m benchmarks.startup_bench --module server --users 10000 --runs 3
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+from collections import defaultdict
+
+# Run in the fresh interpreter: import the module, then time each deferred step
+CHILD_CODE = """
+import json, time
+start = time.perf_counter()
+import {module}
+import_seconds = time.perf_counter() - start
+
+import dialog
+from config import config
+from lib.twitter_utils import local_cache
+steps = []
+def timed(name, function):
+    start = time.perf_counter()
+    function()
+    steps.append((name, time.perf_counter() - start))
+
+timed("config files", lambda: [getattr(config, name) for name in
+                               ("SERVER_CONFIG", "BASE_REDIRECT_URL", "INTENT_SCHEMA", "TWITTER_CONSUMER_KEY")])
+timed("dispatch table", dialog.dispatch_table)
+timed("twitter cache", local_cache.load)
+print(json.dumps({{"import" : import_seconds, "steps" : steps}}))
+"""
+
+PROJECT_MODULES = ("server", "async_server", "dialog", "voice_handlers", "lib", "config", "benchmarks")
+
+
+def seed_cache(backup, users):
+    """ A cache backup with users logged in, each with a home timeline queue """
+    from lib.twitter_utils import LocalCache, process_tweets
+    from benchmarks.fake_twitter import fake_tweet
+    cache = LocalCache(backup)
+    timeline = [fake_tweet(index) for index in range(20)]
+    for index in range(users):
+        user_id = "startup-user-{}".format(index)
+        cache.set_user_state(user_id, {"access_token" : user_id,
+                                       "access_secret" : "secret",
+                                       "twitter_user_id" : str(index),
+                                       "screen_name" : "startupuser{}".format(index)})
+        cache.initialize_user_queue(user_id, process_tweets(timeline))
+    cache.serialize()
+
+
+def parse_importtime(stderr):
+    """ -X importtime output -> microseconds of self time per top level package """
+    self_times = defaultdict(int)
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        self_times[name.strip().split(".")[0]] += int(self_us)
+    return self_times
+
+
+def run_once(module, env):
+    child = subprocess.run([sys.executable, "-X", "importtime", "-c", CHILD_CODE.format(module=module)],
+                           env=env, capture_output=True, text=True, check=True)
+    result = json.loads(child.stdout.strip().splitlines()[-1])
+    return result, parse_importtime(child.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--module", default="server", help="module to start from, server or async_server")
+    parser.add_argument("--users", type=int, default=0, help="fake users in a temporary cache, 0 uses tmp/ as is")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=15, help="packages listed by import time")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    temp_dir = None
+    if args.users:
+        temp_dir = tempfile.mkdtemp()
+        env["TWITTER_CACHE_BACKUP"] = os.path.join(temp_dir, "twitter.cache")
+        print ("Seeding {} users...".format(args.users))
+        seed_cache(env["TWITTER_CACHE_BACKUP"], args.users)
+
+    try:
+        runs = [run_once(args.module, env) for _ in range(args.runs)]
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir)
+
+    median_ms = lambda values: statistics.median(values) * 1000
+    print ("\nimport {}: {:.1f} ms (median of {} runs)".format(
+        args.module, median_ms([result["import"] for result, _ in runs]), args.runs))
+
+    packages = set().union(*(self_times for _, self_times in runs))
+    package_ms = {package : median_ms([self_times.get(package, 0) / 1e6 for _, self_times in runs])
+                  for package in packages}
+    print ("\n{:<24} {:>10}".format("package", "import ms"))
+    ranked = sorted(package_ms.items(), key=lambda item: -item[1])
+    shown = [item for item in ranked if item[0] in PROJECT_MODULES] + ranked[:args.top]
+    for package, milliseconds in sorted(set(shown), key=lambda item: -item[1]):
+        marker = " *" if package in PROJECT_MODULES else ""
+        print ("{:<24} {:>10.1f}{}".format(package, milliseconds, marker))
+    print ("(* the skill's own modules, time spent in their module bodies)")
+
+    print ("\n{:<24} {:>10}".format("deferred step", "ms"))
+    for index, (name, _) in enumerate(runs[0][0]["steps"]):
+        print ("{:<24} {:>10.1f}".format(name, median_ms([result["steps"][index][1] for result, _ in runs])))
+
+
+if __name__ == "__main__":
+    main()
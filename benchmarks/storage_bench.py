@@ -0,0 +1,98 @@
+"""
+Throughput of the twitter cache storage backends (lib/storage_utils.py) as the
+number of users grows.
+
+For each backend and user count, a temporary store is seeded with logged in
+users that each have a home timeline in their queue, then timed on:
+load - a fresh backend reading the server state and every user, as at startup
+lookup - reading random users one at a time, as a shared cache does per request
+write - writing random users one at a time, as a shared cache does per request
+flush - writing batches of users, as the background flush does
+
+Usage (from the repository root):
+$ python3 -m benchmarks.storage_bench --users 10000,100000 --backends file,sqlite
+"""
+from __future__ import print_function
+import argparse
+import random
+import shutil
+import tempfile
+import time
+import os
+
+from lib.storage_utils import BACKENDS, make_backend
+from lib.twitter_utils import ReadableQueue, process_tweets
+from benchmarks.fake_twitter import fake_tweet
+
+
+def user_state(index, timeline):
+    return {"access_token" : "bench-user-{}".format(index),
+            "access_secret" : "secret",
+            "twitter_user_id" : str(index),
+            "screen_name" : "benchuser{}".format(index),
+            "user_queue" : ReadableQueue(timeline)}
+
+
+def timed(function, count):
+    """ Operations per second of calling function count times """
+    start = time.perf_counter()
+    for _ in range(count):
+        function()
+    return count / (time.perf_counter() - start)
+
+
+def bench(backend_name, users, args):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        backup = os.path.join(temp_dir, "twitter.cache")
+        backend = make_backend(backend_name, backup)
+        timeline = process_tweets([fake_tweet(index) for index in range(args.tweets)])
+        user_ids = ["bench-user-{}".format(index) for index in range(users)]
+        backend.write_server({"twitter_keys" : ("key", "secret")})
+        start = time.perf_counter()
+        for offset in range(0, users, args.batch):
+            backend.write_users({user_id : user_state(offset + index, timeline)
+                                 for index, user_id in enumerate(user_ids[offset:offset + args.batch])})
+        seed_seconds = time.perf_counter() - start
+        backend.close()
+
+        backend = make_backend(backend_name, backup)
+        start = time.perf_counter()
+        backend.read_server()
+        loaded = sum(1 for _ in backend.read_users())
+        load_seconds = time.perf_counter() - start
+        assert loaded == users, (loaded, users)
+
+        rng = random.Random(0)
+        state = user_state(0, timeline)
+        return {"seed/s" : users / seed_seconds,
+                "load s" : load_seconds,
+                "lookup/s" : timed(lambda: backend.read_user(rng.choice(user_ids)), args.operations),
+                "write/s" : timed(lambda: backend.write_users({rng.choice(user_ids) : state}), args.operations),
+                "flush users/s" : args.batch * timed(
+                    lambda: backend.write_users({user_id : state for user_id in rng.sample(user_ids, args.batch)}),
+                    max(args.operations // args.batch, 1))}
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--users", default="10000,100000", help="comma separated user counts")
+    parser.add_argument("--backends", default=",".join(sorted(BACKENDS)))
+    parser.add_argument("--tweets", type=int, default=20, help="tweets in each user's queue")
+    parser.add_argument("--operations", type=int, default=2000, help="lookups and writes timed per run")
+    parser.add_argument("--batch", type=int, default=100, help="users per seeding and flush batch")
+    args = parser.parse_args()
+
+    columns = ("seed/s", "load s", "lookup/s", "write/s", "flush users/s")
+    print ("{:<8} {:>8} ".format("backend", "users") + " ".join("{:>14}".format(column) for column in columns))
+    for users in [int(count) for count in args.users.split(",")]:
+        for backend_name in args.backends.split(","):
+            result = bench(backend_name, users, args)
+            print ("{:<8} {:>8} ".format(backend_name, users) +
+                   " ".join("{:>14.1f}".format(result[column]) for column in columns))
+
+
+if __name__ == "__main__":
+    main()
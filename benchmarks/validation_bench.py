@@ -0,0 +1,110 @@
+"""
+Offline benchmark for the request validation path in lib.validation_utils.
+Requests are signed with a locally generated echo-api.amazon.com chain, which is
+served from a local HTTP stand-in for S3, so no Alexa traffic is needed.
+
+Runs:
+  cold     - fresh certificate and verifier caches for every request
+  warm     - shared caches, as in a long running server
+  threaded - warm caches shared by --threads concurrent threads
+The same requests are validated repeatedly, so timestamp and replay checks are off.
+Reports p50/p99 latency per stage (valid_certificate, extract_public_key,
+verify_signature) and for the whole of valid_alexa_request, plus throughput.
+
+Usage (from the repository root):
+$ python3 -m benchmarks.validation_bench --requests 500 --threads 16
+"""
+from __future__ import print_function
+import argparse
+import base64
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.validation_utils import (valid_alexa_request, valid_certificate, extract_public_key,
+                                  verify_signature, VerifierCache)
+from benchmarks.fake_alexa import FakeAlexaSigner, make_request_body, CERT_CHAIN_URL
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[int(round(pct / 100.0 * (len(ordered) - 1)))]
+
+
+def report(title, timings, count, elapsed):
+    print("{} ({} requests, {:.0f} req/s)".format(title, count, count / elapsed))
+    for stage, samples in timings.items():
+        if samples:
+            print("  {:<20} p50 {:9.1f} us   p99 {:9.1f} us".format(
+                stage, percentile(samples, 50) * 1e6, percentile(samples, 99) * 1e6))
+
+
+def staged_validation(cases, make_caches):
+    """ Time each validation stage separately, then the whole call """
+    timings = {"valid_certificate": [], "extract_public_key": [], "verify_signature": [],
+               "valid_alexa_request": []}
+    clock = time.perf_counter
+    start = clock()
+    for headers, body in cases:
+        cache, verifiers = make_caches()
+        t0 = clock()
+        signing_cert = valid_certificate(CERT_CHAIN_URL, cache)
+        t1 = clock()
+        extract_public_key(signing_cert)
+        t2 = clock()
+        verifier = verifiers.get(signing_cert)
+        assert verify_signature(body, verifier, base64.b64decode(headers["Signature"]))
+        t3 = clock()
+        timings["valid_certificate"].append(t1 - t0)
+        timings["extract_public_key"].append(t2 - t1)
+        timings["verify_signature"].append(t3 - t2)
+
+        cache, verifiers = make_caches()
+        t4 = clock()
+        assert valid_alexa_request(headers, body, disable_timestamp_validation=True,
+                                   cache=cache, verifiers=verifiers)
+        timings["valid_alexa_request"].append(clock() - t4)
+    return timings, clock() - start
+
+
+def threaded_validation(cases, cache, verifiers, threads):
+    def run(case):
+        headers, body = case
+        t0 = time.perf_counter()
+        assert valid_alexa_request(headers, body, disable_timestamp_validation=True,
+                                   cache=cache, verifiers=verifiers)
+        return time.perf_counter() - t0
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        latencies = list(pool.map(run, cases))
+    return {"valid_alexa_request": latencies}, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=16)
+    args = parser.parse_args()
+
+    signer = FakeAlexaSigner()
+    signer.serve_over_http()
+    try:
+        bodies = [make_request_body() for _ in range(args.requests)]
+        cases = [(signer.headers(body), body) for body in bodies]
+
+        cold_caches = lambda: (signer.certificate_cache(), VerifierCache())
+        timings, elapsed = staged_validation(cases, cold_caches)
+        report("cold cache", timings, len(cases), elapsed)
+
+        shared = (signer.certificate_cache(), VerifierCache())
+        timings, elapsed = staged_validation(cases, lambda: shared)
+        report("warm cache", timings, len(cases), elapsed)
+
+        timings, elapsed = threaded_validation(cases, shared[0], shared[1], args.threads)
+        report("warm cache, {} threads".format(args.threads), timings, len(cases), elapsed)
+    finally:
+        signer.close()
+
+
+if __name__ == "__main__":
+    main()
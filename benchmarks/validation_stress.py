@@ -0,0 +1,68 @@
+"""
+Concurrency stress run for lib.validation_utils.valid_alexa_request.
+Many threads validate a mix of genuine, tampered and badly located requests
+against one shared certificate cache, starting from a cold cache.
+Every result has to match its expected verdict, and nothing may be written to tmp/.
+
+Usage (from the repository root):
+$ python3 -m benchmarks.validation_stress --threads 32 --requests 4000
+"""
+from __future__ import print_function
+import argparse
+import os
+import random
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.validation_utils import valid_alexa_request
+from benchmarks.fake_alexa import FakeAlexaSigner, make_request_body, CERT_CHAIN_URL
+
+
+def build_cases(signer, count):
+    """ (headers, body, expected verdict) triples """
+    cases = []
+    for index in range(count):
+        body = make_request_body()
+        headers = signer.headers(body)
+        kind = index % 3
+        if kind == 1:
+            # Body modified after signing
+            body = body.replace(b"ListHomeTweets", b"PostTweet")
+        elif kind == 2:
+            headers["Signaturecertchainurl"] = CERT_CHAIN_URL.replace("https://", "http://")
+        cases.append((headers, body, kind == 0))
+    random.shuffle(cases)
+    return cases
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=3000)
+    args = parser.parse_args()
+
+    signer = FakeAlexaSigner()
+    cache = signer.certificate_cache()
+    cases = build_cases(signer, args.requests)
+    tmp_before = set(os.listdir("tmp")) if os.path.isdir("tmp") else set()
+
+    def run(case):
+        headers, body, expected = case
+        return valid_alexa_request(headers, body, cache=cache) == expected
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            results = list(pool.map(run, cases))
+    finally:
+        signer.close()
+
+    tmp_after = set(os.listdir("tmp")) if os.path.isdir("tmp") else set()
+    failures = results.count(False)
+    print("{} requests on {} threads: {} wrong verdicts, {} chain downloads, {} new files in tmp/"
+          .format(len(results), args.threads, failures, signer.fetch_count, len(tmp_after - tmp_before)))
+    if failures or tmp_after != tmp_before:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
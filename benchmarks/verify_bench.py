@@ -0,0 +1,53 @@
+"""
+Micro-benchmark for signature verification: the cost of checking one request
+signature when the public key is imported per request, versus when the
+imported key and verifier come from the VerifierCache.
+
+Usage (from the repository root):
+$ python3 -m benchmarks.verify_bench --iterations 2000
+"""
+from __future__ import print_function
+import argparse
+import base64
+import timeit
+
+from Crypto.Hash import SHA
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5 as Verifier
+
+from lib.validation_utils import (valid_certificate, extract_public_key, verify_signature,
+                                  VerifierCache)
+from benchmarks.fake_alexa import FakeAlexaSigner, make_request_body, CERT_CHAIN_URL
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    signer = FakeAlexaSigner()
+    try:
+        signing_cert = valid_certificate(CERT_CHAIN_URL, signer.certificate_cache())
+    finally:
+        signer.close()
+    body = make_request_body()
+    signature = base64.b64decode(signer.sign(body))
+    verifiers = VerifierCache()
+
+    def per_request_import():
+        # What every request used to pay
+        verifier = Verifier.new(RSA.importKey(extract_public_key(signing_cert)))
+        assert verifier.verify(SHA.new(body), signature)
+
+    def cached_verifier():
+        assert verify_signature(body, verifiers.get(signing_cert), signature)
+
+    for label, function in [("import key per request", per_request_import),
+                            ("cached verifier", cached_verifier)]:
+        function() # warm up
+        seconds = timeit.timeit(function, number=args.iterations)
+        print("{:<24} {:8.1f} us/verify".format(label, seconds / args.iterations * 1e6))
+
+
+if __name__ == "__main__":
+    main()
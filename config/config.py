@@ -20,8 +20,11 @@ def load_json_schema(schema_location):
 
 SERVER_CONFIG_PATH = "config/server_config.json"
 
-SERVER_CONFIG = load_json_schema(SERVER_CONFIG_PATH)
-print ("Loaded server config file:")
+# SERVER_CONFIG is loaded from SERVER_CONFIG_PATH when first used (see the bottom of this file)
+
+# Worker processes forked by server.py, which then share the twitter cache through its files in tmp/
+# 1 serves everything from the server.py process itself
+SERVER_WORKERS = 1
 
 
 # --- AMAZON related configurations ---
@@ -32,25 +35,69 @@ ALL_REQUESTS_VALID = True # Declares all incoming requests valid - (switches off
 # The redirect url is used in the account linking process to associate an amazon user account with your OAuth token
 AMAZON_CREDENTIAL_PATH = path_relative_to_file("../keys/amazon.json")
 
-BASE_REDIRECT_URL = load_json_schema(AMAZON_CREDENTIAL_PATH)['redirect_url'] # Different for each vendor 
+# BASE_REDIRECT_URL is loaded from AMAZON_CREDENTIAL_PATH when first used, it is different for each vendor 
 # ^ YOU CAN HARDCODE YOURS HERE, but I suggest making a JSON schema for it just in case you decide to share your code
 
 DEFAULT_INTENT_SCHEMA_LOCATION = "config/intent_schema.json"
 
 NON_INTENT_REQUESTS = ["LaunchRequest", "SessionEndedRequest"]
 
-INTENT_SCHEMA = load_json_schema(DEFAULT_INTENT_SCHEMA_LOCATION)
+# INTENT_SCHEMA is loaded from DEFAULT_INTENT_SCHEMA_LOCATION when first used
+
+
+
+# --- Logging configurations ---
 
+LOG_LEVEL = "INFO"
+
+# Fraction of records kept per logging category (see lib/log_utils.py), unlisted categories are kept in full
+LOG_SAMPLE_RATES = {"request" : 0.01}
+
+# Per category overrides of LOG_LEVEL
+LOG_CATEGORY_LEVELS = {}
 
 
 # --- TWITTER related configurations ---
 
 TWITTER_CONFIG_PATH = os.path.realpath("keys/twitter_keys.json")
-if os.path.exists(TWITTER_CONFIG_PATH):
-    with open(TWITTER_CONFIG_PATH) as config_file:
-        twitter_config = json.load(config_file)
-    TWITTER_CONSUMER_KEY = twitter_config["consumer_key"]
-    TWITTER_CONSUMER_SECRET = twitter_config["consumer_secret"]
-else:
-    raise Exception("Twitter config not found! at "+ twitter_config_path)
-
+# TWITTER_CONSUMER_KEY and TWITTER_CONSUMER_SECRET are loaded from TWITTER_CONFIG_PATH when first used
+
+
+
+# ---- Configurations loaded on first use ----
+# Importing this module reads no files, the names below are loaded the first time they
+# are looked up, e.g. by "from config.config import SERVER_CONFIG"
+
+def _load_server_config():
+    server_config = load_json_schema(SERVER_CONFIG_PATH)
+    print ("Loaded server config file:")
+    return {"SERVER_CONFIG" : server_config}
+
+def _load_redirect_url():
+    return {"BASE_REDIRECT_URL" : load_json_schema(AMAZON_CREDENTIAL_PATH)['redirect_url']}
+
+def _load_intent_schema():
+    return {"INTENT_SCHEMA" : load_json_schema(DEFAULT_INTENT_SCHEMA_LOCATION)}
+
+def _load_twitter_keys():
+    if not os.path.exists(TWITTER_CONFIG_PATH):
+        raise Exception("Twitter config not found! at "+ TWITTER_CONFIG_PATH)
+    twitter_config = load_json_schema(TWITTER_CONFIG_PATH)
+    return {"TWITTER_CONSUMER_KEY" : twitter_config["consumer_key"],
+            "TWITTER_CONSUMER_SECRET" : twitter_config["consumer_secret"]}
+
+_LOADERS = {
+    "SERVER_CONFIG" : _load_server_config,
+    "BASE_REDIRECT_URL" : _load_redirect_url,
+    "INTENT_SCHEMA" : _load_intent_schema,
+    "TWITTER_CONSUMER_KEY" : _load_twitter_keys,
+    "TWITTER_CONSUMER_SECRET" : _load_twitter_keys,
+}
+
+def __getattr__(name):
+    """ Called for names not set yet, loads and keeps them """
+    if name not in _LOADERS:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    values = _LOADERS[name]()
+    globals().update(values)
+    return values[name]
@@ -1,67 +1,239 @@
 from __future__ import print_function
+import asyncio
+import importlib.util
 import json
-from collections import defaultdict 
+import sys
+import threading
+import time
+import weakref
+from collections import namedtuple
+from types import MappingProxyType
 from lib.dialog_utils import Request
-import pkgutil
 import voice_handlers
 import inspect
-from config.config import INTENT_SCHEMA, NON_INTENT_REQUESTS
+from config import config
+from config.config import NON_INTENT_REQUESTS, DEFAULT_INTENT_SCHEMA_LOCATION, load_json_schema
+from lib.log_utils import get_logger, fields
+from lib.metrics_utils import HANDLER_LATENCY, HANDLER_ERRORS
+from lib.twitter_utils import local_cache, close_loop_session
 
+log = get_logger("dialog")
 
-            
-def initialize_handlers():
+
+class DispatchTable(namedtuple("DispatchTable", ["handlers", "default_handler"])):
     """
-    Automatically populate function handlers from the handlers
+    handlers - read only (request_type, intent) -> voice handler map,
+    e.g. ("IntentRequest", "PostTweet") or ("LaunchRequest", None)
+    default_handler - handles requests that have no entry
     """
-    # If no handler is specified, backoff to default handler 
-    init_default_handler = lambda : voice_handlers.default_handler
-    all_handlers_map = defaultdict(init_default_handler)
-    intent_handlers_map = defaultdict(init_default_handler)
-    
-    # Load intent schema to verify that handlers are mapped to valid intents
-    all_intents = {intent["intent"] : { slot["name"] : slot["type"] for slot in intent['slots'] }
-                   for intent in INTENT_SCHEMA['intents'] }
+    __slots__ = ()
+
+    def lookup(self, request_type, intent_name=None):
+        return self.handlers.get((request_type, intent_name), self.default_handler)
 
-    #Loaded functions in the handlers module
-    member_functions = inspect.getmembers(voice_handlers, inspect.isfunction)
 
-    for (name, function) in member_functions:
-        if hasattr(function, 'voice_handler'): #Function has been decorated as a voice_handler
-            if 'request_type' in function.voice_handler:
-                if function.voice_handler['request_type'] in NON_INTENT_REQUESTS: 
-                    # Function is a valid request voice handler
-                    all_handlers_map[function.voice_handler['request_type']] = function                    
+def compile_dispatch_table(handlers_module, intent_schema):
+    """
+    Map the @VoiceHandler functions of a handlers module to their requests,
+    raises ValueError if a handler is mapped to a request type or intent that doesn't exist,
+    or if two handlers are mapped to the same one
+    """
+    all_intents = {intent["intent"] for intent in intent_schema['intents']}
+    handlers = {}
+    errors = []
 
-            elif 'intent' in function.voice_handler:
-                if function.voice_handler['intent'] in all_intents:
-                    # Function is a valid intent voice handler
-                    intent_handlers_map[function.voice_handler['intent']] = function 
+    #Loaded functions in the handlers module
+    for (name, function) in inspect.getmembers(handlers_module, inspect.isfunction):
+        if not hasattr(function, 'voice_handler'): # Not decorated as a voice_handler
+            continue
+        if 'request_type' in function.voice_handler:
+            key = (function.voice_handler['request_type'], None)
+            if key[0] not in NON_INTENT_REQUESTS:
+                errors.append("{} handles unknown request type {}".format(name, key[0]))
+                continue
+        elif 'intent' in function.voice_handler:
+            key = ('IntentRequest', function.voice_handler['intent'])
+            if key[1] not in all_intents:
+                errors.append("{} handles {}, which is not in the intent schema".format(name, key[1]))
+                continue
+        else:
+            continue
+        if key in handlers:
+            errors.append("{} and {} both handle {}".format(handlers[key].__name__, name, key))
+        handlers[key] = function
 
-    all_handlers_map['IntentRequest'] = intent_handlers_map                
-    return all_handlers_map
+    if errors:
+        raise ValueError("Invalid voice handlers: " + "; ".join(errors))
+    unhandled = sorted(all_intents - {intent for _, intent in handlers})
+    if unhandled:
+        log.warning("Intents handled by the default handler", extra=fields(intents=unhandled))
+    return DispatchTable(MappingProxyType(handlers), handlers_module.default_handler)
 
 
 """
-The REGISTERED_HANDLERS global variable contains a python dict 
-which contains mappings from the intent name to the handler
+The DISPATCH_TABLE global variable is a DispatchTable 
+which maps requests to their handlers
 e.g. 
-handler = REGISTERED_HANDLERS["IntentRequest"][INTENT_NAME]
+handler = dispatch_table().lookup("IntentRequest", INTENT_NAME)
 gives you the appropriate handler.
+It is compiled when first needed, and reload_handlers() replaces it as a whole,
+so read it once per request.
 """    
 
-REGISTERED_HANDLERS = initialize_handlers()
+DISPATCH_TABLE = None
 
+_reload_lock = threading.Lock()
 
-def route_intent(request_json):
+def dispatch_table():
+    global DISPATCH_TABLE
+    if DISPATCH_TABLE is None:
+        with _reload_lock:
+            if DISPATCH_TABLE is None:
+                DISPATCH_TABLE = compile_dispatch_table(voice_handlers, config.INTENT_SCHEMA)
+    return DISPATCH_TABLE
+
+
+def preload():
     """
-    This code routes requests to the appropriate handler
+    Compile the dispatch table and load the twitter cache, which would otherwise
+    happen on the first request, and start writing changed users in the background.
+    Servers run this in the background at startup.
     """
-    request = Request(request_json)    
+    start = time.perf_counter()
+    dispatch_table()
+    local_cache.load()
+    local_cache.start_flusher()
+    log.info("Preloaded handlers and cache", extra=fields(seconds=round(time.perf_counter() - start, 3)))
+
+
+def reload_handlers():
+    """
+    Re-import voice_handlers and the intent schema, and swap in a new dispatch table.
+    The new module is imported next to the old one, so requests in flight finish
+    with the old handlers. If it doesn't import or its handlers don't validate,
+    the error is raised and the old handlers stay in place.
+    """
+    global voice_handlers, DISPATCH_TABLE
+    with _reload_lock:
+        intent_schema = load_json_schema(DEFAULT_INTENT_SCHEMA_LOCATION)
+        spec = importlib.util.find_spec(voice_handlers.__name__)
+        handlers_module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(handlers_module)
+        table = compile_dispatch_table(handlers_module, intent_schema)
+        sys.modules[voice_handlers.__name__] = voice_handlers = handlers_module
+        DISPATCH_TABLE = table
+    log.info("Reloaded voice handlers", extra=fields(handlers=len(table.handlers)))
+
+
+def reload_on_signal(signum=None, frame=None):
+    """ Signal handler for reload_handlers, a failed reload is logged """
+    try:
+        reload_handlers()
+    except Exception:
+        log.exception("Reload failed, still serving the previous handlers")
+
+
+def resolve_handler(request):
+    """
+    Find the voice handler for a dialog_utils.Request
+    """
+    table = dispatch_table()
     # hack for twitter app 
     if not request.access_token():
-        return voice_handlers.default_handler(request)
+        return table.default_handler
     # end hack for twitter 
-    voice_handler = REGISTERED_HANDLERS[request.request_type()]
-    if request.intent_name():
-        voice_handler = voice_handler[request.intent_name()]
-    return voice_handler(request)
+    return table.lookup(request.request_type(), request.intent_name())
+
+
+def handler_labels(request, voice_handler):
+    """
+    Metric labels for a handler call, taken from its @VoiceHandler metadata
+    (request_type, intent, handler name)
+    """
+    metadata = getattr(voice_handler, 'voice_handler', {})
+    request_type = metadata.get('request_type',
+                                'IntentRequest' if 'intent' in metadata else request.request_type())
+    return (request_type or '', metadata.get('intent', ''), voice_handler.__name__)
+
+
+def call_in_user_session(voice_handler, request):
+    """ Run a synchronous handler with the user's cached state loaded and locked """
+    with local_cache.user_session(request.access_token()):
+        return voice_handler(request)
+
+
+_thread_loops = threading.local()
+
+def run_in_thread_loop(coroutine):
+    """
+    Run coroutine to completion on this thread's event loop, made on first use.
+    Keeping the loop lets the async twitter requests of the thread's coroutines
+    share one connection pool (see twitter_utils.make_twitter_request_async)
+    """
+    loop = getattr(_thread_loops, "loop", None)
+    if loop is None or loop.is_closed():
+        loop = _thread_loops.loop = asyncio.new_event_loop()
+        weakref.finalize(threading.current_thread(), _close_thread_loop, loop)
+    return loop.run_until_complete(coroutine)
+
+
+def _close_thread_loop(loop):
+    """ The thread that ran loop is gone (or the interpreter exits) """
+    loop.run_until_complete(close_loop_session())
+    loop.close()
+
+
+def route_intent(request):
+    """
+    This code routes requests to the appropriate handler
+    request - a dialog_utils.Request, or the raw request JSON
+    Handlers written as coroutines are run to completion on an event loop of the
+    calling thread, which it keeps for its next ones (see run_in_thread_loop).
+    """
+    if not isinstance(request, Request):
+        request = Request(request)
+    voice_handler = resolve_handler(request)
+    labels = handler_labels(request, voice_handler)
+    start = time.perf_counter()
+    try:
+        if inspect.iscoroutinefunction(voice_handler):
+            with local_cache.user_session(request.access_token()):
+                return run_in_thread_loop(voice_handler(request))
+        return call_in_user_session(voice_handler, request)
+    except Exception:
+        HANDLER_ERRORS.inc(*labels)
+        raise
+    finally:
+        HANDLER_LATENCY.observe(time.perf_counter() - start, *labels)
+
+
+async def route_intent_async(request, executor=None):
+    """
+    asyncio counterpart of route_intent:
+    coroutine handlers are awaited, regular handlers are run in the executor
+    so that their blocking I/O doesn't stall the event loop.
+    Coroutine handlers don't hold a user_session while they await: the user is
+    loaded before and persisted after the handler (with a shared cache, reloaded
+    and written back without holding the user's lock), and stays in memory meanwhile.
+    """
+    if not isinstance(request, Request):
+        request = Request(request)
+    voice_handler = resolve_handler(request)
+    labels = handler_labels(request, voice_handler)
+    start = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    try:
+        if inspect.iscoroutinefunction(voice_handler):
+            # Reads and writes of the cache happen in the executor, not on the event loop
+            with local_cache.pinned(request.access_token()):
+                await loop.run_in_executor(executor, local_cache.refresh_user, request.access_token())
+                try:
+                    return await voice_handler(request)
+                finally:
+                    await loop.run_in_executor(executor, local_cache.flush_user, request.access_token())
+        return await loop.run_in_executor(executor, call_in_user_session, voice_handler, request)
+    except Exception:
+        HANDLER_ERRORS.inc(*labels)
+        raise
+    finally:
+        HANDLER_LATENCY.observe(time.perf_counter() - start, *labels)
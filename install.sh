@@ -6,4 +6,6 @@ sudo pip install requests
 sudo pip install beautifulsoup4
 sudo apt-get install openssl
 sudo pip install pycrypto
+sudo pip install cryptography
 sudo pip install requests_oauthlib
+sudo pip install aiohttp
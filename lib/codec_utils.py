@@ -0,0 +1,210 @@
+"""
+Compact binary format of the cache states, used by lib/storage_utils.py in place
+of jsonpickle.
+
+An encoded state is MAGIC, a format version byte, then one value. A value is a
+type byte followed by its data: ints as zigzag varints, floats as 8 bytes, strings
+as a varint length and UTF-8, and lists, tuples and dicts as a varint count and
+their items. A string seen before in the same state is written as a reference
+to it, so the keys repeated in every tweet are only stored once.
+
+Only plain data is encoded, and the classes registered with register_type, which
+are stored as a plain value they turn themselves into (e.g. a Tweet as the fields
+it reads) under a code. Anything else raises a TypeError: nothing is pickled, and
+decoding never creates anything but plain data and the registered classes.
+
+Decoders read every version up to VERSION, bump it when the format changes.
+"""
+import struct
+
+MAGIC = b"TWC"
+VERSION = 1
+
+NONE, FALSE, TRUE, INT, FLOAT, STR, STR_REF, BYTES, LIST, TUPLE, DICT, EXT = range(12)
+
+_float = struct.Struct(">d")
+
+_ext_by_type = {} # class -> (code, to_plain)
+_ext_by_code = {} # code -> from_plain
+
+
+def register_type(code, cls, to_plain, from_plain):
+    """
+    Encode instances of cls as to_plain(instance) under code, decoded with from_plain(plain).
+    Codes are stored, so a code must keep meaning the same class.
+    """
+    if code in _ext_by_code and _ext_by_type.get(cls, (None,))[0] != code:
+        raise ValueError("Codec type code {} is already registered".format(code))
+    _ext_by_type[cls] = (code, to_plain)
+    _ext_by_code[code] = from_plain
+
+
+def is_encoded(data):
+    return isinstance(data, bytes) and data[:len(MAGIC)] == MAGIC
+
+
+class _Encoder(object):
+    __slots__ = ("out", "strings")
+
+    def __init__(self):
+        self.out = bytearray()
+        self.strings = {} # string -> index of its first occurrence
+
+    def varint(self, number):
+        out = self.out
+        while number > 0x7f:
+            out.append((number & 0x7f) | 0x80)
+            number >>= 7
+        out.append(number)
+
+    def value(self, obj):
+        kind = type(obj)
+        if kind is str:
+            return self.string(obj)
+        if kind is dict:
+            return self.mapping(obj)
+        if kind is int:
+            return self.integer(obj)
+        if obj is None:
+            return self.out.append(NONE)
+        if kind is bool:
+            return self.out.append(TRUE if obj else FALSE)
+        if kind is float:
+            self.out.append(FLOAT)
+            return self.out.extend(_float.pack(obj))
+        if kind is list or kind is tuple:
+            return self.sequence(obj, LIST if kind is list else TUPLE)
+        if kind in _ext_by_type:
+            code, to_plain = _ext_by_type[kind]
+            self.out.append(EXT)
+            self.varint(code)
+            return self.value(to_plain(obj))
+        # Subclasses of plain types, e.g. a defaultdict, lose their class
+        if isinstance(obj, dict):
+            return self.mapping(obj)
+        if isinstance(obj, (list, tuple)):
+            return self.sequence(obj, TUPLE if isinstance(obj, tuple) else LIST)
+        if isinstance(obj, str):
+            return self.string(str(obj))
+        if isinstance(obj, int):
+            return self.integer(int(obj))
+        if isinstance(obj, (bytes, bytearray)):
+            self.out.append(BYTES)
+            self.varint(len(obj))
+            return self.out.extend(obj)
+        raise TypeError("Cannot encode {!r} in the cache, register its type".format(kind))
+
+    def integer(self, number):
+        self.out.append(INT)
+        self.varint(number << 1 if number >= 0 else ((-number) << 1) - 1)
+
+    def string(self, text):
+        index = self.strings.get(text)
+        if index is not None:
+            self.out.append(STR_REF)
+            return self.varint(index)
+        self.strings[text] = len(self.strings)
+        data = text.encode("utf-8")
+        self.out.append(STR)
+        self.varint(len(data))
+        self.out.extend(data)
+
+    def sequence(self, items, kind):
+        self.out.append(kind)
+        self.varint(len(items))
+        for item in items:
+            self.value(item)
+
+    def mapping(self, items):
+        self.out.append(DICT)
+        self.varint(len(items))
+        for key, item in items.items():
+            self.value(key)
+            self.value(item)
+
+
+class _Decoder(object):
+    __slots__ = ("data", "pos", "strings")
+
+    def __init__(self, data, pos):
+        self.data = data
+        self.pos = pos
+        self.strings = []
+
+    def varint(self):
+        data = self.data
+        number, shift = 0, 0
+        while True:
+            byte = data[self.pos]
+            self.pos += 1
+            number |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return number
+            shift += 7
+
+    def value(self):
+        kind = self.data[self.pos]
+        self.pos += 1
+        if kind == STR:
+            length = self.varint()
+            text = self.data[self.pos:self.pos + length].decode("utf-8")
+            self.pos += length
+            self.strings.append(text)
+            return text
+        if kind == STR_REF:
+            return self.strings[self.varint()]
+        if kind == DICT:
+            items = {}
+            for _ in range(self.varint()):
+                key = self.value()
+                items[key] = self.value()
+            return items
+        if kind == INT:
+            number = self.varint()
+            return number >> 1 if not number & 1 else -((number + 1) >> 1)
+        if kind == NONE:
+            return None
+        if kind == TRUE:
+            return True
+        if kind == FALSE:
+            return False
+        if kind == FLOAT:
+            number, = _float.unpack_from(self.data, self.pos)
+            self.pos += _float.size
+            return number
+        if kind == LIST or kind == TUPLE:
+            items = [self.value() for _ in range(self.varint())]
+            return items if kind == LIST else tuple(items)
+        if kind == BYTES:
+            length = self.varint()
+            self.pos += length
+            return self.data[self.pos - length:self.pos]
+        if kind == EXT:
+            code = self.varint()
+            if code not in _ext_by_code:
+                raise ValueError("Unknown codec type code {}".format(code))
+            return _ext_by_code[code](self.value())
+        raise ValueError("Unknown codec value type {} at byte {}".format(kind, self.pos - 1))
+
+
+def encode(obj):
+    """ obj, plain data and registered types only, as bytes """
+    encoder = _Encoder()
+    encoder.out.extend(MAGIC)
+    encoder.out.append(VERSION)
+    encoder.value(obj)
+    return bytes(encoder.out)
+
+
+def decode(data):
+    """ The value encoded in data, raises ValueError if it isn't in this format """
+    if not is_encoded(data):
+        raise ValueError("Not an encoded cache state")
+    version = data[len(MAGIC)]
+    if version > VERSION:
+        raise ValueError("Cache state format version {} is newer than {}".format(version, VERSION))
+    decoder = _Decoder(data, len(MAGIC) + 1)
+    try:
+        return decoder.value()
+    except IndexError:
+        raise ValueError("Truncated cache state")
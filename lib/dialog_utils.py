@@ -1,5 +1,6 @@
 import os
-from collections import OrderedDict, defaultdict
+import time
+from collections import OrderedDict, defaultdict, namedtuple
 import json
 
 RAW_RESPONSE = """
@@ -25,58 +26,153 @@ class VoiceHandler(object):
         function.voice_handler = self.kwargs
         return function
 
-    
+
+# Seconds a pending action can be confirmed for, unless it is created with another ttl
+PENDING_ACTION_TTL = 600
+
+
+class PendingAction(namedtuple("PendingAction", ["type", "params", "created_at", "ttl", "description"])):
+    """
+    Something the user asked for that waits for a yes, e.g. posting a tweet.
+    type - name of the executor registered for it with @PendingActionExecutor
+    params - keyword arguments of the executor, plain data only
+    created_at - time.time() when it was asked for
+    ttl - seconds it can be confirmed for, None for no limit
+    description - read out to remind the user of it
+    It is kept in the user's state as a dict (to_dict) so that it can be stored
+    and confirmed by any worker, and read back with from_dict.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def create(cls, action_type, params, description=None, ttl=PENDING_ACTION_TTL):
+        return cls(action_type, dict(params), time.time(), ttl, description)
+
+    def expired(self, now=None):
+        return self.ttl is not None and (time.time() if now is None else now) > self.created_at + self.ttl
+
+    def to_dict(self):
+        return {"type" : self.type, "params" : self.params, "created_at" : self.created_at,
+                "ttl" : self.ttl, "description" : self.description}
+
+    @classmethod
+    def from_dict(cls, data):
+        """ None if data isn't a pending action, e.g. one saved by an older version """
+        try:
+            return cls(data["type"], dict(data.get("params") or {}), float(data["created_at"]),
+                       data.get("ttl"), data.get("description"))
+        except (KeyError, TypeError, ValueError, AttributeError):
+            return None
+
+
+class PendingActionExecutor(object):
+    """
+    Decorator registering the function that carries out a type of pending action,
+    it is called with the user id and the action's params, and returns the message to read out
+    e.g.
+    @PendingActionExecutor("post_tweet")
+    def post_tweet_action(user_id, message):
+    """
+    registry = {} # action type -> executor
+
+    def __init__(self, action_type):
+        self.action_type = action_type
+
+    def __call__(self, function):
+        function.pending_action = self.action_type
+        # Registered again when the handlers are reloaded, the newest function wins
+        self.registry[self.action_type] = function
+        return function
+
+    @classmethod
+    def execute(cls, user_id, action):
+        """ Carry out a PendingAction, returns None if nothing is registered for its type """
+        executor = cls.registry.get(action.type)
+        if executor is None:
+            return None
+        return executor(user_id, **action.params)
+
+
 class Request(object):
     """
     Simple wrapper around the JSON request
-    received by the module
-    """    
+    received by the module.
+    A read only view: the fields of the "request" and the "session" parts are
+    pulled out of the nested dicts the first time one of them is asked for,
+    and kept, so the accessors can be called as often as needed.
+    """
+    __slots__ = ("request", "_request_fields", "_session_fields", "_slot_map")
+
     def __init__(self, request_dict):
         self.request = request_dict
+        self._request_fields = None # (type, requestId, timestamp, intent name, slots)
+        self._session_fields = None # (userId, accessToken, sessionId)
+        self._slot_map = None
+
+    @classmethod
+    def from_body(cls, raw_body):
+        """ Build a Request straight from the raw bytes of the HTTP body """
+        return cls(json.loads(raw_body.decode("utf-8")))
+
+    def _request_part(self):
+        if self._request_fields is None:
+            request = self.request.get("request") or {}
+            intent = request.get("intent") or {}
+            self._request_fields = (request.get("type"), request.get("requestId"), request.get("timestamp"),
+                                    intent.get("name"), intent.get("slots") or {})
+        return self._request_fields
+
+    def _session_part(self):
+        if self._session_fields is None:
+            session = self.request.get("session") or {}
+            user = session.get("user") or {}
+            self._session_fields = (user.get("userId"), user.get("accessToken"), session.get("sessionId"))
+        return self._session_fields
         
     def request_type(self):
-        return self.request["request"]["type"]
+        return self._request_part()[0]
+
+    def request_id(self):
+        return self._request_part()[1]
+
+    def timestamp(self):
+        return self._request_part()[2]
 
     def intent_name(self):
-        if not "intent" in self.request["request"]:
-            return None
-        return self.request["request"]["intent"]["name"]
+        return self._request_part()[3]
 
     def user_id(self):
-        return self.request["session"]["user"]["userId"]
+        return self._session_part()[0]
 
     def access_token(self):
-        try:
-            return self.request['session']['user']['accessToken']
-        except:
-             return None
-
+        return self._session_part()[1]
 
     def session_id(self):
-        return self.request["session"]["sessionId"]
+        return self._session_part()[2]
 
     def get_slot_value(self, slot_name):
-        try:
-            return self.request["request"]["intent"]["slots"][slot_name]["value"]
-        except:
-            """Value not found"""
-            return None
+        return self.get_slot_map().get(slot_name)
 
     def get_slot_names(self):
-        try:
-            return self.request['request']['intent']['slots'].keys()
-        except:            
-            return []
+        return list(self.get_slot_map())
 
     def get_slot_map(self):
-        return {slot_name : self.get_slot_value(slot_name) for slot_name in self.get_slot_names()}
+        """ slot name -> value (None for slots without one), shared between calls so don't modify it """
+        if self._slot_map is None:
+            self._slot_map = {slot_name : (slot or {}).get("value")
+                              for slot_name, slot in self._request_part()[4].items()}
+        return self._slot_map
 
     
 class ResponseBuilder(object):
     """
     Simple class to help users to build responses
+    Every call builds a fresh response, so concurrent requests never share one.
     """
+    # Parsed once; only ever read from, never handed out
     base_response = eval(RAW_RESPONSE)
+    _version = base_response['version']
+    _default_speech = base_response['response']['outputSpeech']
        
     @classmethod
     def create_response(self, message=None, end_session=False, card_obj=None, 
@@ -85,27 +181,26 @@ class ResponseBuilder(object):
         message - text message to be spoken out by the Echo
         end_session - flag to determine whether this interaction should end the session
         card_obj = JSON card object to substitute the 'card' field in the raw_response
+        reprompt_message - spoken if the user doesn't reply, sent as response.reprompt
         """
-        response = self.base_response
-        if message:
-            response['response'] = self.create_speech(message, is_ssml)
-        response['response']['shouldEndSession'] = end_session
+        body = {"outputSpeech" : (self._output_speech(message, is_ssml) if message
+                                  else dict(self._default_speech)),
+                "shouldEndSession" : end_session}
         if card_obj:
-            response['response']['card'] = card_obj
+            body['card'] = card_obj
         if reprompt_message:
-            response['reprompt'] = self.create_speech(reprompt_message, is_ssml)
-        return response
+            body['reprompt'] = self.create_speech(reprompt_message, is_ssml)
+        return {"version" : self._version, "response" : body}
     
     @classmethod
     def create_speech(cls, message=None, is_ssml=False):
-        data = {}
+        return {"outputSpeech" : cls._output_speech(message, is_ssml)}
+
+    @staticmethod
+    def _output_speech(message, is_ssml):
         if is_ssml:
-            data['type'] = "SSML"
-            data['ssml'] = message
-        else:
-            data['type'] = "PlainText"
-            data['text'] = message
-        return {"outputSpeech" : data }
+            return {"type" : "SSML", "ssml" : message}
+        return {"type" : "PlainText", "text" : message}
 
     @classmethod
     def create_card(self, title=None, subtitle=None, content=None, card_type="Simple"):
@@ -128,6 +223,15 @@ class ResponseBuilder(object):
 
 
 
+# Compact encoder for responses: they are freshly built trees, so there is
+# nothing circular to check for, and no whitespace is needed on the wire
+_response_encoder = json.JSONEncoder(separators=(',', ':'), check_circular=False)
+
+def encode_response(response):
+    """ Serialize a response built by the ResponseBuilder to UTF-8 JSON """
+    return _response_encoder.encode(response).encode('utf-8')
+
+
 def chunk_list(input_list, chunksize):
     """ Helped function to chunk a list 
     >>> lst = [1,2,3,4,5,6]
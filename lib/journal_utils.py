@@ -0,0 +1,137 @@
+"""
+Append-only journal of changes, used by lib.twitter_utils.LocalCache to make
+user state durable between snapshots.
+
+Records are JSON objects, appended one per line with a checksum to the current
+segment file (<path>.<number>). append() returns once the record is on disk,
+it can also be split into queue(), which fixes the record's place in the
+journal, and wait(). Appends from concurrent threads are grouped: one of them
+writes everything queued so far and calls fsync once for all of them (group
+commit), while the others wait.
+
+Compaction is up to the caller: rotate() starts a new segment and returns the
+older ones, which can be removed once everything they hold has been written to
+a snapshot. replay() reads the records of every segment in order, and stops at
+a torn or corrupt record at the end of a segment (a crash during a write).
+"""
+import glob
+import json
+import os
+import threading
+import zlib
+from lib.log_utils import get_logger, fields
+
+log = get_logger("journal")
+
+
+class Journal(object):
+    segment_template = "{0}.{1:08d}"
+
+    def __init__(self, path):
+        self.path = path
+        self._cond = threading.Condition()
+        self._pending = []
+        self._queued = 0 # sequence number of the last record queued
+        self._durable = 0 # sequence number of the last record written and synced
+        self._writing = False
+        self._file = None
+        self._segment = None
+        self.size = 0 # bytes in the current segment
+
+    def segments(self):
+        """ Segment files on disk, oldest first """
+        segments = glob.glob(glob.escape(self.path) + ".*")
+        return sorted(segment for segment in segments if segment.rsplit(".", 1)[1].isdigit())
+
+    def _open(self):
+        segments = self.segments()
+        number = int(segments[-1].rsplit(".", 1)[1]) + 1 if segments else 0
+        self._segment = self.segment_template.format(self.path, number)
+        self._file = open(self._segment, "ab")
+        self.size = 0
+
+    @staticmethod
+    def encode(record):
+        line = json.dumps(record, separators=(',', ':')).encode("utf-8")
+        return "{:08x} ".format(zlib.crc32(line)).encode("ascii") + line + b"\n"
+
+    def append(self, record):
+        """ Append a record, returns once it is on disk. A failed write is logged and not raised """
+        self.wait(self.queue(record))
+
+    def queue(self, record):
+        """ Queue a record after every record queued so far, returns its sequence number for wait() """
+        line = self.encode(record)
+        with self._cond:
+            self._pending.append(line)
+            self._queued += 1
+            return self._queued
+
+    def wait(self, sequence):
+        """ Returns once the record with this sequence number, and all before it, are on disk """
+        with self._cond:
+            while self._durable < sequence:
+                if self._writing:
+                    self._cond.wait()
+                    continue
+                # Lead a group commit of everything queued so far
+                self._writing = True
+                batch, self._pending = self._pending, []
+                last = self._queued
+                self._cond.release()
+                try:
+                    self._write(batch)
+                finally:
+                    self._cond.acquire()
+                    self._writing = False
+                    self._durable = last
+                    self._cond.notify_all()
+
+    def _write(self, batch):
+        try:
+            if self._file is None:
+                self._open()
+            data = b"".join(batch)
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.size += len(data)
+        except Exception:
+            log.exception("Could not write to the journal", extra=fields(records=len(batch)))
+
+    def rotate(self):
+        """ Start a new segment on the next append, returns the segments written so far """
+        with self._cond:
+            while self._writing:
+                self._cond.wait()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self.size = 0
+            return self.segments()
+
+    def replay(self):
+        """ Every record on disk, oldest first """
+        for segment in self.segments():
+            with open(segment, "rb") as segment_file:
+                for number, line in enumerate(segment_file):
+                    checksum, _, payload = line.rstrip(b"\n").partition(b" ")
+                    try:
+                        if int(checksum, 16) != zlib.crc32(payload):
+                            raise ValueError("checksum mismatch")
+                        record = json.loads(payload.decode("utf-8"))
+                    except ValueError:
+                        log.warning("Journal ends with a torn record", extra=fields(segment=segment, line=number))
+                        break
+                    yield record
+
+    @staticmethod
+    def remove(segments):
+        for segment in segments:
+            try:
+                os.remove(segment)
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        self.rotate()
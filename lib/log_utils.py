@@ -0,0 +1,101 @@
+"""
+Structured logging for the skill server.
+
+Every logger lives under the 'skill' namespace and its name below that is its
+category, e.g. get_logger("request") -> 'skill.request'. Records are put on a
+queue and a background thread formats them as JSON lines and writes them out,
+so request threads never pay for formatting or stdout.
+Categories can be level gated and sampled (keep 1 in N records) with configure().
+"""
+from __future__ import print_function
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+
+ROOT_LOGGER = "skill"
+
+
+def get_logger(category):
+    return logging.getLogger("{}.{}".format(ROOT_LOGGER, category))
+
+
+def fields(**kwargs):
+    """
+    Structured fields for a log record, serialized by the background thread
+    e.g. log.info("request", extra=fields(body=request_json))
+    """
+    return {"fields": kwargs}
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps a fraction of the records of each category,
+    sample_rates - category -> fraction kept, categories not listed are kept in full
+    """
+    def __init__(self, sample_rates=None):
+        super(SamplingFilter, self).__init__()
+        self.sample_rates = sample_rates or {}
+
+    def filter(self, record):
+        rate = self.sample_rates.get(record.name.partition(".")[-1], 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per line: time, level, category, message and any fields """
+    def format(self, record):
+        entry = {"ts" : round(record.created, 3),
+                 "level" : record.levelname,
+                 "category" : record.name.partition(".")[-1],
+                 "msg" : record.getMessage()}
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+_listener = None
+
+def configure(level="INFO", sample_rates=None, category_levels=None, stream=None):
+    """
+    Route all 'skill' loggers through a queue to a background writer.
+    level - default level for every category
+    sample_rates - category -> fraction of records kept
+    category_levels - category -> level, overriding the default
+    stream - where JSON lines are written, defaults to stdout
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+
+    root = logging.getLogger(ROOT_LOGGER)
+    root.setLevel(level)
+    root.propagate = False
+    for category, category_level in (category_levels or {}).items():
+        get_logger(category).setLevel(category_level)
+
+    log_queue = queue.Queue(-1)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(sample_rates))
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+
+    writer = logging.StreamHandler(stream or sys.stdout)
+    writer.setFormatter(JsonFormatter())
+    _listener = logging.handlers.QueueListener(log_queue, writer)
+    _listener.start()
+
+
+def shutdown():
+    """ Flush queued records and stop the background writer """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+atexit.register(shutdown)
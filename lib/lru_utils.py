@@ -0,0 +1,442 @@
+"""
+Bounded write-back cache of user states, used by lib.twitter_utils.LocalCache.
+
+Users are loaded from the backing store on first access and kept in least
+recently used order. When there are more than max_users, or their estimated
+size is over max_bytes, the least recently used are evicted, and written back
+first if they were marked dirty. Users that are pinned (being served) are
+never evicted.
+
+Backing store I/O happens outside the cache's lock. A user that is being
+written back is still found by lookups until the write is done, so a lookup
+never reads an older state from the store, and is not written again until
+then, so writes of a user land in order. With write behind on, evicted users
+aren't written by the thread that evicts them, a request thread, but left for
+a background thread to take (take_evicted or take_dirty) and write.
+
+SegmentedLRUCache splits the users into segments, each an LRUCache with its
+own lock, so that threads looking up different users rarely meet on a lock.
+Its limits hold for all the segments together, however unevenly the users
+hash: it evicts from the segment whose least recently used user was used
+longest ago.
+UserLocks hands out a lock per user, for the users' states themselves.
+"""
+import sys
+import threading
+import time
+from itertools import chain
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from lib.log_utils import get_logger, fields
+from lib.metrics_utils import CACHE_LOOKUPS, CACHE_EVICTIONS
+
+log = get_logger("cache")
+
+
+def deep_size(obj):
+    """ Approximate bytes held by obj and everything it refers to """
+    seen = set()
+    stack = [obj]
+    size = 0
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+        elif hasattr(item, '__dict__'):
+            stack.append(item.__dict__)
+    return size
+
+
+class LRUCache(object):
+    """
+    load(key) - the stored value of key, None if there is none
+    write_back(values) - store a key -> value dict
+    forget(key) - called when key is evicted
+    max_users - most values kept, max_bytes - most estimated bytes kept, 0 for no limit
+    Missing keys read as an empty dict, which is not stored until it's set or marked dirty.
+    write_behind - leave evicted dirty values to take_evicted instead of calling write_back
+    shared_limits - the SegmentedLRUCache this is a segment of, which evicts in place of
+    this cache's own limits
+    """
+    write_behind = False
+
+    def __init__(self, load, write_back, forget=None, max_users=0, max_bytes=0, shared_limits=None):
+        self.load = load
+        self.write_back = write_back
+        self.forget = forget
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.shared_limits = shared_limits
+        self._entries = OrderedDict()
+        self._used = {} # key -> time.monotonic() of its last use
+        self._sizes = {}
+        self._total_bytes = 0
+        self._dirty = set()
+        self._pins = defaultdict(int)
+        self._unsaved = {} # key -> value being written back, still served to lookups
+        self._evicted = {} # key -> evicted value left to write behind, also unsaved
+        self._lock = threading.RLock()
+
+    def _lookup(self, key):
+        """ Resident value of key, or None. Takes the lock """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self._used[key] = time.monotonic()
+                return value
+            value = self._unsaved.get(key)
+            if value is not None:
+                self._admit(key, value)
+            return value
+
+    def get(self, key, default=None):
+        """ The value of key, loaded if it isn't resident """
+        value = self._lookup(key)
+        if value is not None:
+            CACHE_LOOKUPS.inc("hit")
+            return value
+        CACHE_LOOKUPS.inc("miss")
+        value = self.load(key)
+        if value is None:
+            return default
+        with self._lock:
+            # Another thread may have loaded or set it meanwhile
+            if key in self._entries:
+                return self._entries[key]
+            self._admit(key, value)
+        self._evict()
+        return value
+
+    def peek(self, key):
+        """ The value of key if it is resident, without loading or reordering """
+        with self._lock:
+            value = self._entries.get(key)
+            return self._unsaved.get(key) if value is None else value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            with self._lock:
+                value = self._entries.get(key)
+                if value is None:
+                    value = {}
+                    self._admit(key, value)
+            self._evict()
+        return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._admit(key, value)
+        self._evict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._entries))
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        with self._lock:
+            return list(self._entries.items())
+
+    def _admit(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        self._used[key] = time.monotonic()
+        self._resize(key, value)
+
+    def _resize(self, key, value):
+        size = deep_size(value)
+        self._total_bytes += size - self._sizes.get(key, 0)
+        self._sizes[key] = size
+
+    def mark_dirty(self, key):
+        with self._lock:
+            self._dirty.add(key)
+
+    def take_dirty(self):
+        """
+        key -> value of the dirty values, which stop being dirty.
+        Call written() once they are stored or failed to.
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            values = {}
+            for key in dirty:
+                if key in self._unsaved:
+                    # Still being written, write it with the next flush
+                    self._dirty.add(key)
+                    continue
+                value = self.peek(key)
+                if value:
+                    values[key] = value
+                    self._unsaved[key] = value
+            values.update(self._evicted)
+            self._evicted = {}
+            return values
+
+    def take_evicted(self):
+        """ key -> value of the dirty values evicted with write_behind on, call written() once they are stored """
+        with self._lock:
+            evicted, self._evicted = self._evicted, {}
+            return evicted
+
+    def written(self, values, stored=True):
+        """
+        values taken with take_dirty were stored: update their sizes and evict if needed,
+        or weren't: mark them dirty again
+        """
+        with self._lock:
+            for key, value in values.items():
+                if self._unsaved.get(key) is value:
+                    del self._unsaved[key]
+                    if not stored:
+                        # Written back by the next flush, evicted values are resident again
+                        if key not in self._entries:
+                            self._admit(key, value)
+                        self._dirty.add(key)
+                if stored and self._entries.get(key) is value:
+                    self._resize(key, value)
+        self._evict()
+
+    @contextmanager
+    def pinned(self, key):
+        """ key is not evicted in the with block """
+        with self._lock:
+            self._pins[key] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pins[key] -= 1
+                if not self._pins[key]:
+                    del self._pins[key]
+            self._evict()
+
+    def _over_limit(self, pinned=()):
+        return ((self.max_users and len(self._entries) + len(pinned) > self.max_users) or
+                (self.max_bytes and self._total_bytes > self.max_bytes))
+
+    def _evict(self):
+        if self.shared_limits is not None:
+            return self.shared_limits.evict()
+        self._write_victims(self._take_victims(self._over_limit))
+
+    def oldest_use(self):
+        """ Last use of the least recently used value, None if there are none """
+        with self._lock:
+            for key in self._entries:
+                return self._used.get(key)
+            return None
+
+    def evict_oldest(self):
+        """ Evict the least recently used value that isn't pinned, returns False if there is none """
+        with self._lock:
+            resident = len(self._entries)
+            victims = self._take_victims(lambda pinned: len(self._entries) + len(pinned) == resident)
+            evicted = len(self._entries) < resident
+        self._write_victims(victims)
+        return evicted
+
+    def _take_victims(self, over_limit):
+        """
+        Evict the least recently used values while over_limit(values skipped as pinned),
+        returns the dirty ones to write back
+        """
+        victims = []
+        with self._lock:
+            pinned = []
+            while self._entries and over_limit(pinned):
+                key, value = self._entries.popitem(last=False)
+                if key in self._pins or key in self._unsaved:
+                    pinned.append((key, value))
+                    continue
+                self._total_bytes -= self._sizes.pop(key, 0)
+                self._used.pop(key, None)
+                if key in self._dirty:
+                    self._dirty.discard(key)
+                    self._unsaved[key] = value
+                    victims.append((key, value))
+                if self.forget:
+                    self.forget(key)
+                CACHE_EVICTIONS.inc()
+            # Pinned values and values being written stay, as the least recently used
+            for key, value in reversed(pinned):
+                self._entries[key] = value
+                self._entries.move_to_end(key, last=False)
+            if self.write_behind:
+                self._evicted.update(victims)
+                return []
+        return victims
+
+    def _write_victims(self, victims):
+        if not victims:
+            return
+        values = dict(victims)
+        try:
+            self.write_back(values)
+        except Exception:
+            log.exception("Could not write back evicted users", extra=fields(users=len(values)))
+            stored = False
+        else:
+            stored = True
+        with self._lock:
+            for key, value in values.items():
+                if self._unsaved.get(key) is value:
+                    del self._unsaved[key]
+                    if not stored:
+                        # Keep it, to write with the next flush
+                        self._admit(key, value)
+                        self._dirty.add(key)
+
+    def stats(self):
+        """ (resident values, their estimated bytes) """
+        with self._lock:
+            return len(self._entries), self._total_bytes
+
+
+class SegmentedLRUCache(object):
+    """
+    LRUCache split into segments by key, with max_users and max_bytes applying to all
+    the segments together. Takes the same arguments as LRUCache, and has the same methods.
+    """
+    def __init__(self, load, write_back, forget=None, max_users=0, max_bytes=0, segments=16):
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self._evict_lock = threading.Lock()
+        self._segments = [LRUCache(load, write_back, forget, shared_limits=self) for _ in range(segments)]
+
+    def _over_limit(self):
+        users, size = self.stats()
+        return (self.max_users and users > self.max_users) or (self.max_bytes and size > self.max_bytes)
+
+    def evict(self):
+        """
+        Evict the least recently used value of the segment whose one was used longest ago,
+        until the segments are within the limits
+        """
+        if not (self.max_users or self.max_bytes):
+            return
+        with self._evict_lock:
+            while self._over_limit():
+                uses = [(segment.oldest_use(), index) for index, segment in enumerate(self._segments)]
+                for _, index in sorted(use for use in uses if use[0] is not None):
+                    if self._segments[index].evict_oldest():
+                        break
+                else:
+                    # Everything left is pinned or being written
+                    return
+
+    def _segment(self, key):
+        return self._segments[hash(key) % len(self._segments)]
+
+    def get(self, key, default=None):
+        return self._segment(key).get(key, default)
+
+    def peek(self, key):
+        return self._segment(key).peek(key)
+
+    def __contains__(self, key):
+        return key in self._segment(key)
+
+    def __getitem__(self, key):
+        return self._segment(key)[key]
+
+    def __setitem__(self, key, value):
+        self._segment(key)[key] = value
+
+    def __len__(self):
+        return sum(len(segment) for segment in self._segments)
+
+    def __iter__(self):
+        return chain.from_iterable(iter(segment) for segment in self._segments)
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return list(chain.from_iterable(segment.items() for segment in self._segments))
+
+    def mark_dirty(self, key):
+        self._segment(key).mark_dirty(key)
+
+    def take_dirty(self):
+        values = {}
+        for segment in self._segments:
+            values.update(segment.take_dirty())
+        return values
+
+    def take_evicted(self):
+        values = {}
+        for segment in self._segments:
+            values.update(segment.take_evicted())
+        return values
+
+    def set_write_behind(self, write_behind):
+        for segment in self._segments:
+            segment.write_behind = write_behind
+
+    def written(self, values, stored=True):
+        by_segment = defaultdict(dict)
+        for key, value in values.items():
+            by_segment[hash(key) % len(self._segments)][key] = value
+        for index, segment_values in by_segment.items():
+            self._segments[index].written(segment_values, stored)
+
+    def pinned(self, key):
+        return self._segment(key).pinned(key)
+
+    def stats(self):
+        users, size = 0, 0
+        for segment in self._segments:
+            segment_users, segment_size = segment.stats()
+            users += segment_users
+            size += segment_size
+        return users, size
+
+
+class UserLocks(object):
+    """
+    A reentrant lock per key, made when it's first asked for and dropped once
+    nobody holds or waits for it. The table of locks is split into stripes,
+    and a stripe's own lock is only held to find a key's lock in it.
+    """
+    def __init__(self, stripes=64):
+        self._stripes = [(threading.Lock(), {}) for _ in range(stripes)]
+
+    @contextmanager
+    def locked(self, key, blocking=True):
+        """ Hold key's lock in the with block, which gets whether it was taken (always, if blocking) """
+        stripe_lock, locks = self._stripes[hash(key) % len(self._stripes)]
+        with stripe_lock:
+            entry = locks.get(key)
+            if entry is None:
+                entry = locks[key] = [threading.RLock(), 0]
+            entry[1] += 1
+        try:
+            acquired = entry[0].acquire(blocking)
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    entry[0].release()
+        finally:
+            with stripe_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del locks[key]
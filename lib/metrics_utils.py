@@ -0,0 +1,201 @@
+"""
+Low overhead metrics for the skill server, exposed in the Prometheus text format.
+
+Every thread records into its own shard of each metric, so recording a value
+never takes a lock (a lock is only taken the first time a thread records into
+a metric). Shards are summed up when the metrics are rendered.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric(object):
+    """ Base class: per-thread shards of label values -> list of numbers """
+    metric_type = None
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def _cells(self):
+        """ This thread's shard """
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def _merged(self):
+        """ label values -> element wise sum of the cells of every shard """
+        with self._lock:
+            shards = list(self._shards)
+        merged = {}
+        for shard in shards:
+            for label_values, cell in list(shard.items()):
+                total = merged.setdefault(label_values, [0] * len(cell))
+                for index, value in enumerate(cell):
+                    total[index] += value
+        return merged
+
+    def _labels(self, label_values, extra=()):
+        pairs = list(zip(self.label_names, label_values)) + list(extra)
+        if not pairs:
+            return ""
+        escape = lambda value: str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        return "{" + ",".join('{}="{}"'.format(name, escape(value)) for name, value in pairs) + "}"
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help_text),
+                 "# TYPE {} {}".format(self.name, self.metric_type)]
+        for label_values, cell in sorted(self._merged().items()):
+            lines.extend(self._render_cell(label_values, cell))
+        return lines
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def inc(self, *label_values, amount=1):
+        shard = self._cells()
+        cell = shard.get(label_values)
+        if cell is None:
+            cell = shard[label_values] = [0]
+        cell[0] += amount
+
+    def _render_cell(self, label_values, cell):
+        return ["{}{} {}".format(self.name, self._labels(label_values), cell[0])]
+
+
+class Gauge(Metric):
+    """
+    The value is read when rendered, from a function returning a number,
+    or a label values -> number dict
+    """
+    metric_type = "gauge"
+
+    def __init__(self, name, help_text, label_names=(), function=None):
+        super(Gauge, self).__init__(name, help_text, label_names)
+        self.function = function
+
+    def set_function(self, function):
+        self.function = function
+
+    def _merged(self):
+        if self.function is None:
+            return {}
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {() : values}
+        return {label_values : [value] for label_values, value in values.items()}
+
+    def _render_cell(self, label_values, cell):
+        return ["{}{} {}".format(self.name, self._labels(label_values), cell[0])]
+
+
+class Histogram(Metric):
+    """ Cells hold one count per bucket, then the total count and the sum """
+    metric_type = "histogram"
+
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help_text, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        shard = self._cells()
+        cell = shard.get(label_values)
+        if cell is None:
+            cell = shard[label_values] = [0] * (len(self.buckets) + 2)
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            cell[index] += 1
+        cell[-2] += 1
+        cell[-1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        """ Observe the wall time spent in the with block """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def _render_cell(self, label_values, cell):
+        lines = []
+        cumulative = 0
+        for upper_bound, count in zip(self.buckets, cell):
+            cumulative += count
+            lines.append("{}_bucket{} {}".format(self.name, self._labels(label_values, [("le", repr(upper_bound))]),
+                                                 cumulative))
+        lines.append("{}_bucket{} {}".format(self.name, self._labels(label_values, [("le", "+Inf")]), cell[-2]))
+        lines.append("{}_sum{} {}".format(self.name, self._labels(label_values), cell[-1]))
+        lines.append("{}_count{} {}".format(self.name, self._labels(label_values), cell[-2]))
+        return lines
+
+
+_registry = []
+_registry_lock = threading.Lock()
+
+def register(metric):
+    with _registry_lock:
+        _registry.append(metric)
+    return metric
+
+
+def counter(name, help_text, label_names=()):
+    return register(Counter(name, help_text, label_names))
+
+
+def gauge(name, help_text, label_names=(), function=None):
+    return register(Gauge(name, help_text, label_names, function))
+
+
+def histogram(name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+    return register(Histogram(name, help_text, label_names, buckets))
+
+
+def render():
+    """ All registered metrics in the Prometheus text exposition format """
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# --- Metrics recorded by the skill server ---
+
+HANDLER_LATENCY = histogram("skill_handler_seconds", "Time spent in voice handlers",
+                            ("request_type", "intent", "handler"))
+HANDLER_ERRORS = counter("skill_handler_errors_total", "Voice handler calls that raised",
+                         ("request_type", "intent", "handler"))
+TWITTER_LATENCY = histogram("skill_twitter_request_seconds", "Latency of twitter API calls",
+                            ("endpoint", "method"))
+TWITTER_RESPONSES = counter("skill_twitter_responses_total", "Twitter API responses by status code",
+                            ("endpoint", "method", "status"))
+VALIDATION_LATENCY = histogram("skill_validation_seconds", "Time spent in each request validation stage",
+                               ("stage",))
+VALIDATION_REJECTED = counter("skill_validation_rejected_total", "Requests rejected, by validation stage",
+                              ("stage",))
+CACHE_LOOKUPS = counter("skill_cache_lookups_total", "Twitter cache user lookups, by hit or miss",
+                        ("result",))
+CACHE_EVICTIONS = counter("skill_cache_evictions_total", "Users evicted from the twitter cache")
+CACHE_RESIDENT_USERS = gauge("skill_cache_resident_users", "Users held in memory by the twitter cache")
+CACHE_RESIDENT_BYTES = gauge("skill_cache_resident_bytes", "Estimated bytes of the users held in memory")
+CACHE_USER_BYTES = gauge("skill_cache_resident_user_bytes", "Estimated bytes per user held in memory")
+SESSION_KEYS_EXPIRED = counter("skill_cache_session_keys_expired_total",
+                               "Session keys dropped from user states once their ttl passed", ("key",))
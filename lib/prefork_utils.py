@@ -0,0 +1,96 @@
+"""
+Pre-fork process supervisor.
+
+The supervisor binds the listening socket once, then forks worker processes that
+all accept connections on it (the kernel hands each connection to one of them),
+and forks a replacement whenever a worker dies. SIGTERM or SIGINT to the
+supervisor stops every worker, the forward_signals are passed on to every worker.
+"""
+from __future__ import print_function
+import os
+import signal
+import socket
+import time
+import traceback
+
+# Seconds to wait before replacing a worker that died, so a worker that can't start doesn't spin
+RESTART_DELAY = 1.0
+
+
+def bind_socket(host, port, backlog=128):
+    """ A listening TCP socket to share between the workers """
+    family, sock_type, proto, _, address = socket.getaddrinfo(
+        host, port, socket.AF_UNSPEC, socket.SOCK_STREAM, 0, socket.AI_PASSIVE)[0]
+    listening_socket = socket.socket(family, sock_type, proto)
+    listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listening_socket.bind(address)
+    listening_socket.listen(backlog)
+    listening_socket.set_inheritable(True)
+    return listening_socket
+
+
+class Supervisor(object):
+    """
+    workers - number of worker processes
+    run_worker - function run in each worker with the worker's index, the worker
+    exits when it returns
+    forward_signals - signals passed on to the workers
+    """
+    def __init__(self, workers, run_worker, forward_signals=()):
+        self.workers = workers
+        self.run_worker = run_worker
+        self.forward_signals = tuple(forward_signals)
+        self.children = {} # pid -> worker index
+        self.stopping = False
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            # Ctrl-C reaches the whole process group, the supervisor stops the workers with SIGTERM
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            for signum in self.forward_signals:
+                signal.signal(signum, signal.SIG_DFL)
+            status = 0
+            try:
+                self.run_worker(index)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+        self.children[pid] = index
+        print ("Started worker {} (pid {})".format(index, pid))
+
+    def forward(self, signum, frame=None):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        self.forward(signal.SIGTERM)
+
+    def run(self):
+        """ Fork the workers and keep them running until stopped """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for signum in self.forward_signals:
+            signal.signal(signum, self.forward)
+        for index in range(self.workers):
+            self.spawn(index)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            index = self.children.pop(pid, None)
+            if index is None or self.stopping:
+                continue
+            print ("Worker {} (pid {}) exited with status {}, restarting it".format(
+                index, pid, os.waitstatus_to_exitcode(status)))
+            time.sleep(RESTART_DELAY)
+            if not self.stopping:
+                self.spawn(index)
@@ -0,0 +1,285 @@
+"""
+Storage backends for lib.twitter_utils.LocalCache.
+
+A backend stores the server state and the state of every user, and knows nothing
+about caching: LocalCache decides when to read and write. Each backend keeps the
+list of stored users itself.
+
+FileBackend - the original layout, a file for the server state and
+one per user, each replaced whole through a rename.
+SQLiteBackend - one SQLite database in WAL mode, users indexed by id, batches of
+users written in a single transaction.
+
+Versions let several worker processes share a backend (see LocalCache.share):
+a version changes whenever the stored state is rewritten, by any process.
+
+Users can be encoded ahead of writing them (encode, then write_encoded), so
+that the caller can take a consistent snapshot of a state that other threads
+change, and write it without holding them up.
+
+States are written in one of FORMATS: binary, the compact format of
+lib/codec_utils.py, or jsonpickle, the format of older caches. Either is read
+back whatever the backend writes, so a cache can be converted a user at a time
+(see scripts/convert_cache.py).
+"""
+import glob
+import os
+import sqlite3
+import threading
+import jsonpickle
+from lib import codec_utils
+
+FORMATS = ("binary", "jsonpickle")
+
+
+class StorageBackend(object):
+    """ Interface of the cache backends, states are plain python objects """
+    name = None
+    format = "binary"
+
+    def read_server(self):
+        """ The server state, None if there is none yet """
+        raise NotImplementedError
+
+    def write_server(self, state):
+        raise NotImplementedError
+
+    def user_ids(self):
+        raise NotImplementedError
+
+    def read_user(self, user_id):
+        """ The user's state, None if the user isn't stored """
+        data = self.read_encoded(user_id)
+        return None if data is None else self.decode(data)
+
+    def read_encoded(self, user_id):
+        """ The user's state as stored, in either format, None if the user isn't stored """
+        raise NotImplementedError
+
+    def read_users(self):
+        """ (user_id, state) of every stored user """
+        for user_id in self.user_ids():
+            state = self.read_user(user_id)
+            if state is not None:
+                yield user_id, state
+
+    def encode(self, state):
+        if self.format == "jsonpickle":
+            return jsonpickle.encode(state)
+        return codec_utils.encode(state)
+
+    def decode(self, data):
+        """ A state in either format """
+        if codec_utils.is_encoded(data):
+            return codec_utils.decode(data)
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        return jsonpickle.decode(data)
+
+    def write_users(self, users):
+        """ Store a user_id -> state dict of users """
+        self.write_encoded({user_id : self.encode(state) for user_id, state in users.items()})
+
+    def write_encoded(self, encoded_users):
+        """ Store a user_id -> encode(state) dict of users """
+        raise NotImplementedError
+
+    def server_version(self):
+        raise NotImplementedError
+
+    def user_version(self, user_id):
+        """ Changes whenever the user is written, None if the user isn't stored """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class FileBackend(StorageBackend):
+    """
+    backup.server holds the server state, backup.user.<user id> the state of each user.
+    The stored users are the ones with a file, so a new user costs no write of the
+    server state. Older caches also listed them in the server state, as its user_list,
+    which is dropped when read.
+    """
+    name = "file"
+    server_data_template = "{}.server"
+    user_data_template = "{0}.user.{1}"
+
+    def __init__(self, backup, format="binary"):
+        self.backup = backup
+        self.format = format
+
+    def server_fname(self):
+        return self.server_data_template.format(self.backup)
+
+    def user_fname(self, user_id):
+        return self.user_data_template.format(self.backup, user_id)
+
+    @staticmethod
+    def _file_version(fname):
+        """ Files are replaced rather than rewritten in place, so a new inode means new content """
+        try:
+            stat = os.stat(fname)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _read(self, fname):
+        with open(fname, 'rb') as backupfile:
+            return self.decode(backupfile.read())
+
+    def _write(self, fname, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        temp_fname = "{}.{}.{}.tmp".format(fname, os.getpid(), threading.get_ident())
+        with open(temp_fname, 'wb') as backupfile:
+            backupfile.write(data)
+        os.replace(temp_fname, fname)
+
+    def read_server(self):
+        if os.path.isdir(self.backup):
+            return None
+        try:
+            state = self._read(self.server_fname())
+        except FileNotFoundError:
+            return None
+        state.pop('user_list', None)
+        return state
+
+    def write_server(self, state):
+        self._write(self.server_fname(), self.encode(state))
+
+    def user_ids(self):
+        prefix = self.user_fname("")
+        # Skip the files of writes in progress, see _write
+        return [fname[len(prefix):] for fname in glob.glob(glob.escape(prefix) + "*")
+                if not fname.endswith(".tmp")]
+
+    def read_encoded(self, user_id):
+        try:
+            with open(self.user_fname(user_id), 'rb') as backupfile:
+                return backupfile.read()
+        except FileNotFoundError:
+            return None
+
+    def write_encoded(self, encoded_users):
+        for user_id, data in encoded_users.items():
+            self._write(self.user_fname(user_id), data)
+
+    def server_version(self):
+        return self._file_version(self.server_fname())
+
+    def user_version(self, user_id):
+        return self._file_version(self.user_fname(user_id))
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    backup.db, a users table keyed by user id and a single row server table.
+    Every row has a version counter, bumped on each write.
+    Each thread (and process) gets its own connection, which keeps the
+    statements below prepared.
+    States are stored as BLOBs in the binary format, and as TEXT in jsonpickle's.
+    """
+    name = "sqlite"
+    database_template = "{}.db"
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS server ("
+        " id INTEGER PRIMARY KEY CHECK (id = 0), state TEXT NOT NULL, version INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS users ("
+        " user_id TEXT PRIMARY KEY, state TEXT NOT NULL, version INTEGER NOT NULL) WITHOUT ROWID",
+    )
+    READ_SERVER = "SELECT state FROM server WHERE id = 0"
+    WRITE_SERVER = ("INSERT INTO server (id, state, version) VALUES (0, ?, 1) "
+                    "ON CONFLICT (id) DO UPDATE SET state = excluded.state, version = server.version + 1")
+    SERVER_VERSION = "SELECT version FROM server WHERE id = 0"
+    USER_IDS = "SELECT user_id FROM users"
+    READ_USER = "SELECT state FROM users WHERE user_id = ?"
+    READ_USERS = "SELECT user_id, state FROM users"
+    WRITE_USER = ("INSERT INTO users (user_id, state, version) VALUES (?, ?, 1) "
+                  "ON CONFLICT (user_id) DO UPDATE SET state = excluded.state, version = users.version + 1")
+    USER_VERSION = "SELECT version FROM users WHERE user_id = ?"
+
+    # Seconds a connection waits for another process's write transaction
+    BUSY_TIMEOUT = 10.0
+
+    def __init__(self, backup, format="binary"):
+        self.backup = backup
+        self.format = format
+        self.database = self.database_template.format(backup)
+        self._local = threading.local()
+        # A connection must not be used on both sides of a fork
+        os.register_at_fork(after_in_child=self._forget_connections)
+
+    def _forget_connections(self):
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.database, timeout=self.BUSY_TIMEOUT,
+                                         isolation_level=None, cached_statements=32)
+            connection.execute("PRAGMA journal_mode = WAL")
+            # With WAL a commit survives a crash of the process, only a power loss can undo the last ones
+            connection.execute("PRAGMA synchronous = NORMAL")
+            for statement in self.SCHEMA:
+                connection.execute(statement)
+            self._local.connection = connection
+        return connection
+
+    def _one(self, query, params=()):
+        row = self._connection().execute(query, params).fetchone()
+        return row[0] if row else None
+
+    def read_server(self):
+        state = self._one(self.READ_SERVER)
+        return None if state is None else self.decode(state)
+
+    def write_server(self, state):
+        self._connection().execute(self.WRITE_SERVER, (self.encode(state),))
+
+    def user_ids(self):
+        return [user_id for user_id, in self._connection().execute(self.USER_IDS)]
+
+    def read_encoded(self, user_id):
+        return self._one(self.READ_USER, (user_id,))
+
+    def read_users(self):
+        for user_id, state in self._connection().execute(self.READ_USERS):
+            yield user_id, self.decode(state)
+
+    def write_encoded(self, encoded_users):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(self.WRITE_USER, encoded_users.items())
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def server_version(self):
+        return self._one(self.SERVER_VERSION)
+
+    def user_version(self, user_id):
+        return self._one(self.USER_VERSION, (user_id,))
+
+    def close(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+BACKENDS = {backend.name : backend for backend in (FileBackend, SQLiteBackend)}
+
+
+def make_backend(name, backup, format="binary"):
+    """ A backend by name, file or sqlite, storing under the backup path in a format of FORMATS """
+    if name not in BACKENDS:
+        raise ValueError("Unknown cache backend {}, use one of {}".format(name, sorted(BACKENDS)))
+    if format not in FORMATS:
+        raise ValueError("Unknown cache format {}, use one of {}".format(format, FORMATS))
+    return BACKENDS[name](backup, format)
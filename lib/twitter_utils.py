@@ -1,129 +1,820 @@
 import requests
 import jsonpickle
 from requests_oauthlib import OAuth1
-from urllib.parse import parse_qs, urlencode
-import cherrypy 
-from collections import defaultdict 
-import json
+from oauthlib.oauth1 import Client as OAuth1Client
+from urllib.parse import parse_qs, urlencode, urlparse
 import os
 import re
+import time
+import asyncio
+import atexit
+import base64
+import fcntl
+import heapq
+import threading
+import weakref
+import zlib
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from lib.log_utils import get_logger, fields
+from lib import codec_utils
+from lib.codec_utils import register_type
+from lib.dialog_utils import PENDING_ACTION_TTL
+from lib.journal_utils import Journal
+from lib.lru_utils import SegmentedLRUCache, UserLocks
+from lib.storage_utils import make_backend
+from lib.metrics_utils import TWITTER_LATENCY, TWITTER_RESPONSES
+from lib.metrics_utils import CACHE_RESIDENT_USERS, CACHE_RESIDENT_BYTES, CACHE_USER_BYTES, SESSION_KEYS_EXPIRED
+
+log = get_logger("cache")
+twitter_log = get_logger("twitter")
 
 # For readable serializations
 jsonpickle.set_encoder_options('json', sort_keys=True, indent=4)
 
+# Base URL of the twitter API, override with the TWITTER_API_ROOT environment
+# variable to point the server at a stand-in (see benchmarks/fake_twitter.py)
+TWITTER_API_ROOT = os.environ.get("TWITTER_API_ROOT", "https://api.twitter.com")
+
+# Where the cache is backed up, override with the TWITTER_CACHE_BACKUP environment variable
+CACHE_BACKUP = os.environ.get("TWITTER_CACHE_BACKUP", "tmp/twitter.cache")
+
+# How the cache is stored (see lib/storage_utils.py), file or sqlite,
+# override with the TWITTER_CACHE_BACKEND environment variable
+CACHE_BACKEND = os.environ.get("TWITTER_CACHE_BACKEND", "file")
+
+# Format the backend writes states in, binary (lib/codec_utils.py) or jsonpickle,
+# override with the TWITTER_CACHE_FORMAT environment variable. Both are read
+CACHE_FORMAT = os.environ.get("TWITTER_CACHE_FORMAT", "binary")
+
+# Most users held in memory, and most estimated bytes of them (0 for no limit), the least
+# recently used are evicted. Override with the TWITTER_CACHE_MAX_USERS and TWITTER_CACHE_MAX_BYTES
+# environment variables
+CACHE_MAX_USERS = int(os.environ.get("TWITTER_CACHE_MAX_USERS", 10000))
+CACHE_MAX_BYTES = int(os.environ.get("TWITTER_CACHE_MAX_BYTES", 0))
+
+# Seconds between background flushes of the users that changed
+FLUSH_INTERVAL = 1.0
+
+# Journal the changes made by each request, so that they survive a crash without a flush,
+# disable with TWITTER_CACHE_JOURNAL=0. Flushes then compact the journal into the backend
+# every COMPACT_INTERVAL seconds, or once it has grown to COMPACT_BYTES
+CACHE_JOURNAL = os.environ.get("TWITTER_CACHE_JOURNAL", "1") != "0"
+COMPACT_INTERVAL = 30.0
+COMPACT_BYTES = 16 * 1024 * 1024
+
+# Tweets fetched per page of a timeline. A user's queue starts fetching the next page
+# in the background once reading gets within PREFETCH_AT tweets of the end of the
+# ones fetched, on one of PREFETCH_THREADS threads, and keeps QUEUE_WINDOW tweets behind
+# the read position
+TIMELINE_PAGE_SIZE = 20
+PREFETCH_AT = 6
+PREFETCH_THREADS = 4
+QUEUE_WINDOW = 20
+
+# Once a timeline has no older tweets, seconds between asking it for newer ones
+NEWER_CHECK_INTERVAL = 60.0
+
+# Seconds after a user's last request that the state of the conversation is kept,
+# override with the TWITTER_SESSION_TTL environment variable
+SESSION_TTL = float(os.environ.get("TWITTER_SESSION_TTL", 1800))
+
+# Keys of a user's state that only matter during a conversation -> seconds they are kept
+# after the user's last request. Their expiry times are kept in the state, under SESSION_EXPIRY_KEY
+SESSION_KEYS = {"user_queue" : SESSION_TTL,
+                "focus_tweet" : SESSION_TTL,
+                "pending_action" : PENDING_ACTION_TTL}
+SESSION_EXPIRY_KEY = "session_expiry"
+
+# An expiry time is only moved once it is this many seconds behind, so that a run of
+# requests doesn't change the user (and journal it) every time
+SESSION_TTL_SLACK = 60.0
+
 
 class LocalCache(object):
-    """ Generic class for encapsulating twitter credential caching """
-    server_data_template = "{}.server"
-    user_data_template = "{0}.user.{1}"
+    """
+    Generic class for encapsulating twitter credential caching
+    The cache is stored by a backend (lib/storage_utils.py), files by default.
+    Users are read from the backend when first used, and at most max_users of them
+    (or max_bytes) are kept in memory, see lib/lru_utils.py.
+    By default the cache lives in this process. Changed users are marked dirty, and
+    flush() writes only those (start_flusher() runs it in the background), or when
+    they are evicted, while serialize() writes everything in memory. Once the
+    background thread runs, it also writes the evicted users, so that requests don't.
+    With a journal, the changes each request makes to its user are appended to it
+    when the request is done (see user_session), and replayed by load() after a crash;
+    flush() then also compacts the journal. The request waits for its record to be
+    on disk after it lets go of the user, so the user's next request doesn't wait too.
+    After share(), the backend is the shared store of several worker processes.
+    Nothing is read from the backend until the cache is first used, or load() is called.
+
+    Each user has a lock (user_lock), held by a request for the whole user_session and
+    by the methods that change a user, so requests for different users never wait for
+    each other. Writes to the backend snapshot (encode) each user under its lock, and
+    write outside it; the background flush skips a user that is busy until the next flush.
+
+    The session keys of a user's state (session_keys) expire once the user has made no
+    request for their ttl: they are dropped when the user's next request starts, or by
+    the background flush thread if the user is still in memory, and end_session() drops
+    them at once.
+    """
+    lock_template = "{0}.lock.{1}"
+
+    journal_template = "{}.journal"
 
-    def __init__(self, backup = "tmp/twitter.cache"):
+    def __init__(self, backup = CACHE_BACKUP, backend = None,
+                 max_users = CACHE_MAX_USERS, max_bytes = CACHE_MAX_BYTES, journal = CACHE_JOURNAL,
+                 session_keys = SESSION_KEYS):
         self.backup = backup #Unique identifier for the backup of this cache
-        self.memcache = {
-            "users" : defaultdict(lambda : {}),
-            "server": defaultdict(lambda : {})
-        }
-        self.deserialize()
+        self.backend = backend or make_backend(CACHE_BACKEND, backup, CACHE_FORMAT)
+        self.journal = Journal(self.journal_template.format(backup)) if journal else None
+        self._journaled = {} # user id -> top level key -> checksum of the value last journaled
+        self._user_locks = UserLocks()
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.session_keys = session_keys
+        self._expiry_heap = [] # (expiry time, user id) of users in memory with session keys
+        self._expiry_scheduled = {} # user id -> the expiry time it has in the heap
+        self._expiry_lock = threading.Lock()
+        self.shared = False
+        self._versions = {} # user id (None for the server) -> version held in memory
+        self._server_defaults = {}
+        self._loaded = False
+        self._load_lock = threading.Lock()
+        self._server_lock = threading.Lock() # the server state in memory and _server_dirty
+        self._server_dirty = False
+        self._flusher = None
+
+    @property
+    def memcache(self):
+        if not self._loaded:
+            self.load()
+        return self._memcache
+
+    @memcache.setter
+    def memcache(self, memcache):
+        self._memcache = memcache
+
+    def load(self):
+        """
+        Load the server state from the backend, if that hasn't happened yet.
+        Threads using the cache meanwhile wait until it is loaded.
+        """
+        with self._load_lock:
+            if self._loaded:
+                return
+            self._memcache = {
+                "users" : SegmentedLRUCache(self._read_user, self._write_back,
+                                            forget=self._forget_user,
+                                            max_users=self.max_users, max_bytes=self.max_bytes),
+                "server": defaultdict(lambda : {})
+            }
+            self.deserialize()
+            self._apply_server_defaults(self._server_defaults)
+            self._loaded = True
+
+    def _forget_user(self, user_id):
+        """ The user was evicted """
+        self._versions.pop(user_id, None)
+        self._journaled.pop(user_id, None)
+
+    def set_server_defaults(self, state_dict):
+        """
+        Server state used when the backup doesn't have it, e.g. the twitter keys.
+        A value can be a function returning it, only called if the backup doesn't have it
+        """
+        self._server_defaults.update(state_dict)
+        if self._loaded:
+            self._apply_server_defaults(state_dict)
+
+    def _apply_server_defaults(self, state_dict):
+        server_state = self._memcache['server']
+        for key, value in state_dict.items():
+            if key not in server_state:
+                server_state[key] = value() if callable(value) else value
 
     def users(self):
+        """ The users in memory, users that aren't are loaded when looked up """
         return self.memcache['users']
 
+    def load_user(self, user_id):
+        """ Bring a user into memory ahead of its use """
+        if user_id:
+            self.users().get(user_id)
+
+    def resident_stats(self):
+        """ (users in memory, their estimated bytes) """
+        if not self._loaded:
+            return 0, 0
+        return self._memcache['users'].stats()
+
+    @contextmanager
+    def user_lock(self, user_id, blocking=True):
+        """
+        Hold the user's lock, with the user kept in memory, in the with block
+        (which gets whether the lock was taken). Reentrant.
+        """
+        if not user_id:
+            yield True
+            return
+        with self.pinned(user_id), self._user_locks.locked(user_id, blocking) as acquired:
+            yield acquired
+
     def set_user_state(self, user_id, state):
-        self.memcache['users'][user_id] = state
+        with self.user_lock(user_id):
+            self.memcache['users'][user_id] = state
+            self.mark_dirty(user_id)
 
     def update_user_state(self, user_id, state = {}):
-        self.memcache['users'][user_id].update(state)
+        with self.user_lock(user_id):
+            self.memcache['users'][user_id].update(state)
+            self.mark_dirty(user_id)
         
     def get_user_state(self, user_id):
+        """ The user's state, to change only in a user_session or while holding the user_lock """
         return self.memcache['users'][user_id]
 
     def clear_user_state(self, user_id):
-        return self.memcache['users'][user_id].clear()
+        with self.user_lock(user_id):
+            self.mark_dirty(user_id)
+            return self.memcache['users'][user_id].clear()
 
     def update_server_state(self, state_dict):
-        self.memcache['server'].update(state_dict)
+        if not self.shared:
+            with self._server_lock:
+                self.memcache['server'].update(state_dict)
+                self._server_dirty = True
+            return
+        with self._locked(None):
+            self._reload_server()
+            self.memcache['server'].update(state_dict)
+            self._write_server()
         
     def get_server_state(self):
+        if self.shared:
+            with self._locked(None):
+                self._reload_server()
         return self.memcache['server']
 
     def clear_server_state(self):
-        return self.memcache['server'].clear()    
-
-    def initialize_user_queue(self, user_id, queue):
-        self.memcache['users'][user_id]['user_queue'] = ReadableQueue(queue)        
+        with self._server_lock:
+            self.mark_server_dirty()
+            return self.memcache['server'].clear()    
+
+    def initialize_user_queue(self, user_id, queue, source=None):
+        """ Start reading out queue, the first page of source if there is one (see ReadableQueue) """
+        with self.user_lock(user_id):
+            self.memcache['users'][user_id]['user_queue'] = ReadableQueue(queue, source=source, user_id=user_id)
+            self.mark_dirty(user_id)
+
+    def mark_dirty(self, user_id):
+        """ The user changed and is written by the next flush (a shared cache writes users itself) """
+        if not self.shared:
+            self.users().mark_dirty(user_id)
+
+    def mark_server_dirty(self):
+        if not self.shared:
+            self._server_dirty = True
         
     def user_queue(self, user_id):
         if 'user_queue' in self.memcache['users'][user_id]:
             return self.memcache['users'][user_id]['user_queue']
             
-    def server_fname(self):
-        return self.server_data_template.format(self.backup)
-        
-    def user_fname(self, user):
-        return self.user_data_template.format(self.backup, user)
-
-    def deserialize(self):
-        cache_loaded = False
-        if os.path.exists(self.server_fname()) and not os.path.isdir(self.backup):
+    def lock_fname(self, stripe):
+        return self.lock_template.format(self.backup, stripe)
+
+    def share(self, lock_stripes=64):
+        """
+        Make the backend the store shared by several worker processes (see server.py).
+        Every worker keeps its own copy of the cache in memory: a user is reloaded
+        when another worker has rewritten it, and written back when the worker is done
+        with the user (see user_session). The server state is written through on update.
+        Users are locked across processes with flock on one of lock_stripes lock files.
+        """
+        self.lock_stripes = lock_stripes
+        # flock only excludes other processes, threads also need to exclude each other
+        self._thread_locks = [threading.Lock() for _ in range(lock_stripes + 1)]
+        self._lock_files = {}
+        # A lock file opened before a fork would share its lock with the child
+        os.register_at_fork(after_in_child=self._lock_files.clear)
+        # Users are written to the backend after every request, so the journal is only
+        # replayed once, before the workers start
+        if self.journal is not None:
+            self.replay_journal()
+            self.journal = None
+        self.shared = True
+
+    def _lock_file(self, stripe):
+        if stripe not in self._lock_files:
+            self._lock_files[stripe] = open(self.lock_fname(stripe), 'a')
+        return self._lock_files[stripe]
+
+    @contextmanager
+    def _locked(self, user_id):
+        """ Hold the stripe of a user, or the server state if user_id is None """
+        stripe = (self.lock_stripes if user_id is None
+                  else zlib.crc32(user_id.encode('utf-8')) % self.lock_stripes)
+        with self._thread_locks[stripe]:
+            lock_file = self._lock_file(stripe)
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
             try:
-                self.memcache = { "server" : {},
-                                  "users" : {} }
-                
-                with open(self.server_fname()) as backupfile:
-                    print ("Attempting to reload cache")
-                    self.memcache['server'] = jsonpickle.decode(backupfile.read())
-
-                print ("Server cache loaded", json.dumps(self.memcache, indent=4))
-                for user in self.memcache['server']['user_list']:
-                    # Try to load as much user data as possible
-                    if os.path.exists(self.user_fname(user)):
-                        print ("found path for user", user)
-                        with open(self.user_fname(user)) as userfile:
-                            user_data = jsonpickle.decode(userfile.read())
-                        self.memcache['users'][user] = user_data
-                cache_loaded = True
-            except Exception as e:
-                print ("Cache file corrupted...")
-                raise e
-        if not cache_loaded:
-            print ("Cache could not be loaded")
-            pass
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _version(self, user_id):
+        """ Version of a user (the server state if user_id is None) in the backend """
+        if user_id is None:
+            return self.backend.server_version()
+        return self.backend.user_version(user_id)
+
+    def _changed(self, user_id):
+        version = self._version(user_id)
+        return version is not None and version != self._versions.get(user_id)
+
+    def _read_user(self, user_id):
+        version = self._version(user_id) if self.shared else None
+        state = self.backend.read_user(user_id)
+        # Only users in the backend have a version, see _flush_user
+        if state is not None:
+            self._versions[user_id] = version
+        return state
+
+    def _write_user(self, user_id, state):
+        self.backend.write_users({user_id : state})
+        self._versions[user_id] = self._version(user_id)
+
+    def _reload_server(self):
+        if self._changed(None):
+            # Keep what this process set up in memory, e.g. the twitter keys
+            server_state = dict(self.memcache['server'])
+            version = self._version(None)
+            server_state.update(self.backend.read_server() or {})
+            self._versions[None] = version
+            self.memcache['server'] = server_state
+
+    def _write_server(self):
+        self.backend.write_server(self.memcache['server'])
+        self._versions[None] = self._version(None)
+
+    def refresh_user(self, user_id):
+        """
+        Before a request that doesn't hold a user_session: bring the user into memory,
+        with a shared cache reload the user if another worker wrote it since we last saw it
+        """
+        if not user_id:
+            return
+        with self.user_lock(user_id):
+            if not self.shared:
+                self.load_user(user_id)
+                return self._expire_session(user_id)
+            with self._locked(user_id):
+                self._refresh_user(user_id)
+                self.load_user(user_id)
+                self._expire_session(user_id)
+
+    def _refresh_user(self, user_id):
+        if self._changed(user_id):
+            state = self._read_user(user_id)
+            if state is not None:
+                previous = self.users().peek(user_id)
+                self.users()[user_id] = state
+                # The page the queue was fetching in the background isn't stored with it
+                queue = state.get('user_queue')
+                if isinstance(queue, ReadableQueue):
+                    queue.resume_prefetch((previous or {}).get('user_queue'))
+
+    def flush_user(self, user_id):
+        """
+        After a request that doesn't hold a user_session: persist the changes it made,
+        a shared cache writes the user back for the other workers
+        """
+        if not user_id:
+            return
+        if not self.shared:
+            with self.user_lock(user_id):
+                sequence = self._end_request(user_id)
+            return self._sync_journal(sequence)
+        with self.user_lock(user_id), self._locked(user_id):
+            self._flush_user(user_id)
+
+    def _end_request(self, user_id):
+        """ Returns the journal sequence number to sync, see journal_user """
+        if self.users().peek(user_id) is not None:
+            self._touch_session(user_id)
+            # Dirty before journaled, so a compaction never drops the record unflushed
+            self.mark_dirty(user_id)
+            return self.journal_user(user_id)
+
+    def _flush_user(self, user_id):
+        # Only users in the shared store, an unknown user must not become a logged in one,
+        # and with an empty state there's nothing worth keeping (as in take_dirty)
+        state = self.users().peek(user_id)
+        if user_id in self._versions and state:
+            self._touch_session(user_id)
+            self._write_user(user_id, state)
+
+    def _touch_session(self, user_id):
+        """
+        The user made a request: its session keys now expire their ttl from now,
+        except the ones whose time was already up, which are dropped
+        """
+        state = self.users().peek(user_id)
+        if not state:
+            return
+        now = time.time()
+        self._expire_session(user_id, now)
+        expiry = state.get(SESSION_EXPIRY_KEY, {})
+        touched = {}
+        for key, ttl in self.session_keys.items():
+            if key in state:
+                previous = expiry.get(key)
+                touched[key] = (previous if previous is not None and now + ttl - previous < SESSION_TTL_SLACK
+                                else now + ttl)
+        if touched != expiry:
+            if touched:
+                state[SESSION_EXPIRY_KEY] = touched
+            else:
+                state.pop(SESSION_EXPIRY_KEY, None)
+            self.mark_dirty(user_id)
+        if touched and not self.shared:
+            self._schedule_expiry(user_id, min(touched.values()))
+
+    def _expire_session(self, user_id, now=None):
+        """ Drop the user's session keys whose time is up, returns how many were dropped """
+        state = self.users().peek(user_id)
+        expiry = state.get(SESSION_EXPIRY_KEY) if state else None
+        if not expiry:
+            return 0
+        now = time.time() if now is None else now
+        expired = [key for key, expires_at in expiry.items() if expires_at <= now]
+        if not expired:
+            return 0
+        for key in expired:
+            if state.pop(key, None) is not None:
+                SESSION_KEYS_EXPIRED.inc(key)
+        left = {key : expires_at for key, expires_at in expiry.items() if expires_at > now}
+        if left:
+            state[SESSION_EXPIRY_KEY] = left
         else:
-            print ("CACHE LOADED SUCCESSFULLY!")
+            del state[SESSION_EXPIRY_KEY]
+        self.mark_dirty(user_id)
+        return len(expired)
+
+    def _schedule_expiry(self, user_id, expires_at):
+        with self._expiry_lock:
+            scheduled = self._expiry_scheduled.get(user_id)
+            if scheduled is None or expires_at < scheduled:
+                self._expiry_scheduled[user_id] = expires_at
+                heapq.heappush(self._expiry_heap, (expires_at, user_id))
+
+    def expire_sessions(self, now=None):
+        """
+        Drop the session keys whose time is up from the users in memory, returns the
+        number of users changed. Users that were evicted meanwhile are left to their next
+        request, and users in a request now are scheduled again when it is done.
+        """
+        now = time.time() if now is None else now
+        due = []
+        with self._expiry_lock:
+            while self._expiry_heap and self._expiry_heap[0][0] <= now:
+                expires_at, user_id = heapq.heappop(self._expiry_heap)
+                # Entries replaced by an earlier expiry time are stale
+                if self._expiry_scheduled.get(user_id) == expires_at:
+                    del self._expiry_scheduled[user_id]
+                    due.append(user_id)
+        changed = 0
+        for user_id in due:
+            with self.user_lock(user_id, blocking=False) as acquired:
+                state = self.users().peek(user_id) if acquired else None
+                if state is None:
+                    continue
+                # Not journaled: keys brought back by a replay expire again on the next request
+                if self._expire_session(user_id, now):
+                    changed += 1
+                expiry = state.get(SESSION_EXPIRY_KEY)
+                if expiry:
+                    self._schedule_expiry(user_id, min(expiry.values()))
+        if changed:
+            log.debug("Expired sessions", extra=fields(users=changed))
+        return changed
+
+    def end_session(self, user_id, keys=None):
+        """ The conversation is over: drop the user's session keys now (keys, or all of them) """
+        with self.user_lock(user_id):
+            state = self.users().peek(user_id)
+            if not state:
+                return
+            keys = self.session_keys if keys is None else keys
+            dropped = [key for key in keys if state.pop(key, None) is not None]
+            expiry = state.get(SESSION_EXPIRY_KEY)
+            if expiry:
+                for key in keys:
+                    expiry.pop(key, None)
+                if not expiry:
+                    del state[SESSION_EXPIRY_KEY]
+            if dropped:
+                self.mark_dirty(user_id)
+
+    @contextmanager
+    def pinned(self, user_id):
+        """ The user stays in memory in the with block """
+        if not user_id:
+            yield
+            return
+        with self.users().pinned(user_id):
+            yield
+
+    @contextmanager
+    def user_session(self, user_id):
+        """
+        Serve one request for a user, handlers change the user's state in place,
+        so the user is kept in memory and locked during the request, and marked dirty
+        when it is done. Requests for other users go on meanwhile.
+        With a shared cache the user is reloaded if needed, and locked in every
+        worker until the request is done and the user written back.
+        """
+        if not user_id:
+            yield
+            return
+        if not self.shared:
+            with self.user_lock(user_id):
+                # Expired keys are only dropped from a user in memory, never extended
+                self.load_user(user_id)
+                self._expire_session(user_id)
+                try:
+                    yield
+                finally:
+                    sequence = self._end_request(user_id)
+            self._sync_journal(sequence)
+            return
+        with self.user_lock(user_id), self._locked(user_id):
+            self._refresh_user(user_id)
+            self.load_user(user_id)
+            self._expire_session(user_id)
+            try:
+                yield
+            finally:
+                self._flush_user(user_id)
+
+    def commit_user(self, user_id):
+        """ Persist a user that just logged in """
+        if not self.shared:
+            with self.user_lock(user_id):
+                self.mark_dirty(user_id)
+                sequence = self.journal_user(user_id)
+            return self._sync_journal(sequence)
+        with self.user_lock(user_id), self._locked(user_id):
+            self._write_user(user_id, self.users()[user_id])
+
+    def journal_user(self, user_id):
+        """
+        Queue a journal record of the top level keys of the user's state that changed
+        since the user was last journaled (all of them the first time), and the ones
+        removed. Values are in the binary format of lib/codec_utils.py.
+        Call holding the user's lock, so records of a user are queued in the order of
+        its changes. Returns the sequence number to pass to _sync_journal, or None
+        """
+        state = self.users().peek(user_id) if self.journal is not None else None
+        if state is None:
+            return None
+        encoded = {key : codec_utils.encode(value) for key, value in list(state.items())}
+        checksums = {key : zlib.crc32(data) for key, data in encoded.items()}
+        previous = self._journaled.get(user_id, {})
+        changed = {key : base64.b64encode(data).decode('ascii') for key, data in encoded.items()
+                   if previous.get(key) != checksums[key]}
+        removed = [key for key in previous if key not in checksums]
+        self._journaled[user_id] = checksums
+        if not (changed or removed):
+            return None
+        return self.journal.queue({"user" : user_id, "values" : changed, "del" : removed})
+
+    def _sync_journal(self, sequence):
+        """ Returns once the record queued as sequence is on disk, along with other requests' """
+        if sequence is not None:
+            self.journal.wait(sequence)
+
+    def replay_journal(self):
+        """ Apply the journal to the users in the backend, and remove it """
+        segments = self.journal.rotate()
+        if not segments:
+            return
+        users = {}
+        records, skipped = 0, 0
+        for record in self.journal.replay():
+            if "values" not in record:
+                # Written by an older version as jsonpickle, which could create any class
+                skipped += 1
+                continue
+            user_id = record["user"]
+            if user_id not in users:
+                users[user_id] = self.backend.read_user(user_id) or {}
+            state = users[user_id]
+            for key, value in record["values"].items():
+                state[key] = codec_utils.decode(base64.b64decode(value))
+            for key in record["del"]:
+                state.pop(key, None)
+            records += 1
+        if users:
+            self.backend.write_users(users)
+        self.journal.remove(segments)
+        if skipped:
+            log.warning("Skipped old journal records", extra=fields(records=skipped))
+        log.info("Replayed journal", extra=fields(records=records, users=len(users)))
 
+    def deserialize(self):
+        """ Read the server state from the backend, see load(). Users are read when first used """
+        try:
+            log.info("Attempting to reload cache", extra=fields(backend=self.backend.name))
+            version = self.backend.server_version()
+            server_state = self.backend.read_server()
+            if self.journal is not None:
+                self.replay_journal()
+        except Exception as e:
+            log.exception("Cache file corrupted...")
+            raise e
+        if server_state is None:
+            log.warning("Cache could not be loaded")
+            return
+        self._memcache['server'] = server_state
+        self._versions[None] = version
+        log.info("Cache loaded successfully")
+
+    def flush(self):
+        """
+        Write the users marked dirty since the last flush, in one batch,
+        and the server state if it changed.
+        With a journal, the segments written before the flush are removed once it is done.
+        """
+        segments = self.journal.rotate() if self.journal is not None else []
+        server_state = self._take_server()
+        users = self.users()
+        # Users with an empty state have nothing worth keeping, e.g. one that never logged in
+        to_write = users.take_dirty()
+        # Users in a request now are written by the next flush, their changes are in the journal
+        encoded, busy = self._snapshot(to_write, blocking=False)
+        if busy:
+            users.written(busy, stored=False)
+            to_write = {user_id : state for user_id, state in to_write.items() if user_id not in busy}
+            segments = []
+        if not (to_write or server_state is not None):
+            if segments:
+                self.journal.remove(segments)
+            return
+        try:
+            if encoded:
+                self.backend.write_encoded(encoded)
+            if server_state is not None:
+                self.backend.write_server(server_state)
+        except Exception:
+            log.exception("Could not write the cache")
+            # Try again at the next flush
+            users.written(to_write, stored=False)
+            if server_state is not None:
+                self.mark_server_dirty()
+            return
+        users.written(to_write)
+        if segments:
+            self.journal.remove(segments)
+        log.debug("Flushed cache", extra=fields(users=len(to_write), busy=len(busy),
+                                                server=server_state is not None))
+
+    def _take_server(self):
+        """ A copy of the server state if it changed since the last write, or None """
+        with self._server_lock:
+            if not self._server_dirty:
+                return None
+            self._server_dirty = False
+            return dict(self.memcache['server'])
+
+    def _snapshot(self, states, blocking=True):
+        """
+        Encode each user_id -> state under the user's lock, so that it's written as
+        no request left it half changed. Returns the encoded users, and the ones skipped
+        because another thread holds them (never, if blocking)
+        """
+        encoded, busy = {}, {}
+        for user_id, state in states.items():
+            with self._user_locks.locked(user_id, blocking) as acquired:
+                if acquired:
+                    encoded[user_id] = self.backend.encode(state)
+                else:
+                    busy[user_id] = state
+        return encoded, busy
+
+    def _write_back(self, states):
+        """ Write evicted users, which nobody holds, as they are not pinned """
+        encoded, _ = self._snapshot(states)
+        self.backend.write_encoded(encoded)
+
+    def write_evicted(self):
+        """ Write the users evicted since the last flush or write_evicted, see start_flusher """
+        users = self.users()
+        evicted = users.take_evicted()
+        if not evicted:
+            return
+        # Users looked up again and now in a request are written by the next flush
+        encoded, busy = self._snapshot(evicted, blocking=False)
+        if busy:
+            users.written(busy, stored=False)
+        try:
+            self.backend.write_encoded(encoded)
+        except Exception:
+            log.exception("Could not write back evicted users", extra=fields(users=len(encoded)))
+            users.written({user_id : evicted[user_id] for user_id in encoded}, stored=False)
+            return
+        users.written({user_id : evicted[user_id] for user_id in encoded})
+
+    def start_flusher(self, interval=FLUSH_INTERVAL):
+        """
+        Flush every interval seconds from a background thread, so that many changes
+        to a user cost one write, and once more at exit.
+        With a journal, changes are already safe, so the flush waits for COMPACT_INTERVAL
+        or for the journal to reach COMPACT_BYTES.
+        The thread also expires the session keys of the users in memory (expire_sessions),
+        and writes the users evicted since the last round (write_evicted), which stay in
+        memory until then.
+        """
+        if self.shared or self._flusher is not None:
+            return
+        self.users().set_write_behind(True)
+        def run():
+            last_flush = time.monotonic()
+            while True:
+                time.sleep(interval)
+                self.expire_sessions()
+                self.write_evicted()
+                if (self.journal is not None and self.journal.size < COMPACT_BYTES and
+                    time.monotonic() - last_flush < COMPACT_INTERVAL):
+                    continue
+                self.flush()
+                last_flush = time.monotonic()
+        self._flusher = threading.Thread(target=run, name="cache-flusher", daemon=True)
+        self._flusher.start()
+        atexit.register(self.flush)
 
     def serialize(self):
-        json_to_serialize = self.memcache['server']
-        user_list = list(self.users().keys())
-        json_to_serialize.update({"user_list" : user_list})
-        with open(self.server_fname(), 'w') as backup_server:
-            # Serialize Server:
-            json_encoded = jsonpickle.encode(json_to_serialize)
-            backup_server.write(json_encoded)
-            
-        for user in user_list:
-            user_data = self.get_user_state(user)
-            json_encoded = jsonpickle.encode(user_data)
-            with open(self.user_fname(user), 'w') as userfile:
-                userfile.write(json_encoded)
+        """ Write the server state and every user in memory now """
+        with self._server_lock:
+            self._server_dirty = False
+            server_state = dict(self.memcache['server'])
+        users = self.users()
+        dirty = users.take_dirty()
+        encoded, _ = self._snapshot(dict(users.items()))
+        try:
+            self.backend.write_server(server_state)
+            self.backend.write_encoded(encoded)
+        except Exception:
+            users.written(dirty, stored=False)
+            raise
+        users.written(dirty)
 
 
     
 class ReadableQueue(object):    
-    def __init__(self, queue=[], pos=0):
+    """
+    Items read out a few at a time, e.g. tweets, numbered by their place in the whole list.
+    With a source (see timeline_source), the queue is a cursor over a twitter timeline
+    rather than a fixed list: once reading gets within PREFETCH_AT items of the tweets in
+    hand, the next page of older tweets (max_id) is fetched in the background, and when
+    there are no older ones, reading on asks for tweets posted since the first page (since_id),
+    at most every NEWER_CHECK_INTERVAL seconds. Only get_next and the background fetch
+    call twitter. Only QUEUE_WINDOW items behind the read position are kept.
+    Not thread safe, a user's queue is only used while holding the user's lock.
+    """
+    # Fetch of the next page in progress, not stored with the queue
+    _prefetch = None
+
+    def __init__(self, queue=[], pos=0, source=None, user_id=None):
         self.hashmap = { "queue" : [(i, e) for i,e in enumerate(queue)],
                          "pos" : pos }
+        if source is not None:
+            self.hashmap.update({"source" : source, "user_id" : user_id,
+                                 "max_id" : None, "since_id" : None, "exhausted" : False})
+            self._update_cursor(queue)
         return 
 
+    def __getstate__(self):
+        return {"hashmap" : self.hashmap}
+
+    def __setstate__(self, state):
+        self.hashmap = state["hashmap"]
+
     def queue(self):
+        """ (index, item) of the items in hand """
         return self.hashmap['queue']
     
     def is_empty(self):
         return len(self.queue()) == 0
 
     def is_finished(self):
-        return self.pos() == len(self.queue())
+        """ Nothing to read now: no items in hand past the read position, and no page due to fetch """
+        if self.pos() < self.end():
+            return False
+        if self.hashmap.get('source') is None:
+            return True
+        return self.hashmap['exhausted'] and not self._newer_due()
 
     def pos(self):
         return self.hashmap['pos']
@@ -131,39 +822,155 @@ class ReadableQueue(object):
     def set_pos(self, val):
         self.hashmap['pos'] = val
 
+    def start(self):
+        """ Index of the first item in hand """
+        return self.queue()[0][0] if self.queue() else self.hashmap.get('start', 0)
+
+    def end(self):
+        """ Index after the last item in hand """
+        return self.start() + len(self.queue())
+
+    def get(self, index):
+        """ (index, item) of the item at index, None if it isn't in hand """
+        if self.start() <= index < self.end():
+            return self.queue()[index - self.start()]
+        return None
+
     def get_next(self, offset=1):
-        
-        if self.pos() < len(self.queue()):
-            temp_queue =  self.queue()[self.pos(): self.pos() + offset]
-            self.set_pos(self.pos() + offset)    
-            if self.pos() > len(self.queue()): self.set_pos(len(self.queue()))
+        self._fill(self.pos() + offset - 1)
+        if self.pos() < self.end():
+            first = self.pos() - self.start()
+            temp_queue =  self.queue()[first: first + offset]
+            self.set_pos(min(self.pos() + offset, self.end()))
+            self._trim()
+            self._start_prefetch()
             return temp_queue
 
             
     def read_out_next(self, offset=1):
-         return " ".join([readable.read_out(index) for index,readable in self.get_next(offset)])
+         return " ".join([readable.read_out(index) for index,readable in self.get_next(offset) or []])
 
     def has_prev(self):
-        return self.pos() > 0
+        return self.pos() > self.start()
 
     def get_prev(self, offset=1):
-         if self.pos() > 0:
-             self.set_pos(self.pos() - offset)
-             if self.pos() < 0: 
-                 offset = offset + self.pos() 
-                 # [1, current(2), 3] get_prev(offeset=3) 
-                 # pos :=> -2, offset :=> 3-2 = 1, pos :=> 0, then read 0 to 1
-                 self.set_pos(0)
-             return self.queue()[self.pos() : offset]
+         if self.has_prev():
+             self.set_pos(max(self.pos() - offset, self.start()))
+             first = self.pos() - self.start()
+             return self.queue()[first : first + offset]
          return None
          
     def read_out_prev(self, offset=1):
-         return " ".join([readable.read_out() for readable in self.get_prev(offset)])
+         return " ".join([readable.read_out(index) for index,readable in self.get_prev(offset)])
+
+    def _update_cursor(self, tweets):
+        ids = [tweet.get_id() for tweet in tweets]
+        if not ids:
+            return
+        oldest = min(ids) - 1
+        if self.hashmap['max_id'] is None or oldest < self.hashmap['max_id']:
+            self.hashmap['max_id'] = oldest
+        self.hashmap['since_id'] = max(ids + [self.hashmap['since_id'] or 0])
+
+    def _fetch_page(self):
+        """ (older, tweets) of the next page: older tweets, or once there are none, newer ones """
+        source, user_id = self.hashmap['source'], self.hashmap['user_id']
+        if not self.hashmap['exhausted']:
+            max_id = self.hashmap['max_id']
+            return True, [tweet for tweet in fetch_timeline(user_id, source, max_id=max_id)
+                          if max_id is None or tweet.get_id() <= max_id]
+        since_id = self.hashmap['since_id']
+        return False, [tweet for tweet in fetch_timeline(user_id, source, since_id=since_id)
+                       if since_id is None or tweet.get_id() > since_id]
+
+    def _fill(self, index):
+        """ Fetch pages until the item at index is in hand, or there are no more tweets for now """
+        if self.hashmap.get('source') is None:
+            return
+        while self.end() <= index:
+            if self.hashmap['exhausted'] and not self._newer_due():
+                return
+            prefetch, self._prefetch = self._prefetch, None
+            try:
+                older, tweets = prefetch.result() if prefetch is not None else self._fetch_page()
+            except Exception:
+                twitter_log.exception("Could not fetch the next page of tweets",
+                                      extra=fields(endpoint=self.hashmap['source']['endpoint']))
+                return
+            if older and not tweets:
+                # Newer tweets are asked for from NEWER_CHECK_INTERVAL on, not right away
+                self.hashmap['exhausted'] = True
+                self.hashmap['newer_checked'] = time.time()
+                return
+            if not older:
+                self.hashmap['newer_checked'] = time.time()
+                if not tweets:
+                    return
+            end = self.end()
+            self.hashmap['queue'].extend((end + i, tweet) for i, tweet in enumerate(tweets))
+            self._update_cursor(tweets)
+
+    def _newer_due(self):
+        return time.time() - self.hashmap.get('newer_checked', 0) >= NEWER_CHECK_INTERVAL
+
+    def resume_prefetch(self, previous=None):
+        """
+        After the queue was reloaded in place of previous (see LocalCache._refresh_user):
+        take over the page previous was fetching if it is the one this queue reads next,
+        or start fetching it again if it's due
+        """
+        prefetch = getattr(previous, '_prefetch', None)
+        cursor = lambda readable: tuple(readable.hashmap.get(key) for key in ('source', 'user_id', 'max_id', 'exhausted'))
+        if prefetch is not None and self._prefetch is None and cursor(previous) == cursor(self):
+            previous._prefetch, self._prefetch = None, prefetch
+        self._start_prefetch()
+
+    def _start_prefetch(self):
+        if (self.hashmap.get('source') is None or self.hashmap['exhausted'] or
+            self._prefetch is not None or self.end() - self.pos() > PREFETCH_AT):
+            return
+        self._prefetch = prefetch_executor().submit(self._fetch_page)
+
+    def _trim(self):
+        """ Drop the items more than QUEUE_WINDOW behind the read position """
+        drop = self.pos() - QUEUE_WINDOW - self.start()
+        if drop > 0:
+            self.hashmap['start'] = self.start() + drop
+            del self.hashmap['queue'][:drop]
+
+    def to_plain(self):
+        return dict(self.hashmap, queue=[item for _, item in self.queue()], start=self.start())
+
+    @classmethod
+    def from_plain(cls, plain):
+        if isinstance(plain, list):
+            # Written before queues had a source: the items and the position
+            queue, pos = plain
+            return cls(queue, pos)
+        readable = cls.__new__(cls)
+        readable.hashmap = dict(plain, queue=[(plain['start'] + i, item) for i, item in enumerate(plain['queue'])])
+        return readable
+
+
+_prefetcher = None
+_prefetcher_lock = threading.Lock()
+
+def prefetch_executor():
+    """ Threads fetching the next pages of timelines, started on first use """
+    global _prefetcher
+    with _prefetcher_lock:
+        if _prefetcher is None:
+            _prefetcher = ThreadPoolExecutor(max_workers=PREFETCH_THREADS, thread_name_prefix="timeline-prefetch")
+        return _prefetcher
 
 
 #Local cache caches tokens for different users 
 local_cache = LocalCache()
 
+CACHE_RESIDENT_USERS.set_function(lambda: local_cache.resident_stats()[0])
+CACHE_RESIDENT_BYTES.set_function(lambda: local_cache.resident_stats()[1])
+CACHE_USER_BYTES.set_function(lambda: local_cache.resident_stats()[1] / max(local_cache.resident_stats()[0], 1))
+
 
 
 def strip_html(text):
@@ -237,6 +1044,28 @@ class Tweet(object):
     def user_mentions(self):
         return self.tweet['user_mentions']
 
+    # The fields of the tweet JSON read above, the rest of it isn't stored in the cache
+    FIELDS = ("id", "text", "retweeted", "retweet_count", "favorited", "favorites_count",
+              "in_reply_to_screen_name", "user_mentions")
+    USER_FIELDS = ("screen_name", "name", "description")
+    MENTION_FIELDS = ("screen_name", "name")
+
+    def slim(self):
+        """ The tweet JSON with only the fields that are read """
+        tweet = {key : self.tweet[key] for key in self.FIELDS if key in self.tweet}
+        if 'user' in self.tweet:
+            tweet['user'] = {key : self.tweet['user'][key] for key in self.USER_FIELDS if key in self.tweet['user']}
+        if 'entities' in self.tweet:
+            mentions = self.tweet['entities'].get('user_mentions', [])
+            tweet['entities'] = {'user_mentions' : [{key : mention[key] for key in self.MENTION_FIELDS if key in mention}
+                                                    for mention in mentions]}
+        return tweet
+
+
+# Codes of the classes kept in user states, in the binary cache format. Never reuse a code
+register_type(1, ReadableQueue, ReadableQueue.to_plain, ReadableQueue.from_plain)
+register_type(2, Tweet, Tweet.slim, Tweet)
+
 
 def get_cached_access_pair(uid):
     if uid in local_cache.users():
@@ -248,7 +1077,7 @@ def get_cached_access_pair(uid):
 
 
 def get_request_token(callback_url=None):
-    url = "https://api.twitter.com/oauth/request_token"
+    url = TWITTER_API_ROOT + "/oauth/request_token"
     consumer_key, consumer_secret = local_cache.get_server_state()['twitter_keys']
 
     auth = OAuth1(consumer_key, consumer_secret)
@@ -261,7 +1090,7 @@ def get_request_token(callback_url=None):
     
 
 def authenticate_user_page(callback_url="", metadata=None):
-    url = "https://api.twitter.com/oauth/authenticate"
+    url = TWITTER_API_ROOT + "/oauth/authenticate"
     oauth_secret, oauth_token = get_request_token(callback_url)
     local_cache.update_server_state({'metadata' : metadata })
 
@@ -275,16 +1104,16 @@ def post_tweet(user_id, message, additional_params={}):
     """
     Helper function to post a tweet 
     """
-    url = "https://api.twitter.com/1.1/statuses/update.json"    
+    url = TWITTER_API_ROOT + "/1.1/statuses/update.json"    
     params = { "status" : message }
     params.update(additional_params)
     r = make_twitter_request(url, user_id, params, request_type='POST')
-    print (r.text)
+    twitter_log.debug("Posted tweet", extra=fields(status=r.status_code, response=r.text))
     return "Successfully posted a tweet {}".format(message)
 
 
 def get_access_token(oauth_token, oauth_verifier):
-    url = "https://api.twitter.com/oauth/access_token"
+    url = TWITTER_API_ROOT + "/oauth/access_token"
     params = {"oauth_verifier" : oauth_verifier}
 
     server_state = local_cache.get_server_state()
@@ -298,7 +1127,7 @@ def get_access_token(oauth_token, oauth_verifier):
     response_obj = parse_qs(r.text)
 
     uid = response_obj['oauth_token'][0]    
-    print ("Access token", uid)
+    twitter_log.info("Received access token", extra=fields(user=uid))
 
 
     local_cache.set_user_state(user_id = uid,
@@ -307,7 +1136,7 @@ def get_access_token(oauth_token, oauth_verifier):
                                          'twitter_user_id': response_obj['user_id'][0],
                                          'screen_name' : response_obj ['screen_name'][0] 
                                })
-    local_cache.serialize()
+    local_cache.commit_user(uid)
 
     fragments = {
         "state" : local_cache.get_server_state()['metadata']['state'],
@@ -332,15 +1161,61 @@ def process_tweets(tweet_list):
 
 def make_twitter_request(url, user_id, params={}, request_type='GET'):
     """ Generically make a request to twitter API using a particular user's authorization """
-    if request_type == "GET":
-        return requests.get(url, auth=get_twitter_auth(user_id), params=params)
-    elif request_type == "POST":
-        return requests.post(url, auth=get_twitter_auth(user_id), params=params)
+    endpoint = urlparse(url).path
+    with TWITTER_LATENCY.time(endpoint, request_type):
+        if request_type == "GET":
+            response = requests.get(url, auth=get_twitter_auth(user_id), params=params)
+        elif request_type == "POST":
+            response = requests.post(url, auth=get_twitter_auth(user_id), params=params)
+    TWITTER_RESPONSES.inc(endpoint, request_type, str(response.status_code))
+    return response
+
+
+# The asyncio server sets this to its own aiohttp.ClientSession, so that async
+# twitter requests share one connection pool
+async_session = None
+
+# Elsewhere, e.g. coroutine handlers run by route_intent on the threads of the cherrypy
+# server, each event loop gets a session of its own, kept until close_loop_session
+_loop_sessions = weakref.WeakKeyDictionary() # event loop -> aiohttp.ClientSession
+
+def _twitter_session():
+    """ The aiohttp.ClientSession for async twitter requests from the running event loop """
+    if async_session is not None and not async_session.closed:
+        return async_session
+    import aiohttp # Only async requests need it, and it is slow to import
+    loop = asyncio.get_running_loop()
+    session = _loop_sessions.get(loop)
+    if session is None or session.closed:
+        session = _loop_sessions[loop] = aiohttp.ClientSession()
+    return session
+
+async def close_loop_session():
+    """ Close the session of the running event loop, if it has one """
+    session = _loop_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+async def make_twitter_request_async(url, user_id, params={}, request_type='GET'):
+    """ Async counterpart of make_twitter_request, returns the decoded JSON response """
+    consumer_key, consumer_secret = local_cache.get_server_state()['twitter_keys']
+    access_token, access_secret = get_cached_access_pair(user_id)
+    client = OAuth1Client(consumer_key, client_secret=consumer_secret,
+                          resource_owner_key=access_token, resource_owner_secret=access_secret)
+    if params:
+        url += ('&' if '?' in url else '?') + urlencode(params)
+    signed_url, headers, _ = client.sign(url, http_method=request_type)
+    endpoint = urlparse(url).path
+
+    with TWITTER_LATENCY.time(endpoint, request_type):
+        async with _twitter_session().request(request_type, signed_url, headers=headers) as response:
+            TWITTER_RESPONSES.inc(endpoint, request_type, str(response.status))
+            return await response.json(content_type=None)
 
 
 
 def get_user_twitter_details(user_id, params={}):
-    url  = "https://api.twitter.com/1.1/users/lookup.json"    
+    url  = TWITTER_API_ROOT + "/1.1/users/lookup.json"    
     user_cache = local_cache.get_user_state(user_id)    
     params.update({"user_id": user_cache['twitter_user_id'] })
     response = make_twitter_request(url, user_id, params)
@@ -351,7 +1226,7 @@ def geo_search(user_id, search_location):
     """
     Search for a location - free form
     """
-    url = "https://api.twitter.com/1.1/geo/search.json"
+    url = TWITTER_API_ROOT + "/1.1/geo/search.json"
     params =  {"query" : search_location }
     response = make_twitter_request(url, user_id, params).json()
     return response
@@ -359,18 +1234,40 @@ def geo_search(user_id, search_location):
 
 def closest_trend_search(user_id, params={}):
     #url = "https://api.twitter.com/1.1/trends/place.json"
-    url = "https://api.twitter.com/1.1/trends/closest.json"
+    url = TWITTER_API_ROOT + "/1.1/trends/closest.json"
     response = make_twitter_request(url, user_id, params).json()
     return response
 
 
 def list_trends(user_id, woe_id):
-    url = "https://api.twitter.com/1.1/trends/place.json"
+    url = TWITTER_API_ROOT + "/1.1/trends/place.json"
     params = { "id" : woe_id }
     response = make_twitter_request(url, user_id, params).json()
     return response
 
 
+async def get_user_twitter_details_async(user_id):
+    url  = TWITTER_API_ROOT + "/1.1/users/lookup.json"    
+    user_cache = local_cache.get_user_state(user_id)    
+    params = {"user_id": user_cache['twitter_user_id'] }
+    return await make_twitter_request_async(url, user_id, params)
+
+
+async def geo_search_async(user_id, search_location):
+    url = TWITTER_API_ROOT + "/1.1/geo/search.json"
+    return await make_twitter_request_async(url, user_id, {"query" : search_location })
+
+
+async def closest_trend_search_async(user_id, params={}):
+    url = TWITTER_API_ROOT + "/1.1/trends/closest.json"
+    return await make_twitter_request_async(url, user_id, params)
+
+
+async def list_trends_async(user_id, woe_id):
+    url = TWITTER_API_ROOT + "/1.1/trends/place.json"
+    return await make_twitter_request_async(url, user_id, { "id" : woe_id })
+
+
 def read_out_tweets(processed_tweets, speech_convertor=None):
     """
     Input - list of processed 'Tweets'
@@ -380,42 +1277,75 @@ def read_out_tweets(processed_tweets, speech_convertor=None):
                for index, (user, text) in enumerate(processed_tweets)]
 
 
+def timeline_source(endpoint, params={}, key=None):
+    """
+    A timeline to page through, as plain data to keep in a user's state:
+    the API endpoint, its params, and the key of the tweets in its response (None for a list)
+    """
+    return {"endpoint" : endpoint, "params" : dict(params), "key" : key}
+
+
+def fetch_timeline(user_id, source, max_id=None, since_id=None, count=TIMELINE_PAGE_SIZE):
+    """ A page of the tweets of a timeline_source, newest first, no newer than max_id and newer than since_id """
+    params = dict(source["params"], count=count)
+    if max_id is not None:
+        params["max_id"] = max_id
+    if since_id is not None:
+        params["since_id"] = since_id
+    response = make_twitter_request(TWITTER_API_ROOT + source["endpoint"], user_id, params).json()
+    return process_tweets(response[source["key"]] if source.get("key") else response)
+
+
+def home_timeline_source(params={}):
+    return timeline_source("/1.1/statuses/home_timeline.json", params)
+
+
+def retweets_of_me_source(params={}):
+    return timeline_source("/1.1/statuses/retweets_of_me.json", params)
+
+
+def favourite_tweets_source(params={}):
+    return timeline_source("/1.1/favorites/list.json", params)
+
+
+def user_tweets_source(params={}):
+    return timeline_source("/1.1/statuses/user_timeline.json", params)
+
+
+def mentions_source(params={}):
+    return timeline_source("/1.1/statuses/mentions_timeline.json", params)
+
+
+def search_tweets_source(params):
+    return timeline_source("/1.1/search/tweets.json", params, key="statuses")
+
+
 def request_tweet_list(url, user_id, params={}):
-    return process_tweets(make_twitter_request(url, user_id).json())
+    return process_tweets(make_twitter_request(url, user_id, params).json())
 
 
 def get_home_tweets(user_id, input_params={}):
-    url = "https://api.twitter.com/1.1/statuses/home_timeline.json"
-    print ("Trying to get home tweets")
-    response = request_tweet_list(url, user_id)
-    return response
+    return fetch_timeline(user_id, home_timeline_source(input_params))
 
 
 def get_retweets_of_me(user_id, input_params={}):
     """ returns recently retweeted  tweets """
-    url = "https://api.twitter.com/1.1/statuses/retweets_of_me.json"
-    print ("trying to get retweets")
-    return request_tweet_list(url, user_id)
+    return fetch_timeline(user_id, retweets_of_me_source(input_params))
 
 
 def get_my_favourite_tweets(user_id, input_params = {}):
     """ Returns a user's favourite tweets """
-    url = "https://api.twitter.com/1.1/favorites/list.json"
-    return request_tweet_list(url, user_id)
+    return fetch_timeline(user_id, favourite_tweets_source(input_params))
 
 
 def get_user_latest_tweets(user_id, params={}):
-    url = "https://api.twitter.com/1.1/statuses/user_timeline.json?"
-    return request_tweet_list(url, user_id, params)
+    return fetch_timeline(user_id, user_tweets_source(params))
     
 
 def get_latest_twitter_mentions(user_id):
-    url = "https://api.twitter.com/1.1/statuses/mentions_timeline.json"
-    return request_tweet_list(url, user_id)
+    return fetch_timeline(user_id, mentions_source())
 
 
 def search_for_tweets_about(user_id, params):
     """ Search twitter API """
-    url = "https://api.twitter.com/1.1/search/tweets.json"
-    response = make_twitter_request(url, user_id, params)
-    return process_tweets(response.json()["statuses"]) 
+    return fetch_timeline(user_id, search_tweets_source(params))
@@ -1,74 +1,319 @@
 from urllib.parse import urlparse
 import os
-import subprocess
+import sqlite3
 import requests
-import urllib
+import requests.certs
 import json
-import requests
-from datetime import datetime
+from datetime import datetime, timezone
 import base64
-import shlex
+import threading
+import time
+from collections import OrderedDict, deque
 
 from Crypto.Signature import PKCS1_v1_5 as Verifier
 from Crypto.Hash import SHA
 from Crypto.PublicKey import RSA
+from cryptography import x509
+from cryptography.x509.verification import PolicyBuilder, Store, VerificationError
+from cryptography.hazmat.primitives import hashes, serialization
+
+from lib.metrics_utils import VALIDATION_LATENCY, VALIDATION_REJECTED
 
+# The signing certificate must be issued for this domain
+ECHO_API_DOMAIN = "echo-api.amazon.com"
 
-def linux_cmd(cmd_str):
-    return str(subprocess.check_output(shlex.split(cmd_str))).replace("\\n","\n")
+# PEM bundle of root CAs that the signing certificate chain has to lead to
+TRUSTED_ROOTS_FILE = requests.certs.where()
 
+# Requests whose timestamp is further than this from our clock are rejected (seconds)
+TIMESTAMP_TOLERANCE = 150
 
-def valid_alexa_request(headers_map, request_body, disable_timestamp_validation=True):
-    '''                                                                                                                                                                  
-    Utility function to validate headers                                                                                                                                     '''
-    if not os.path.isdir("tmp"):
-        os.makedirs("tmp")
+# Where worker processes keep the request ids they have seen (see share_seen_requests)
+SHARED_REQUEST_IDS = "tmp/request_ids.db"
 
-    cert_file = "tmp/echo_cert.pem"
-    public_key_file = "tmp/pubkey.pem"
-    files_to_be_cleaned =  [cert_file, public_key_file]
 
-    cert_chain_url = headers_map["Signaturecertchainurl"]    
+def normalize_cert_url(cert_chain_url):
+    """
+    Canonical form of a SignatureCertChainUrl, used as the certificate cache key
+    e.g. 'https://S3.amazonaws.com:443/echo.api/../echo.api/echo-api-cert.pem'
+      => 'https://s3.amazonaws.com/echo.api/echo-api-cert.pem'
+    """
+    parsed_url = urlparse(cert_chain_url)
+    netloc = parsed_url.hostname or ""
+    if parsed_url.port and parsed_url.port != 443:
+        netloc += ":{}".format(parsed_url.port)
+    return "{scheme}://{netloc}{path}".format(scheme=parsed_url.scheme.lower(), netloc=netloc,
+                                              path=os.path.normpath(parsed_url.path or "/"))
+
 
-    is_url_valid =  valid_cert_url(cert_chain_url)
-    is_cert_valid = valid_certificate(cert_chain_url, cert_file)    
+def fetch_cert_chain(cert_chain_url):
+    """ Download the PEM encoded certificate chain """
+    return requests.get(cert_chain_url).content
 
-    if disable_timestamp_validation:
-        is_valid_timestamp = True
-    else:
-        is_valid_timestamp = valid_timestamp(json.loads(request_body.decode('utf-8'))['request']['timestamp'])
-    extract_public_key(cert_file, public_key_file)
-    signature = headers_map["Signature"]
-    decoded_signature = base64.b64decode(signature)
-    is_signature_verified = verify_signature(request_body, public_key_file, decoded_signature)    
 
-    #Cleanup
-    for fname in files_to_be_cleaned:
-        os.remove(fname)
+def load_trusted_roots(roots_file):
+    """ Load a PEM bundle of root certificates into a verification Store """
+    with open(roots_file, 'rb') as pem_file:
+        return Store(x509.load_pem_x509_certificates(pem_file.read()))
 
-    return (is_valid_timestamp and is_url_valid 
-            and is_cert_valid and is_signature_verified)
 
-def valid_timestamp(timestamp_str):
-    """ Validate the timestamp to ensure that it is valid
-    timestamp_str format: '2015-08-29T22:22:37Z' """
+class CertificateCache(object):
+    """
+    Bounded LRU cache of signing certificates whose chains have already been validated,
+    keyed by the normalized SignatureCertChainUrl.
+    Entries are dropped once the earliest 'Not After' date of the chain has passed,
+    so an expired intermediate ends the entry as well as an expired signing certificate.
+    fetch - function used to download a chain on a cache miss
+    trusted_roots_file - PEM bundle of roots that chains are validated against
+    All methods are safe to call from concurrent request threads.
+    """
+    def __init__(self, max_size=16, fetch=fetch_cert_chain, trusted_roots_file=TRUSTED_ROOTS_FILE):
+        self.max_size = max_size
+        self.fetch = fetch
+        self.trusted_roots_file = trusted_roots_file
+        self.entries = OrderedDict() # url -> (signing certificate, expiry of the chain)
+        self.lock = threading.Lock()
+        self._trusted_roots = None
+
+    def get(self, cert_chain_url):
+        key = normalize_cert_url(cert_chain_url)
+        with self.lock:
+            if key not in self.entries:
+                return None
+            signing_cert, expires_at = self.entries[key]
+            if datetime.now(timezone.utc) >= expires_at:
+                # A certificate of the chain expired since it was cached
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return signing_cert
+
+    def put(self, cert_chain_url, signing_cert, expires_at=None):
+        """ expires_at - earliest 'Not After' of the validated chain, defaults to the signing certificate's """
+        key = normalize_cert_url(cert_chain_url)
+        if expires_at is None:
+            expires_at = signing_cert.not_valid_after_utc
+        with self.lock:
+            self.entries[key] = (signing_cert, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def trusted_roots(self):
+        """ Store of the trusted roots, loaded on first use """
+        with self.lock:
+            if self._trusted_roots is None:
+                self._trusted_roots = load_trusted_roots(self.trusted_roots_file)
+            return self._trusted_roots
+
+
+# Validated signing certificates, shared by all requests
+cert_cache = CertificateCache()
+
+
+class VerifierCache(object):
+    """
+    Imported public keys and their PKCS1_v1_5 verifiers, keyed by the SHA-256
+    fingerprint of the signing certificate, so that each key is only parsed once.
+    Amazon rotates its signing certificate rarely, so a handful of entries is plenty.
+    """
+    def __init__(self, max_size=8):
+        self.max_size = max_size
+        self.verifiers = OrderedDict() # fingerprint -> verifier
+        self.lock = threading.Lock()
+
+    def get(self, signing_cert):
+        fingerprint = signing_cert.fingerprint(hashes.SHA256())
+        with self.lock:
+            verifier = self.verifiers.get(fingerprint)
+            if verifier is not None:
+                self.verifiers.move_to_end(fingerprint)
+                return verifier
+        verifier = Verifier.new(RSA.importKey(extract_public_key(signing_cert)))
+        with self.lock:
+            self.verifiers[fingerprint] = verifier
+            while len(self.verifiers) > self.max_size:
+                self.verifiers.popitem(last=False)
+        return verifier
+
+
+verifier_cache = VerifierCache()
+
+
+class RequestIdWindow(object):
+    """
+    Request ids seen during the last `window` seconds, used to reject replayed requests.
+    Ids are grouped into buckets of `bucket_width` seconds: a membership check looks at
+    a fixed number of sets, and expired buckets are dropped whole.
+    A request with a valid timestamp can only be replayed within 2 * TIMESTAMP_TOLERANCE
+    seconds of its first delivery, so that is the default window.
+    """
+    def __init__(self, window=2 * TIMESTAMP_TOLERANCE, bucket_width=10, clock=time.time):
+        self.window = window
+        self.bucket_width = bucket_width
+        self.clock = clock
+        self.buckets = deque() # (bucket_start, set of request ids), oldest first
+        self.lock = threading.Lock()
+
+    def _expire(self, now):
+        while self.buckets and self.buckets[0][0] + self.bucket_width <= now - self.window:
+            self.buckets.popleft()
+
+    def add(self, request_id):
+        """ Record request_id, returns False if it was already seen inside the window """
+        now = self.clock()
+        with self.lock:
+            self._expire(now)
+            for bucket_start, request_ids in self.buckets:
+                if request_id in request_ids:
+                    return False
+            bucket_start = now - now % self.bucket_width
+            if not self.buckets or self.buckets[-1][0] != bucket_start:
+                self.buckets.append((bucket_start, set()))
+            self.buckets[-1][1].add(request_id)
+            return True
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(request_ids) for bucket_start, request_ids in self.buckets)
 
-    #No idea why my time is offset by this amount... server time drift?
-    mysterious_delta = 296
 
-    timestamp = datetime.strptime(timestamp_str,"%Y-%m-%dT%H:%M:%SZ")
-    dt = datetime.utcnow() - timestamp
-    print (dt, dt.seconds)
-    return False if dt.seconds-mysterious_delta> 150 else True
+class SharedRequestIdWindow(object):
+    """
+    RequestIdWindow kept in a SQLite database, so that the worker processes of
+    server.py reject a request replayed to any of them, not only to the one that
+    accepted it. Each thread (and process) gets its own connection, and every
+    bucket_width seconds a process deletes the ids older than the window.
+    """
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS request_ids ("
+              " request_id TEXT PRIMARY KEY, seen REAL NOT NULL) WITHOUT ROWID")
+    # Inserts the id, or takes it over once it has left the window, changes no row if it's in it
+    ADD = ("INSERT INTO request_ids (request_id, seen) VALUES (?, ?) "
+           "ON CONFLICT (request_id) DO UPDATE SET seen = excluded.seen WHERE request_ids.seen <= ?")
+    EXPIRE = "DELETE FROM request_ids WHERE seen <= ?"
+    COUNT = "SELECT COUNT(*) FROM request_ids WHERE seen > ?"
+
+    # Seconds a connection waits for another process's write
+    BUSY_TIMEOUT = 10.0
+
+    def __init__(self, database, window=2 * TIMESTAMP_TOLERANCE, bucket_width=10, clock=time.time):
+        self.database = database
+        self.window = window
+        self.bucket_width = bucket_width
+        self.clock = clock
+        self._next_expiry = 0
+        self._local = threading.local()
+        # A connection must not be used on both sides of a fork
+        os.register_at_fork(after_in_child=self._forget_connections)
+
+    def _forget_connections(self):
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.database, timeout=self.BUSY_TIMEOUT, isolation_level=None)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            connection.execute(self.SCHEMA)
+            self._local.connection = connection
+        return connection
+
+    def add(self, request_id):
+        """ Record request_id, returns False if any worker already saw it inside the window """
+        now = self.clock()
+        connection = self._connection()
+        if now >= self._next_expiry:
+            self._next_expiry = now + self.bucket_width
+            connection.execute(self.EXPIRE, (now - self.window,))
+        return connection.execute(self.ADD, (request_id, now, now - self.window)).rowcount == 1
+
+    def __len__(self):
+        return self._connection().execute(self.COUNT, (self.clock() - self.window,)).fetchone()[0]
 
 
-def verify_signature(request_body, public_key_file, signature):
+# Request ids of recently accepted requests, shared by all requests
+seen_requests = RequestIdWindow()
+
+
+def share_seen_requests(database=SHARED_REQUEST_IDS):
     """
-    Given a public key, a request body and a signature - verifies that the signature is valid.
+    Keep the request ids in database, for requests served by several processes.
+    Call before forking them
+    """
+    global seen_requests
+    seen_requests = SharedRequestIdWindow(database)
+
+
+def valid_alexa_request(headers_map, request_body, disable_timestamp_validation=False,
+                        cache=None, verifiers=None, request=None):
+    '''
+    Utility function to validate headers
+    Certificates and keys are only ever held in memory, so this is safe to call
+    from concurrent request threads.
+    Unless timestamp validation is disabled, stale requests and replays of an
+    already accepted requestId are rejected as well.
+    cache - CertificateCache to use, defaults to the shared cert_cache
+    verifiers - VerifierCache to use, defaults to the shared verifier_cache
+    request - the already parsed dialog_utils.Request for request_body, if there is one
+    '''
+    def rejected(stage):
+        VALIDATION_REJECTED.inc(stage)
+        return False
+
+    with VALIDATION_LATENCY.time("certificate"):
+        signing_cert = valid_certificate(headers_map["Signaturecertchainurl"], cache)
+    if signing_cert is None:
+        return rejected("certificate")
+
+    if not disable_timestamp_validation:
+        with VALIDATION_LATENCY.time("timestamp"):
+            if request is None:
+                request_json = json.loads(request_body.decode('utf-8'))['request']
+                timestamp, request_id = request_json.get('timestamp'), request_json.get('requestId')
+            else:
+                timestamp, request_id = request.timestamp(), request.request_id()
+            is_valid_timestamp = valid_timestamp(timestamp)
+        if not is_valid_timestamp:
+            return rejected("timestamp")
+
+    with VALIDATION_LATENCY.time("signature"):
+        verifiers = verifier_cache if verifiers is None else verifiers
+        verifier = verifiers.get(signing_cert)
+        decoded_signature = base64.b64decode(headers_map["Signature"])
+        is_signature_verified = verify_signature(request_body, verifier, decoded_signature)
+    if not is_signature_verified:
+        return rejected("signature")
+
+    # Only remember ids of genuine requests, so forged ones can't block real ones
+    if not disable_timestamp_validation:
+        with VALIDATION_LATENCY.time("replay"):
+            is_new_request = request_id is not None and seen_requests.add(request_id)
+        if not is_new_request:
+            return rejected("replay")
+    return True
+
+
+def valid_timestamp(timestamp_str, tolerance=TIMESTAMP_TOLERANCE):
+    """ Validate the timestamp to ensure that it is valid
+    timestamp_str format: '2015-08-29T22:22:37Z' """
+    try:
+        timestamp = datetime.strptime(timestamp_str,"%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
+    except (TypeError, ValueError):
+        return False
+    dt = datetime.now(timezone.utc) - timestamp
+    return abs(dt.total_seconds()) <= tolerance
+
+
+def verify_signature(request_body, verifier, signature):
+    """
+    Given a verifier (see VerifierCache), a request body and a signature - verifies that the signature is valid.
     """
-    public_key = RSA.importKey(open(public_key_file).read())
     h = SHA.new(request_body)
-    verifier = Verifier.new(public_key)
     return verifier.verify(h, signature)
 
 
@@ -84,52 +329,55 @@ def valid_cert_url(cert_chain_url):
     return False
 
 
-def valid_certificate(cert_url, cert_file):
+def valid_certificate(cert_url, cache=None):
     """
     Download and Validate the ceritifcate provided by the requestor
+    Returns the signing certificate if the chain is valid, None otherwise.
+    Chains that were validated by an earlier request are served from the cache.
     """
-    r = requests.get(cert_url)
-    with open(cert_file, 'wb') as cfile:
-        cfile.write(r.content)
-    get_cert_text = lambda cert: linux_cmd("openssl x509 -text -noout -in {}".format(cert))    
-    cert_text = get_cert_text(cert_file)
-    if valid_cert_text(cert_text):
-        return True
-    else:
-        return False
+    cache = cert_cache if cache is None else cache
+    signing_cert = cache.get(cert_url)
+    if signing_cert is None and valid_cert_url(cert_url):
+        try:
+            cert_chain = x509.load_pem_x509_certificates(cache.fetch(cert_url))
+        except ValueError:
+            # Not a PEM encoded certificate chain
+            return None
+        verified_chain = verify_cert_chain(cert_chain, cache.trusted_roots())
+        if verified_chain is not None:
+            signing_cert = cert_chain[0]
+            cache.put(cert_url, signing_cert, min(cert.not_valid_after_utc for cert in verified_chain))
+    return signing_cert
 
 
-def extract_public_key(cert_file, public_key_file):
+def extract_public_key(signing_cert):
     """
-    Extract the public key 
+    Extract the PEM encoded public key of the signing certificate
     """
-    os.system("openssl x509 -pubkey -noout -in {cert_file}  > {public_key_file}".format(cert_file=cert_file,
-                                                                                        public_key_file=public_key_file))
+    return signing_cert.public_key().public_bytes(serialization.Encoding.PEM,
+                                                  serialization.PublicFormat.SubjectPublicKeyInfo)
+
 
-def valid_cert_text(cert_text):
+def verify_cert_chain(cert_chain, trusted_roots):
     """
-    Validate the text of the certificate
+    Validate a parsed certificate chain, signing certificate first, against a Store
+    of trusted roots, the way a TLS client validates a server for echo-api.amazon.com:
+    every certificate is within its validity period, the signing certificate names
+    echo-api.amazon.com as a Subject Alternative Name, and each issuer is a CA
+    (BasicConstraints, keyCertSign, path length) that signed the certificate below it,
+    up to a trusted root.
+    Returns the validated chain, signing certificate first and root last, None if it isn't valid
     """
-    cert_lines = cert_text.split("\n")    
-    certificate_not_expired = False
-    certificate_has_dns = False
-
-    for index, line in enumerate(cert_lines):
-        if line.strip().startswith("Not After"):
-            def parse_time(text):
-                """Not After : Oct 31 23:59:59 2015 GMT"""
-                expiry_time_text = text.partition(":")[-1].strip()
-                expiry_datetime = datetime.strptime(expiry_time_text,"%b %d %H:%M:%S %Y GMT")
-                if datetime.utcnow() < expiry_datetime:
-                    return True
-                else:
-                    return False
-            certificate_not_expired = parse_time(line)            
-        if line.strip().startswith("X509v3 Subject Alternative Name:"):
-             certificate_has_dns = cert_lines[index+1].strip() == "DNS:echo-api.amazon.com"
-
-    return (certificate_not_expired and certificate_has_dns)
-         
+    if not cert_chain:
+        return None
+    verifier = (PolicyBuilder().store(trusted_roots)
+                .build_server_verifier(x509.DNSName(ECHO_API_DOMAIN)))
+    try:
+        return verifier.verify(cert_chain[0], cert_chain[1:])
+    except VerificationError:
+        return None
 
 
-            
+def valid_cert_chain(cert_chain, trusted_roots):
+    """ True if verify_cert_chain accepts the chain """
+    return verify_cert_chain(cert_chain, trusted_roots) is not None
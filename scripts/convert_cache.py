@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+# Rewrite the twitter cache in place in another format, e.g. the jsonpickle files
+# in tmp/ in the compact binary format:
+# $ python3 scripts/convert_cache.py --backend file --format binary
+# Both formats are read, so the server can keep running on a cache half converted,
+# but stop it first to keep it from writing users meanwhile.
+from __future__ import print_function
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib.storage_utils import BACKENDS, FORMATS, make_backend
+from lib.twitter_utils import CACHE_BACKUP, CACHE_BACKEND
+
+
+def convert(backend, batch_size=1000):
+    """
+    Read every user and the server state, and write them back in the backend's format.
+    Returns (users converted, bytes of them in the old format, bytes in the new one)
+    """
+    old_bytes, new_bytes, converted = 0, 0, 0
+    user_ids = backend.user_ids()
+    for offset in range(0, len(user_ids), batch_size):
+        encoded = {}
+        for user_id in user_ids[offset:offset + batch_size]:
+            data = backend.read_encoded(user_id)
+            if data is None:
+                continue
+            encoded[user_id] = backend.encode(backend.decode(data))
+            old_bytes += len(data)
+            new_bytes += len(encoded[user_id])
+        backend.write_encoded(encoded)
+        converted += len(encoded)
+        print ("Converted {} users".format(converted))
+    server_state = backend.read_server()
+    if server_state is not None:
+        backend.write_server(server_state)
+    return converted, old_bytes, new_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rewrite the twitter cache in another format")
+    parser.add_argument("--backend", default=CACHE_BACKEND, choices=sorted(BACKENDS))
+    parser.add_argument("--format", default="binary", choices=FORMATS)
+    parser.add_argument("--backup", default=CACHE_BACKUP, help="backup path of the cache")
+    parser.add_argument("--batch-size", type=int, default=1000, help="users written per batch")
+    args = parser.parse_args()
+
+    backend = make_backend(args.backend, args.backup, args.format)
+    start = time.perf_counter()
+    converted, old_bytes, new_bytes = convert(backend, args.batch_size)
+    print ("Converted the server state and {} users to {} in {:.1f}s".format(
+        converted, args.format, time.perf_counter() - start))
+    if converted:
+        print ("Bytes per user: {:.0f} before, {:.0f} after".format(old_bytes / converted, new_bytes / converted))
+
+
+if __name__ == "__main__":
+    main()
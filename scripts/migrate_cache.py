@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+# Copy the twitter cache from one storage backend to another, e.g. from the
+# jsonpickle files in tmp/ to SQLite:
+# $ python3 scripts/migrate_cache.py --from file --to sqlite
+# then start the server with TWITTER_CACHE_BACKEND=sqlite. Stop the server first.
+from __future__ import print_function
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib.storage_utils import BACKENDS, FORMATS, make_backend
+from lib.twitter_utils import CACHE_BACKUP
+
+
+def migrate(source, destination, batch_size=1000):
+    """ Copy the server state and every user, returns the number of users copied """
+    server_state = source.read_server()
+    if server_state is not None:
+        destination.write_server(server_state)
+    copied = 0
+    batch = {}
+    for user_id, state in source.read_users():
+        batch[user_id] = state
+        if len(batch) >= batch_size:
+            destination.write_users(batch)
+            copied += len(batch)
+            batch = {}
+            print ("Copied {} users".format(copied))
+    if batch:
+        destination.write_users(batch)
+        copied += len(batch)
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy the twitter cache between storage backends")
+    parser.add_argument("--from", dest="source", default="file", choices=sorted(BACKENDS))
+    parser.add_argument("--to", dest="destination", default="sqlite", choices=sorted(BACKENDS))
+    parser.add_argument("--backup", default=CACHE_BACKUP, help="backup path of the source")
+    parser.add_argument("--to-backup", help="backup path of the destination, defaults to --backup")
+    parser.add_argument("--format", default="binary", choices=FORMATS, help="format the destination is written in")
+    parser.add_argument("--batch-size", type=int, default=1000, help="users written per batch")
+    args = parser.parse_args()
+
+    if args.source == args.destination and not args.to_backup:
+        parser.error("--from and --to are the same backend, pass a different --to-backup")
+    source = make_backend(args.source, args.backup)
+    destination = make_backend(args.destination, args.to_backup or args.backup, args.format)
+    start = time.perf_counter()
+    copied = migrate(source, destination, args.batch_size)
+    print ("Copied the server state and {} users from {} to {} in {:.1f}s".format(
+        copied, args.source, args.destination, time.perf_counter() - start))
+    missing = set(source.user_ids()) - set(destination.user_ids())
+    if missing:
+        print ("Users listed by the source but not copied (no state stored): {}".format(sorted(missing)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,62 @@
 import cherrypy
+from cherrypy._cpwsgi_server import CPWSGIServer
+from cherrypy.process.servers import ServerAdapter
 import json
 import dialog
-from lib.validation_utils import valid_alexa_request
-from lib.twitter_utils import authenticate_user_page, get_access_token
+from lib.dialog_utils import Request, encode_response
+from lib.twitter_utils import authenticate_user_page, get_access_token, local_cache
+from lib import log_utils
+from lib import prefork_utils
+from lib.log_utils import get_logger, fields
+from lib import metrics_utils
 from urllib.parse import urlparse
 import os
+import signal
 import subprocess
+import threading
 import requests
 
-from config.config import SERVER_CONFIG, ALL_REQUESTS_VALID, BASE_REDIRECT_URL
+from config.config import (SERVER_CONFIG, SERVER_WORKERS, ALL_REQUESTS_VALID,
+                           LOG_LEVEL, LOG_SAMPLE_RATES, LOG_CATEGORY_LEVELS)
+
+if not ALL_REQUESTS_VALID:
+    # The certificate and signature checks are slow to import, only load them when used
+    from lib.validation_utils import valid_alexa_request, share_seen_requests
+
+request_log = get_logger("request")
+auth_log = get_logger("auth")
+
+
+def json_handler(*args, **kwargs):
+    """ json_out handler using the compact response encoder """
+    value = cherrypy.serving.request._json_inner_handler(*args, **kwargs)
+    return encode_response(value)
 
 
 class SkillServer(object):
     @cherrypy.expose
-    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_out(handler=json_handler)
     def index(self):
         content_length = int(cherrypy.request.headers['Content-Length'])
         raw_body = cherrypy.request.body.read(content_length)
-        input_json = json.loads(raw_body.decode("utf-8"))
-        is_valid_request = valid_alexa_request(cherrypy.request.headers, 
-                                               raw_body) if not ALL_REQUESTS_VALID else True
+        request = Request.from_body(raw_body) # The only JSON parse of this body
+        is_valid_request = valid_alexa_request(cherrypy.request.headers, raw_body,
+                                               request=request) if not ALL_REQUESTS_VALID else True
         if is_valid_request:
-            print ("New Request Body:", json.dumps(input_json, indent=4))
-            output_json = dialog.route_intent(input_json)
+            request_log.info("New Request", extra=fields(body=request.request))
+            output_json = dialog.route_intent(request)
             return output_json
     
+    @cherrypy.expose
+    def metrics(self):
+        """ Handler, twitter and validation metrics in the Prometheus text format """
+        cherrypy.response.headers['Content-Type'] = metrics_utils.CONTENT_TYPE
+        return metrics_utils.render()
+
     @cherrypy.expose
     def login(self, **kwargs):
         """ Create login screen for user login"""
-        print (json.dumps(kwargs, indent=4))
+        auth_log.info("Login", extra=fields(params=kwargs))
         callback_url = cherrypy.request.base+"/get_auth/"
         return authenticate_user_page(callback_url, metadata=kwargs)
 
@@ -36,16 +64,60 @@ class SkillServer(object):
     def get_auth(self, oauth_token, oauth_verifier):
         """ Receive access token for user from twitter"""
         url_fragments = get_access_token(oauth_token, oauth_verifier)
+        from config.config import BASE_REDIRECT_URL
         redirect_url = BASE_REDIRECT_URL + "#" + url_fragments
         redirect_url = redirect_url.strip()
         raise cherrypy.HTTPRedirect(redirect_url)
 
 
+class PreforkWSGIServer(CPWSGIServer):
+    """ CherryPy's WSGI server, accepting on a socket bound by the supervisor before forking """
+    def __init__(self, listening_socket):
+        self.listening_socket = listening_socket
+        super(PreforkWSGIServer, self).__init__(cherrypy.server)
+
+    def bind(self, family, type, proto=0):
+        self.socket = self.listening_socket
+        return self.socket
+
+
+def run_worker(listening_socket, config):
+    """ Serve SkillServer on the shared socket until the supervisor stops this worker """
+    log_utils.configure(LOG_LEVEL, LOG_SAMPLE_RATES, LOG_CATEGORY_LEVELS)
+    signal.signal(signal.SIGUSR2, dialog.reload_on_signal)
+    cherrypy.config.update(SERVER_CONFIG)
+    cherrypy.config.update({"engine.autoreload.on" : False})
+    # Replace the default server, which would bind its own socket
+    cherrypy.server.unsubscribe()
+    ServerAdapter(cherrypy.engine, PreforkWSGIServer(listening_socket)).subscribe()
+    cherrypy.tree.mount(SkillServer(), "/", config=config)
+    threading.Thread(target=dialog.preload, daemon=True).start()
+    cherrypy.engine.signals.subscribe()
+    cherrypy.engine.start()
+    cherrypy.engine.block()
+
+
 if __name__ == "__main__":
     """
-    Load the server config and launch the server
+    Load the server config and launch the server,
+    or a supervisor forking SERVER_WORKERS worker processes
+    kill -USR2 <pid> reloads voice_handlers.py and the intent schema
     """
     print (json.dumps(SERVER_CONFIG, indent=4))    
     config = {"global": SERVER_CONFIG}    
-    cherrypy.config.update(SERVER_CONFIG)
-    cherrypy.quickstart(SkillServer(), config=config)
+    if SERVER_WORKERS > 1:
+        local_cache.share()
+        if not ALL_REQUESTS_VALID:
+            # Every worker rejects the requests replayed to it, whichever worker served them first
+            share_seen_requests()
+        listening_socket = prefork_utils.bind_socket(SERVER_CONFIG.get("server.socket_host", "0.0.0.0"),
+                                                     SERVER_CONFIG.get("server.socket_port", 443))
+        prefork_utils.Supervisor(SERVER_WORKERS,
+                                 lambda index: run_worker(listening_socket, config),
+                                 forward_signals=[signal.SIGUSR2]).run()
+    else:
+        log_utils.configure(LOG_LEVEL, LOG_SAMPLE_RATES, LOG_CATEGORY_LEVELS)
+        signal.signal(signal.SIGUSR2, dialog.reload_on_signal)
+        threading.Thread(target=dialog.preload, daemon=True).start()
+        cherrypy.config.update(SERVER_CONFIG)
+        cherrypy.quickstart(SkillServer(), config=config)
@@ -6,23 +6,24 @@ Each VoiceHandler function receives a ResponseBuilder object as input and output
 A response object is defined as the output of ResponseBuilder.create_response()
 """
 
-import cherrypy
-import json
-from lib.dialog_utils import VoiceHandler, ResponseBuilder as r
-from lib.twitter_utils import (post_tweet, get_home_tweets, get_retweets_of_me, 
-                               get_my_favourite_tweets, get_my_favourite_tweets, 
-                               get_latest_twitter_mentions, search_for_tweets_about,
-                               get_user_latest_tweets, get_user_twitter_details,
-                               geo_search, closest_trend_search, list_trends)
+from lib.dialog_utils import VoiceHandler, PendingAction, PendingActionExecutor, ResponseBuilder as r
+from lib.log_utils import get_logger, fields
+from lib.twitter_utils import (post_tweet, fetch_timeline, home_timeline_source,
+                               retweets_of_me_source, favourite_tweets_source,
+                               mentions_source, search_tweets_source,
+                               user_tweets_source, get_user_twitter_details_async, geo_search_async,
+                               closest_trend_search_async, list_trends_async)
+
+log = get_logger("handlers")
 
 # -- Config setup -- 
-from config.config import TWITTER_CONSUMER_KEY, TWITTER_CONSUMER_SECRET
+from config import config
 from lib.twitter_utils import local_cache as twitter_cache
 
-# Run this code once on startup to load twitter keys into credentials
-server_cache_state = twitter_cache.get_server_state()
-if 'twitter_keys' not in server_cache_state:
-    server_cache_state['twitter_keys'] = (TWITTER_CONSUMER_KEY, TWITTER_CONSUMER_SECRET)
+# Load twitter keys into credentials, unless the cache already has some when it is loaded.
+# The keys file is only read then, not when this module is imported
+twitter_cache.set_server_defaults({'twitter_keys' : lambda: (config.TWITTER_CONSUMER_KEY,
+                                                             config.TWITTER_CONSUMER_SECRET)})
 
 
 def default_handler(request):
@@ -41,13 +42,12 @@ def launch_request_handler(request):
         user_cache = twitter_cache.get_user_state(user_id)        
         user_cache["amzn_id"]= request.user_id()
         base_message = "Welcome to Twitter, {} . How may I help you today ?".format(user_cache["screen_name"])
-        print (user_cache)        
-        if 'pending_action' in user_cache:
+        log.debug("Launch", extra=fields(user=user_id, state_keys=sorted(user_cache)))
+        action = pending_action(user_cache)
+        if action:
             base_message += " You have one pending action . "
-            print ("Found pending action")
-            if 'description' in user_cache['pending_action']:
-                print ("Found description")
-                base_message += user_cache['pending_action']['description']
+            if action.description:
+                base_message += action.description
         return r.create_response(base_message)
 
     card = r.create_card(title="Please log into twitter", card_type="LinkAccount")
@@ -58,6 +58,9 @@ def launch_request_handler(request):
 
 @VoiceHandler(request_type="SessionEndedRequest")
 def session_ended_request_handler(request):
+    # The timeline read out and the tweet in focus go with the conversation,
+    # a pending action is kept so that the next launch can remind the user of it
+    twitter_cache.end_session(request.access_token(), keys=("user_queue", "focus_tweet"))
     return r.create_response(message="Goodbye!")
 
 
@@ -70,12 +73,9 @@ def post_tweet_intent_handler(request):
     tweet = tweet if tweet else ""    
     if tweet:
         user_state = twitter_cache.get_user_state(request.access_token())
-        def action():
-            return post_tweet(request.access_token(), tweet)
-
         message = "I am ready to post the tweet, {} ,\n Please say yes to confirm or stop to cancel .".format(tweet)
-        user_state['pending_action'] = {"action" : action,
-                                        "description" : message} 
+        user_state['pending_action'] = PendingAction.create("post_tweet", {"message" : tweet},
+                                                            description=message).to_dict()
         return r.create_response(message=message, end_session=False)
     else:
         # No tweet could be disambiguated
@@ -89,8 +89,9 @@ def post_tweet_intent_handler(request):
 
 
 @VoiceHandler(intent="SearchTrends")
-def find_trends_handler(request):
-
+async def find_trends_handler(request):
+    """ Handlers can also be coroutines, which lets them await their twitter calls
+    instead of holding a server thread while twitter responds """
     uid = request.access_token()
     user_cache = twitter_cache.get_user_state(uid)
     resolved_location = False
@@ -100,7 +101,7 @@ def find_trends_handler(request):
 
     if not location:
         # Get trends for user's current location
-        user_details = get_user_twitter_details(uid)        
+        user_details = await get_user_twitter_details_async(uid)
         location = user_details[0]['location'] 
         if location:
             message += "Finding trends near you . "
@@ -109,13 +110,13 @@ def find_trends_handler(request):
 
     if location:
 
-        response = geo_search(request.access_token(), location) # convert natural language text to location
+        response = await geo_search_async(request.access_token(), location) # convert natural language text to location
         top_result = response['result']['places'][0]
         lon, lat = top_result['centroid'] 
         trend_params = {"lat" : lat, "long" : lon}
-        trend_location = closest_trend_search(request.access_token(), trend_params) # find closest woeid which has trends
+        trend_location = await closest_trend_search_async(request.access_token(), trend_params) # find closest woeid which has trends
         woeid = trend_location[0]['woeid']
-        trends = list_trends(request.access_token(), trend_location[0]['woeid']) # List top trends
+        trends = await list_trends_async(request.access_token(), trend_location[0]['woeid']) # List top trends
         trend_lst = [trend['name'] for trend in trends[0]['trends']]
         message += "The top trending topics near {0} are, ".format(trend_location[0]['name'])
         message += "\n".join(["{0}, {1}, ".format(index+1, trend) for index, trend in enumerate(trend_lst)])
@@ -145,15 +146,16 @@ def cancel_intent_handler(request):
 
 MAX_RESPONSE_TWEETS = 3
 
-def tweet_list_handler(request, tweet_list_builder, msg_prefix=""):
+def tweet_list_handler(request, source, msg_prefix=""):
 
     """ This is a generic function to handle any intent that reads out a list of tweets"""
-    # tweet_list_builder is a function that takes a unique identifier and returns a list of things to say
-    tweets = tweet_list_builder(request.access_token())
-    print (len(tweets), 'tweets found')
+    # source is a timeline_source, the first page of it is read out now and the user's queue
+    # fetches more as the user says 'next'
+    tweets = fetch_timeline(request.access_token(), source)
+    log.debug("tweets found", extra=fields(count=len(tweets)))
     if tweets:
         twitter_cache.initialize_user_queue(user_id=request.access_token(),
-                                            queue=tweets)
+                                            queue=tweets, source=source)
         text_to_read_out = twitter_cache.user_queue(request.access_token()).read_out_next(MAX_RESPONSE_TWEETS)        
         message = msg_prefix + text_to_read_out + ", say 'next' to hear more, or reply to a tweet by number."
         return r.create_response(message=message,
@@ -169,41 +171,39 @@ def search_tweets_handler(request):
     max_tweets = 3
     if search_topic:
         message = "Searching twitter for tweets about {} . ".format(search_topic)
-        def search_tweets_builder(uid):
-            params = {
-                "q" : search_topic,
-                "result_type" : "popular"
-            }
-            return search_for_tweets_about(request.access_token(), params)           
-        return tweet_list_handler(request, tweet_list_builder=search_tweets_builder, msg_prefix=message)
+        params = {
+            "q" : search_topic,
+            "result_type" : "popular"
+        }
+        return tweet_list_handler(request, search_tweets_source(params), msg_prefix=message)
     else:
          return r.create_response("I couldn't find a topic to search for in your request")
 
 
 @VoiceHandler(intent="FindLatestMentions")
 def list_mentions_handler(request):
-    return tweet_list_handler(request, tweet_list_builder=get_latest_twitter_mentions, msg_prefix="Looking for tweets that mention you.")
+    return tweet_list_handler(request, mentions_source(), msg_prefix="Looking for tweets that mention you.")
 
 
 @VoiceHandler(intent="ListHomeTweets")
 def list_home_tweets_handler(request):
-    return tweet_list_handler(request, tweet_list_builder=get_home_tweets)
+    return tweet_list_handler(request, home_timeline_source())
 
 
 @VoiceHandler(intent="UserTweets")
 def list_user_tweets_handler(request):
     """ by default gets tweets for current user """
-    return tweet_list_handler(request, tweet_list_builder=get_user_latest_tweets, msg_prefix="Looking for tweets posted by you.")
+    return tweet_list_handler(request, user_tweets_source(), msg_prefix="Looking for tweets posted by you.")
 
 
 @VoiceHandler(intent="RetweetsOfMe")
 def list_retweets_of_me_handler(request):
-    return tweet_list_handler(request, tweet_list_builder=get_retweets_of_me, msg_prefix="Looking for retweets.")
+    return tweet_list_handler(request, retweets_of_me_source(), msg_prefix="Looking for retweets.")
 
 
 @VoiceHandler(intent="FindFavouriteTweets")
 def find_my_favourites_handler(request):
-    return tweet_list_handler(request, tweet_list_builder=get_my_favourite_tweets, msg_prefix="Finding your favourite tweets.")
+    return tweet_list_handler(request, favourite_tweets_source(), msg_prefix="Finding your favourite tweets.")
 
 
 def focused_on_tweet(request):
@@ -222,10 +222,11 @@ def focused_on_tweet(request):
         
     index = index - 1 # Going from regular notation to CS notation
     user_state = twitter_cache.get_user_state(request.access_token())
-    queue = user_state['user_queue'].queue()
-    if index < len(queue):
+    if 'user_queue' not in user_state: # Nothing was read out in this session
+        return False
+    tweet_to_analyze = user_state['user_queue'].get(index)
+    if tweet_to_analyze:
         # Analyze tweet in queue
-        tweet_to_analyze = queue[index]
         user_state['focus_tweet'] = tweet_to_analyze
         return index + 1 # Returning to regular notation
         twitter_cache.serialize()
@@ -233,11 +234,40 @@ def focused_on_tweet(request):
 
 """
 Definining API for executing pending actions:
-action = function that does everything you want and returns a 'message' to return.
-description = read out in case there is a pending action at startup. 
-other metadata will be added as time progresses
+A handler that needs the user to confirm something stores a lib.dialog_utils.PendingAction
+as user_state['pending_action'] (with to_dict), naming the type of action and its params.
+When the user says yes, the function registered for that type with @PendingActionExecutor
+is called with the user id and the params, does everything you want and returns a 'message' to return.
+The description is read out in case there is a pending action at startup,
+and the action can't be confirmed any more once its ttl has passed.
+Pending actions are plain data so that they can be stored with the rest of the user's state,
+and confirmed by a different server process than the one that set them up.
 """
 
+def pending_action(user_state):
+    """ The user's PendingAction, None if there is none, and drops one that expired or can't be read """
+    if 'pending_action' not in user_state:
+        return None
+    action = PendingAction.from_dict(user_state['pending_action'])
+    if action is None or action.expired():
+        log.info("Dropped pending action", extra=fields(expired=action is not None))
+        del user_state['pending_action']
+        return None
+    return action
+
+
+@PendingActionExecutor("post_tweet")
+def post_tweet_action(user_id, message):
+    return post_tweet(user_id, message)
+
+
+@PendingActionExecutor("post_reply")
+def post_reply_action(user_id, message, in_reply_to_status_id):
+    message = post_tweet(user_id, message, {"in_reply_to_status_id" : in_reply_to_status_id})
+    twitter_cache.get_user_state(user_id).pop('focus_tweet', None)
+    return message
+
+
 @VoiceHandler(intent="ReplyIntent")
 def reply_handler(request):
     message = "Sorry, I couldn't tell which tweet you want to reply to. "
@@ -260,18 +290,12 @@ def reply_handler(request):
             index, focus_tweet = user_state['focus_tweet']
             tweet_message = "@{0} {1}".format(focus_tweet.get_screen_name(),
                                           slots['Tweet'])
-            params = {"in_reply_to_status_id": focus_tweet.get_id()}
-            
-            def action():
-                print ("Performing action! lambda functions are awesome!")
-                message = post_tweet(request.access_token(), tweet_message, params)
-                del user_state['focus_tweet']
-                return message
+            params = {"message" : tweet_message, "in_reply_to_status_id" : focus_tweet.get_id()}
 
             should_end_session = False
             message = "I am ready to post the tweet, {}. Please say yes to confirm or stop to cancel.".format(slots['Tweet'])
-            user_state['pending_action'] = {"action" : action,
-                                            "description" : message }
+            user_state['pending_action'] = PendingAction.create("post_reply", params,
+                                                                description=message).to_dict()
 
     return r.create_response(message=message, end_session=should_end_session)
 
@@ -282,28 +306,24 @@ def confirm_action_handler(request):
     user_state = twitter_cache.get_user_state(request.access_token())
     should_end_session = True
     if 'pending_action' in user_state:
-        params = user_state['pending_action']
+        action = pending_action(user_state)
         # Perform action
-        message = params['action']()
-        if 'message' in params:
-            message = params['message']
-        if 'callback' in params:
-            params['callback']()
-        del user_state['pending_action']
-        print ("successfully executed command")
+        message = PendingActionExecutor.execute(request.access_token(), action) if action else None
+        if message is None:
+            message = "Sorry, I couldn't do that, please ask me again."
+        user_state.pop('pending_action', None)
+        log.info("Executed pending action", extra=fields(user=request.access_token()))
         message = message + " would you like me to do anything else ? "
         should_end_session = False
     return r.create_response(message, end_session=should_end_session)
 
 
-@VoiceHandler(intent="AMAZON.CancelIntent")
 def cancel_action_handler(request):
     message = "okay."
     user_state = twitter_cache.get_user_state(request.access_token())
     should_end_session = True
     if 'pending_action' in user_state:
         del user_state['pending_action'] # Clearing out the user's pending action
-        print ("cleared user_state")
         message += " i won't do it. would you like me to do something else ? "
         should_end_session = False
     return r.create_response(message, end_session=should_end_session)
@@ -339,11 +359,14 @@ def next_intent_handler(request):
     end_session = True
     if True:
         user_queue = twitter_cache.user_queue(request.access_token())
-        if not user_queue.is_finished():
-            message = user_queue.read_out_next(MAX_RESPONSE_TWEETS)
-            if not user_queue.is_finished():
-                end_session = False
-                message = message + ". Please, say 'next' if you want me to read out more. "
+        if user_queue and not user_queue.is_finished():
+            # Empty if the timeline turns out to have nothing more
+            text_to_read_out = user_queue.read_out_next(MAX_RESPONSE_TWEETS)
+            if text_to_read_out:
+                message = text_to_read_out
+                if not user_queue.is_finished():
+                    end_session = False
+                    message = message + ". Please, say 'next' if you want me to read out more. "
     return r.create_response(message=message,
                              end_session=end_session)
         